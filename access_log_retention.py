@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""
+Roll access_logs up into hourly aggregates and purge old raw rows.
+
+Run from cron / a systemd timer (e.g. every 15 minutes), or with --loop.
+"""
+import time
+import argparse
+
+from app import create_app
+from app.tokens import get_db
+from app.retention import run_retention
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NVR wall access log retention")
+    parser.add_argument("--days", type=int, help="keep raw rows this many days")
+    parser.add_argument("--batch", type=int, help="rows deleted per transaction")
+    parser.add_argument("--loop", type=int, metavar="SECONDS",
+                        help="keep running, every SECONDS")
+    args = parser.parse_args()
+
+    app = create_app()
+    days = args.days or app.config["ACCESS_LOG_RETENTION_DAYS"]
+    batch = args.batch or app.config["ACCESS_LOG_PURGE_BATCH"]
+
+    while True:
+        with app.app_context():
+            result = run_retention(get_db(), days, batch_size=batch)
+        print(
+            f"rolled up {result['hours_rolled']} hour(s), "
+            f"deleted {result['rows_deleted']} raw row(s)"
+        )
+        if not args.loop:
+            break
+        time.sleep(args.loop)
@@ -0,0 +1,159 @@
+import os
+import time
+import atexit
+import logging
+import sqlite3
+import threading
+
+
+log = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("drop", "coalesce")
+
+_start_lock = threading.Lock()
+
+
+class AccessLogWriter:
+    """
+    Background, batched writer for access_logs.
+
+    Requests call submit(), which only appends to an in-memory buffer.
+    A writer thread flushes the buffer with executemany() in a single
+    transaction every `flush_interval` seconds, or as soon as `batch_size`
+    records are pending.
+
+    Overflow (buffer holds `max_pending` records):
+    - "drop":     the record is discarded and counted in `dropped`
+    - "coalesce": the access_logs row is discarded, but the token's
+                  last_used_at is still advanced on the next flush
+                  (one pending timestamp per token, counted in `coalesced`)
+
+    stop() (also registered with atexit) flushes whatever is pending.
+    `connect` returns the writer thread's DB connection; `observe`, if
+    set, is called with the duration of each flush transaction.
+    """
+
+    def __init__(self, connect, flush_interval=0.5, batch_size=200,
+                 max_pending=10000, overflow="coalesce", observe=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy: {overflow!r}")
+        self.connect = connect
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.observe = observe
+
+        self.written = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+        self._pid = None
+        self._thread = None
+        self._reset()
+
+    def _reset(self):
+        self._cond = threading.Condition()
+        self._pending = []
+        self._last_used = {}
+        self._stopping = False
+
+    # ---- producer side --------------------------------------------------------
+    def submit(self, token_id, path, ip, user_agent, created_at):
+        if self._pid != os.getpid():
+            self.start()
+
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                if self.overflow == "coalesce":
+                    prev = self._last_used.get(token_id)
+                    if prev is None or prev < created_at:
+                        self._last_used[token_id] = created_at
+                    self.coalesced += 1
+                else:
+                    self.dropped += 1
+                return
+
+            self._pending.append((token_id, path, ip, user_agent, created_at))
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    # ---- lifecycle ------------------------------------------------------------
+    def start(self):
+        """
+        Start the writer thread for this process.
+        Safe to call again after a fork (e.g. gunicorn --preload).
+        """
+        with _start_lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            self._reset()
+            self._thread = threading.Thread(
+                target=self._run, name="access-log-writer", daemon=True
+            )
+            self._thread.start()
+            self._pid = os.getpid()
+            atexit.register(self.stop)
+
+    def stop(self, timeout=5.0):
+        """
+        Flush pending records and stop the writer thread.
+        """
+        if self._thread is None or self._pid != os.getpid():
+            return
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        self._thread = None
+
+    # ---- writer side ----------------------------------------------------------
+    def _run(self):
+        db = self.connect()
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._stopping
+                    or len(self._pending) >= self.batch_size,
+                    timeout=self.flush_interval,
+                )
+                batch, self._pending = self._pending, []
+                last_used, self._last_used = self._last_used, {}
+                stopping = self._stopping
+
+            if batch or last_used:
+                self._write(db, batch, last_used)
+            if stopping:
+                return
+
+    def _write(self, db, batch, last_used):
+        for token_id, _path, _ip, _ua, created_at in batch:
+            prev = last_used.get(token_id)
+            if prev is None or prev < created_at:
+                last_used[token_id] = created_at
+
+        started = time.perf_counter()
+        try:
+            with db:
+                db.executemany(
+                    """
+                    INSERT INTO access_logs (token_id, path, ip, user_agent, created_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    """,
+                    batch,
+                )
+                db.executemany(
+                    """
+                    UPDATE tokens SET last_used_at = ?
+                    WHERE id = ? AND (last_used_at IS NULL OR last_used_at < ?)
+                    """,
+                    [(ts, tid, ts) for tid, ts in last_used.items()],
+                )
+        except sqlite3.Error:
+            log.exception("access log flush failed; dropped %d records", len(batch))
+            self.dropped += len(batch)
+            return
+        finally:
+            if self.observe is not None:
+                self.observe(time.perf_counter() - started)
+        self.written += len(batch)
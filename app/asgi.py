@@ -0,0 +1,311 @@
+import io
+import os
+import sys
+import time
+import asyncio
+import logging
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+
+log = logging.getLogger(__name__)
+
+# environ keys shared with the views
+ASGI_KEY = "nvrwall.asgi"                   # set on every request served here
+ASYNC_FEED_KEY = "nvrwall.async_feed"       # view -> (SharedFeed, keepalive) to stream here
+PREWAITED_KEY = "nvrwall.playlist_prewaited"  # blocking reload already waited for
+
+_DONE = object()
+
+
+class FileWrapper:
+    """
+    wsgi.file_wrapper for this server: segment bodies are read in large
+    chunks on the thread pool (or sent with http.response.pathsend).
+    """
+
+    def __init__(self, filelike, blksize=256 * 1024):
+        self.filelike = filelike
+        self.blksize = blksize
+
+    def __iter__(self):
+        while True:
+            chunk = self.filelike.read(self.blksize)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self.filelike.close()
+
+
+class AsyncApp:
+    """
+    ASGI server for the Flask app.
+
+    Every request still goes through the Flask app (same blueprint, auth,
+    templates), run on a bounded thread pool, so DB work never blocks the
+    event loop. What holds a request for long happens on the loop instead:
+
+    - response bodies are sent from the loop, one chunk read per pool hop;
+      a worker thread is never held for a whole segment download
+    - LL-HLS blocking reloads (_HLS_msn) are awaited on the loop before the
+      view runs, so the view finds the playlist ready
+    - MJPEG/mosaic views hand their feed over (ASYNC_FEED_KEY) and the
+      frames are awaited on the loop, one coroutine per viewer
+
+    Admin pages and everything else behave exactly as under WSGI.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.threads = app.config.get("ASGI_THREADS", 32)
+        self.chunk_size = app.config.get("ASGI_CHUNK_SIZE", 256 * 1024)
+        self._pool = None
+        self._pid = None
+
+    @property
+    def pool(self):
+        if self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(self.threads, thread_name_prefix="asgi")
+            self._pid = os.getpid()
+        return self._pool
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f"unsupported scope type {scope['type']!r}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                writer = self.app.extensions.get("access_log")
+                if writer is not None:
+                    await self.run(writer.stop)
+                if self._pool is not None:
+                    self._pool.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # ---- request --------------------------------------------------------------
+    async def _http(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        environ = wsgi_environ(scope, bytes(body))
+        await self._prewait_playlist(environ)
+
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await self._respond(scope, environ, send, disconnected)
+        finally:
+            watcher.cancel()
+
+    async def _prewait_playlist(self, environ):
+        """
+        Hold an LL-HLS blocking reload on the loop until the playlist has
+        the requested segment/part (or times out); the view then only
+        checks once.
+
+        Only authorized requests are held: without a grant for the playlist
+        or a valid ?token= the view answers 401 right away. The view still
+        does its own (full) check.
+        """
+        path = environ["PATH_INFO"]
+        if not (path.startswith("/hls/") and path.endswith(".m3u8")) or path.endswith(".master.m3u8"):
+            return
+        args = parse_qs(environ["QUERY_STRING"])
+        try:
+            msn = int(args["_HLS_msn"][0])
+            part = int(args["_HLS_part"][0]) if "_HLS_part" in args else None
+        except (KeyError, ValueError):
+            return
+        cache = self.app.extensions["playlist_cache"]
+        name = path[len("/hls/"):]
+        if not await self.run(self._may_fetch, environ, name):
+            return
+        playlist = await self.run(cache.get, name)
+        if playlist is None or msn > playlist.last_msn + 2:
+            return  # the view answers 404 / 400
+        await cache.wait_for_async(name, msn, part)
+        environ[PREWAITED_KEY] = True
+
+    def _may_fetch(self, environ, name):
+        from .tokens import is_token_valid
+        from .signing import request_grant
+
+        with self.app.request_context(environ):
+            grant = request_grant()
+            if grant is not None and grant.allows(name):
+                return True
+            return is_token_valid(parse_qs(environ["QUERY_STRING"]).get("token", [""])[0]) is not None
+
+    async def _respond(self, scope, environ, send, disconnected):
+        state = {}
+
+        def start_response(status, headers, exc_info=None):
+            state["status"] = int(status[:3])
+            state["headers"] = headers
+            return lambda data: None  # write() is not supported
+
+        def call_app():
+            result = self.app.wsgi_app(environ, start_response)
+            if "status" in state:
+                return result, _DONE
+            # start_response deferred to the first chunk
+            iterator = iter(result)
+            return result, next(iterator, b"")
+
+        result, first = await self.run(call_app)
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": state["status"],
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in state["headers"]
+                ],
+            })
+            feed = environ.get(ASYNC_FEED_KEY)
+            if feed is not None:
+                await self._send_feed(feed, send, disconnected)
+            elif first is not _DONE:
+                await send({"type": "http.response.body", "body": first, "more_body": True})
+                await self._send_iterable(result, send, disconnected)
+            elif isinstance(result, FileWrapper):
+                await self._send_file(scope, result, send, disconnected)
+            else:
+                await self._send_iterable(result, send, disconnected)
+        finally:
+            if hasattr(result, "close"):
+                await self.run(result.close)
+
+    # ---- bodies ---------------------------------------------------------------
+    async def _send_iterable(self, result, send, disconnected):
+        if isinstance(result, (list, tuple)):
+            for chunk in result:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        else:
+            iterator = iter(result)
+            while not disconnected.is_set():
+                chunk = await self.run(next, iterator, _DONE)
+                if chunk is _DONE:
+                    break
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def _send_file(self, scope, wrapper, send, disconnected):
+        f = wrapper.filelike
+        if "http.response.pathsend" in scope.get("extensions", {}) and f.tell() == 0:
+            await send({"type": "http.response.pathsend", "path": os.path.abspath(f.name)})
+            return
+        while not disconnected.is_set():
+            chunk = await self.run(f.read, self.chunk_size)
+            if not chunk:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def _send_feed(self, feed_and_keepalive, send, disconnected):
+        """
+        Frames of a SharedFeed until the client leaves or keepalive() says
+        stop. keepalive may hit the DB: it runs on the pool, at most once
+        a second.
+        """
+        feed, keepalive = feed_and_keepalive
+        app = self.app
+        state = {"checked": 0.0, "alive": True}
+
+        def check():
+            with app.app_context():
+                return keepalive()
+
+        async def still_wanted():
+            if disconnected.is_set():
+                return False
+            if keepalive is not None and time.monotonic() - state["checked"] >= 1:
+                state["checked"] = time.monotonic()
+                state["alive"] = await self.run(check)
+            return state["alive"]
+
+        async for part in feed.astream(still_wanted):
+            await send({"type": "http.response.body", "body": part, "more_body": True})
+        if not disconnected.is_set():
+            await send({"type": "http.response.body", "body": b""})
+
+
+def wsgi_environ(scope, body):
+    """
+    PEP 3333 environ for an ASGI HTTP scope.
+    """
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root_path.encode().decode("latin-1"),
+        "PATH_INFO": path.encode().decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "wsgi.file_wrapper": FileWrapper,
+        ASGI_KEY: True,
+    }
+    client = scope.get("client")
+    if client:
+        environ["REMOTE_ADDR"] = client[0]
+        environ["REMOTE_PORT"] = str(client[1])
+    for name, value in scope.get("headers", ()):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            key = name
+        else:
+            key = f"HTTP_{name}"
+        if key in environ:
+            value = environ[key] + ("; " if key == "HTTP_COOKIE" else ",") + value
+        environ[key] = value
+    return environ
+
+
+def create_asgi_app(app=None):
+    """
+    ASGI application for `app` (default: create_app()). Run with e.g.
+    `uvicorn asgi:app --workers 4`.
+    """
+    if app is None:
+        from . import create_app
+        app = create_app()
+    return AsyncApp(app)
@@ -0,0 +1,92 @@
+import os
+import hashlib
+import logging
+import threading
+
+from flask import abort, current_app, request, url_for
+
+
+log = logging.getLogger(__name__)
+
+# hls.js pinned for the wall; vendor it with `python vendor_hlsjs.py`
+HLS_JS_VERSION = "1.5.20"
+HLS_JS_VENDOR_PATH = f"vendor/hls.js-{HLS_JS_VERSION}/hls.min.js"
+HLS_JS_CDN_URL = f"https://cdn.jsdelivr.net/npm/hls.js@{HLS_JS_VERSION}/dist/hls.min.js"
+_NOT_VENDORED = (
+    f"hls.js {HLS_JS_VERSION} is not vendored under app/static/{HLS_JS_VENDOR_PATH}: "
+    "run `python vendor_hlsjs.py`, or set HLS_JS_CDN = True to load it from the CDN"
+)
+
+
+class AssetVersions:
+    """
+    Content digests of files under the static folder, computed once per
+    file per process. Static files only change on deploy (restart).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def digest(self, filename):
+        digest = self._digests.get(filename)
+        if digest is None:
+            with open(os.path.join(self.root, filename), "rb") as f:
+                digest = hashlib.blake2b(f.read(), digest_size=6).hexdigest()
+            with self._lock:
+                self._digests[filename] = digest
+        return digest
+
+    def exists(self, filename):
+        return filename in self._digests or os.path.isfile(os.path.join(self.root, filename))
+
+
+def asset_url(filename):
+    """
+    URL of a static file with its content digest (?v=...), so it can be
+    cached "forever" and still change on deploy.
+    """
+    versions = current_app.extensions["assets"]
+    return url_for("static", filename=filename, v=versions.digest(filename))
+
+
+def hls_js_url():
+    """
+    The vendored hls.js, or the same pinned version from the CDN when
+    HLS_JS_CDN is set. With neither, the page that needs it answers 503
+    rather than silently falling back to the CDN.
+    """
+    if current_app.config.get("HLS_JS_CDN"):
+        return HLS_JS_CDN_URL
+    if not current_app.extensions["assets"].exists(HLS_JS_VENDOR_PATH):
+        log.error("%s", _NOT_VENDORED)
+        abort(503, "hls.js is not installed on this server")
+    return asset_url(HLS_JS_VENDOR_PATH)
+
+
+
+def init_app(app):
+    """
+    - asset_url() / hls_js_url() in templates
+    - versioned static responses are public, immutable, STATIC_MAX_AGE
+    - hls.js must be vendored (`python vendor_hlsjs.py`) unless HLS_JS_CDN
+      is set: a missing file is logged at startup and makes the pages
+      that load it answer 503; it is never a silent CDN fallback. CLIs and
+      pages without video start regardless
+    Templates are compiled once and cached by Jinja (TEMPLATES_AUTO_RELOAD
+    is off outside debug).
+    """
+    app.extensions["assets"] = AssetVersions(app.static_folder)
+    if not app.config.get("HLS_JS_CDN") and not app.extensions["assets"].exists(HLS_JS_VENDOR_PATH):
+        log.warning("%s", _NOT_VENDORED)
+    app.jinja_env.globals.update(asset_url=asset_url, hls_js_url=hls_js_url)
+
+    @app.after_request
+    def _cache_versioned_static(resp):
+        if request.endpoint == "static" and "v" in request.args and resp.status_code in (200, 304):
+            resp.cache_control.no_cache = None
+            resp.cache_control.public = True
+            resp.cache_control.max_age = app.config.get("STATIC_MAX_AGE", 365 * 86400)
+            resp.cache_control.immutable = True
+        return resp
@@ -0,0 +1,363 @@
+import re
+import math
+import time
+import sqlite3
+import threading
+
+from flask import current_app
+
+from .tokens import get_db
+
+
+# Grid sizes /wall can render (NxN)
+GRIDS = (1, 2, 3, 4)
+
+# Same alphabet as grant channel names (see app/signing.py)
+_STREAM_NAME = re.compile(r"^[A-Za-z0-9-]+$")
+
+
+class Channel:
+    """
+    A camera. `main`, `sub` and `low` are HLS stream names (<name>.m3u8 in
+    HLS_DIR): the DVR main stream, its low-bitrate sub-stream and an
+    optional transcoded low tier; only `main` is required.
+    """
+
+    __slots__ = ("id", "name", "title", "main", "sub", "low", "position", "enabled")
+
+    def __init__(self, id, name, title, main, sub, low, position, enabled):
+        self.id = id
+        self.name = name
+        self.title = title or name
+        self.main = main
+        self.sub = sub
+        self.low = low
+        self.position = position
+        self.enabled = bool(enabled)
+
+    def stream(self, small):
+        """
+        Stream name for a tile: the sub-stream for small tiles when there
+        is one, the main stream otherwise.
+        """
+        return self.sub if small and self.sub else self.main
+
+    @property
+    def renditions(self):
+        """
+        (tier, stream name) from the highest quality down.
+        """
+        tiers = (("main", self.main), ("sub", self.sub), ("low", self.low))
+        return [(tier, stream) for tier, stream in tiers if stream]
+
+    @property
+    def streams(self):
+        return [stream for _, stream in self.renditions]
+
+    @property
+    def master(self):
+        """
+        Master playlist name (<master>.m3u8) if there is more than one
+        rendition, else None.
+        """
+        return f"{self.name}.master" if len(self.renditions) > 1 else None
+
+
+class Layout:
+    """
+    A named wall: an NxN grid and its tiles as (channel name, span), placed
+    in order; a tile with span > 1 covers span x span cells.
+    """
+
+    __slots__ = ("id", "name", "grid", "tiles")
+
+    def __init__(self, id, name, grid, tiles):
+        self.id = id
+        self.name = name
+        self.grid = grid
+        self.tiles = tiles
+
+
+class Tile:
+    __slots__ = ("channel", "span", "stream", "main")
+
+    def __init__(self, channel, span, small):
+        self.channel = channel
+        self.span = span
+        self.stream = channel.stream(small)
+        self.main = self.stream == channel.main
+
+
+class Catalog:
+    """
+    Immutable snapshot of channels and layouts.
+    """
+
+    def __init__(self, channels, layouts):
+        self.channels = channels                      # all, in wall order
+        self.enabled = [ch for ch in channels if ch.enabled]
+        self.by_name = {ch.name: ch for ch in channels}
+        self.layouts = {layout.name: layout for layout in layouts}
+        self.streams = {
+            stream: ch for ch in self.enabled for stream in ch.streams
+        }
+
+    def default_grid(self):
+        """
+        Smallest grid that shows every enabled channel (capped at 4x4).
+        """
+        n = max(1, len(self.enabled))
+        return min(GRIDS[-1], math.ceil(math.sqrt(n)))
+
+    def tiles(self, layout=None, grid=None, page=0):
+        """
+        (grid, [Tile]) for a named layout, or for `grid` x `grid` enabled
+        channels starting at page * grid².
+
+        Only a tile that fills the screen (1x1) or is enlarged (span > 1)
+        gets the main stream; every other tile gets the sub-stream.
+        """
+        if layout is not None:
+            tiles = []
+            for name, span in layout.tiles:
+                ch = self.by_name.get(name)
+                if ch is not None and ch.enabled:
+                    tiles.append(Tile(ch, span, small=layout.grid > 1 and span == 1))
+            return layout.grid, tiles
+
+        grid = grid or self.default_grid()
+        per_page = grid * grid
+        channels = self.enabled[page * per_page:(page + 1) * per_page]
+        return grid, [Tile(ch, 1, small=grid > 1) for ch in channels]
+
+
+# ---- Cache --------------------------------------------------------------------
+class ChannelCatalog:
+    """
+    Per-worker cache of the channels/layouts tables.
+
+    The catalog is re-read only when the `channel_generation` counter in
+    `settings` changes, and that counter is looked at no more than once
+    every `generation_interval` seconds.
+    """
+
+    def __init__(self, generation_interval=5):
+        self.generation_interval = generation_interval
+        self._catalog = None
+        self._generation = None
+        self._checked_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def get(self, db):
+        now = time.monotonic()
+        if self._catalog is not None and now - self._checked_at < self.generation_interval:
+            return self._catalog
+        with self._lock:
+            if self._catalog is None or now - self._checked_at >= self.generation_interval:
+                generation = _read_channel_generation(db)
+                if self._catalog is None or generation != self._generation:
+                    self._catalog = load_catalog(db)
+                    self._generation = generation
+                self._checked_at = now
+            return self._catalog
+
+    def invalidate(self):
+        with self._lock:
+            self._catalog = None
+
+
+def load_catalog(db):
+    channels = [
+        Channel(r["id"], r["name"], r["title"], r["main_stream"], r["sub_stream"],
+                r["low_stream"], r["position"], r["enabled"])
+        for r in db.execute(
+            """
+            SELECT id, name, title, main_stream, sub_stream, low_stream, position, enabled
+            FROM channels
+            ORDER BY position, name
+            """
+        )
+    ]
+    tiles = {}
+    for r in db.execute(
+        """
+        SELECT lt.layout_id, c.name, lt.span
+        FROM layout_tiles lt JOIN channels c ON c.id = lt.channel_id
+        ORDER BY lt.layout_id, lt.slot
+        """
+    ):
+        tiles.setdefault(r["layout_id"], []).append((r["name"], r["span"]))
+    layouts = [
+        Layout(r["id"], r["name"], r["grid"], tiles.get(r["id"], []))
+        for r in db.execute("SELECT id, name, grid FROM layouts ORDER BY name")
+    ]
+    return Catalog(channels, layouts)
+
+
+def _read_channel_generation(db):
+    row = db.execute(
+        "SELECT value FROM settings WHERE key = 'channel_generation'"
+    ).fetchone()
+    return row["value"] if row else None
+
+
+def _bump_channel_generation(db):
+    """
+    Bump the cross-worker channel generation counter (caller commits).
+    """
+    db.execute(
+        """
+        INSERT INTO settings (key, value) VALUES ('channel_generation', '1')
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+        """
+    )
+
+
+def _changed(db):
+    _bump_channel_generation(db)
+    db.commit()
+    current_app.extensions["channels"].invalidate()
+
+
+def _check_stream(name):
+    if not name or not _STREAM_NAME.match(name):
+        raise ValueError(f"invalid stream name: {name!r}")
+
+
+# ---- Channel / layout operations ----------------------------------------------
+def get_catalog():
+    return current_app.extensions["channels"].get(get_db())
+
+
+def save_channel(name: str, main: str | None = None, sub: str | None = None,
+                 title: str | None = None, position: int = 0,
+                 enabled: bool = True, low: str | None = None) -> None:
+    """
+    Create or update a channel. `main` defaults to the channel name.
+    """
+    main = main or name
+    _check_stream(name)
+    _check_stream(main)
+    for stream in (sub, low):
+        if stream:
+            _check_stream(stream)
+    db = get_db()
+    db.execute(
+        """
+        INSERT INTO channels (name, title, main_stream, sub_stream, low_stream, position, enabled)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET
+            title = excluded.title,
+            main_stream = excluded.main_stream,
+            sub_stream = excluded.sub_stream,
+            low_stream = excluded.low_stream,
+            position = excluded.position,
+            enabled = excluded.enabled
+        """,
+        (name, title, main, sub or None, low or None, position, int(enabled)),
+    )
+    _changed(db)
+
+
+def delete_channel(name: str) -> None:
+    db = get_db()
+    db.execute(
+        "DELETE FROM layout_tiles WHERE channel_id IN (SELECT id FROM channels WHERE name = ?)",
+        (name,),
+    )
+    db.execute("DELETE FROM channels WHERE name = ?", (name,))
+    _changed(db)
+
+
+def save_layout(name: str, grid: int, tiles) -> None:
+    """
+    Create or replace a layout. `tiles` is a list of (channel name, span).
+    """
+    if grid not in GRIDS:
+        raise ValueError(f"grid must be one of {GRIDS}")
+    db = get_db()
+    ids = {}
+    for channel, span in tiles:
+        if not 1 <= span <= grid:
+            raise ValueError(f"span of {channel!r} must be 1..{grid}")
+        row = db.execute("SELECT id FROM channels WHERE name = ?", (channel,)).fetchone()
+        if row is None:
+            raise ValueError(f"unknown channel: {channel!r}")
+        ids[channel] = row["id"]
+
+    db.execute(
+        """
+        INSERT INTO layouts (name, grid) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET grid = excluded.grid
+        """,
+        (name, grid),
+    )
+    layout_id = db.execute("SELECT id FROM layouts WHERE name = ?", (name,)).fetchone()["id"]
+    db.execute("DELETE FROM layout_tiles WHERE layout_id = ?", (layout_id,))
+    db.executemany(
+        "INSERT INTO layout_tiles (layout_id, slot, channel_id, span) VALUES (?, ?, ?, ?)",
+        [(layout_id, slot, ids[channel], span) for slot, (channel, span) in enumerate(tiles)],
+    )
+    _changed(db)
+
+
+def delete_layout(name: str) -> None:
+    db = get_db()
+    db.execute(
+        "DELETE FROM layout_tiles WHERE layout_id IN (SELECT id FROM layouts WHERE name = ?)",
+        (name,),
+    )
+    db.execute("DELETE FROM layouts WHERE name = ?", (name,))
+    _changed(db)
+
+
+def parse_tiles(spec: str):
+    """
+    "ch1:2, ch2, ch3" -> [("ch1", 2), ("ch2", 1), ("ch3", 1)]
+    """
+    tiles = []
+    for item in spec.replace(",", " ").split():
+        name, _, span = item.partition(":")
+        tiles.append((name, int(span) if span else 1))
+    return tiles
+
+
+def seed_channels(db_path: str, names) -> None:
+    """
+    First run: one channel per HLS_CHANNELS name (main stream only), so a
+    fresh install renders the same wall as before.
+
+    Runs once per database: the `channels_seeded` setting records it, so
+    channels an admin deleted don't come back on restart. Inserting bumps
+    the channel generation like any other change.
+    """
+    # Autocommit mode: IMMEDIATE so concurrently starting workers seed once
+    db = sqlite3.connect(db_path, timeout=10, check_same_thread=False, isolation_level=None)
+    try:
+        if db.execute("SELECT 1 FROM settings WHERE key = 'channels_seeded'").fetchone():
+            return
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if db.execute("SELECT 1 FROM settings WHERE key = 'channels_seeded'").fetchone() is None:
+                if db.execute("SELECT 1 FROM channels LIMIT 1").fetchone() is None and names:
+                    db.executemany(
+                        """
+                        INSERT INTO channels (name, title, main_stream, sub_stream, position, enabled)
+                        VALUES (?, ?, ?, NULL, ?, 1)
+                        """,
+                        [(name, name, name, i) for i, name in enumerate(names)],
+                    )
+                    _bump_channel_generation(db)
+                db.execute("INSERT INTO settings (key, value) VALUES ('channels_seeded', '1')")
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+    finally:
+        db.close()
+
+
+def init_app(app):
+    app.extensions["channels"] = ChannelCatalog(
+        generation_interval=app.config.get("CHANNEL_CACHE_INTERVAL", 5),
+    )
@@ -0,0 +1,162 @@
+import os
+import time
+import sqlite3
+import threading
+
+
+class ConnectionStats:
+    """
+    Counters for connection reuse and lock contention (process-wide).
+    """
+
+    FIELDS = (
+        "acquires",             # connections handed out
+        "opens",                # of which newly opened
+        "acquire_seconds",      # total time spent acquiring
+        "lock_waits",           # statements that hit SQLITE_BUSY at least once
+        "lock_wait_seconds",    # total time spent waiting on locks
+        "lock_timeouts",        # statements that gave up after `timeout`
+        "lock_conflicts",       # writes refused inside a stale read transaction
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            for field in self.FIELDS:
+                setattr(self, field, 0)
+
+    def add(self, **deltas):
+        with self._lock:
+            for field, delta in deltas.items():
+                setattr(self, field, getattr(self, field) + delta)
+
+    def snapshot(self):
+        with self._lock:
+            return {field: getattr(self, field) for field in self.FIELDS}
+
+
+def _is_busy(exc):
+    msg = str(exc)
+    return "database is locked" in msg or "database is busy" in msg
+
+
+class TrackedConnection(sqlite3.Connection):
+    """
+    sqlite3.Connection that waits for locks itself (instead of SQLite's
+    built-in busy handler) so every wait can be counted.
+
+    Only statements that start a transaction are retried: connections run
+    with isolation_level="IMMEDIATE", so a write transaction takes the
+    write lock up front and waiting for it is safe. A statement that hits
+    SQLITE_BUSY inside an already open transaction (an explicit deferred
+    BEGIN that read first) holds a snapshot another writer has moved past;
+    retrying it could never succeed, so it fails at once and the caller's
+    transaction has to start over.
+    """
+
+    lock_timeout = 10.0
+    stats = None
+
+    def _retry(self, fn, *args, in_transaction_ok=False):
+        in_transaction = self.in_transaction
+        try:
+            return fn(*args)
+        except sqlite3.OperationalError as exc:
+            if not _is_busy(exc):
+                raise
+            if in_transaction and not in_transaction_ok:
+                self.stats.add(lock_conflicts=1)
+                raise
+        started = time.perf_counter()
+        delay = 0.001
+        try:
+            while True:
+                if time.perf_counter() - started >= self.lock_timeout:
+                    self.stats.add(lock_timeouts=1)
+                    raise sqlite3.OperationalError("database is locked")
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+                try:
+                    return fn(*args)
+                except sqlite3.OperationalError as exc:
+                    if not _is_busy(exc):
+                        raise
+        finally:
+            self.stats.add(lock_waits=1, lock_wait_seconds=time.perf_counter() - started)
+
+    def execute(self, *args):
+        return self._retry(super().execute, *args)
+
+    def executemany(self, *args):
+        return self._retry(super().executemany, *args)
+
+    def commit(self):
+        # The write lock is already held: a busy commit only waits for readers
+        return self._retry(super().commit, in_transaction_ok=True)
+
+
+class ConnectionManager:
+    """
+    One tuned SQLite connection per thread (and per process, so it is safe
+    across gunicorn's fork), reused for the life of the thread.
+
+    Each connection runs in WAL mode with synchronous=NORMAL, a memory map
+    and a larger page cache, and keeps up to `statement_cache` prepared
+    statements.
+    """
+
+    def __init__(self, db_path, timeout=10.0, mmap_size=64 * 1024 * 1024,
+                 cache_size_kib=8192, statement_cache=256):
+        self.db_path = db_path
+        self.timeout = timeout
+        self.mmap_size = mmap_size
+        self.cache_size_kib = cache_size_kib
+        self.statement_cache = statement_cache
+        self.stats = ConnectionStats()
+        self._local = threading.local()
+
+    def connection(self):
+        started = time.perf_counter()
+        db = getattr(self._local, "db", None)
+        opened = 0
+        if db is None or self._local.pid != os.getpid():
+            db = self._open()
+            self._local.db = db
+            self._local.pid = os.getpid()
+            opened = 1
+        self.stats.add(
+            acquires=1, opens=opened,
+            acquire_seconds=time.perf_counter() - started,
+        )
+        return db
+
+    def _open(self):
+        db = sqlite3.connect(
+            self.db_path,
+            timeout=0,                  # TrackedConnection handles waiting
+            check_same_thread=False,
+            cached_statements=self.statement_cache,
+            factory=TrackedConnection,
+            # Implicit transactions start with BEGIN IMMEDIATE (see TrackedConnection)
+            isolation_level="IMMEDIATE",
+        )
+        db.lock_timeout = self.timeout
+        db.stats = self.stats
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        db.execute(f"PRAGMA cache_size=-{int(self.cache_size_kib)}")
+        db.execute("PRAGMA temp_store=MEMORY")
+        return db
+
+    def release(self):
+        """
+        End the current thread's transaction, if any; keep the connection.
+        """
+        db = getattr(self._local, "db", None)
+        if db is not None and self._local.pid == os.getpid() and db.in_transaction:
+            db.rollback()
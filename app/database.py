@@ -1,46 +0,0 @@
-import sqlite3
-from flask import g
-
-DB_NAME = "nvrwall.db"
-
-def get_db():
-    if "db" not in g:
-        g.db = sqlite3.connect(DB_NAME, detect_types=sqlite3.PARSE_DECLTYPES)
-        g.db.row_factory = sqlite3.Row
-    return g.db
-
-
-def close_db(e=None):
-    db = g.pop("db", None)
-    if db is not None:
-        db.close()
-
-
-def init_db(app):
-    app.teardown_appcontext(close_db)
-
-    # Create tables if missing
-    with app.app_context():
-        db = get_db()
-        db.executescript(
-            """
-            CREATE TABLE IF NOT EXISTS tokens (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                token TEXT UNIQUE NOT NULL,
-                description TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                revoked INTEGER DEFAULT 0
-            );
-
-            CREATE TABLE IF NOT EXISTS access_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                token_id INTEGER,
-                path TEXT,
-                ip TEXT,
-                user_agent TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(token_id) REFERENCES tokens(id)
-            );
-            """
-        )
-        db.commit()
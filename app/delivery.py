@@ -0,0 +1,116 @@
+import os
+from urllib.parse import quote
+
+from flask import Response, abort, current_app, request, send_from_directory
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+
+from .edge import OriginError, edge_segment_path
+
+
+# How .ts (and other non-playlist) files leave the app:
+# - "flask":      send_from_directory() (default)
+# - "sendfile":   open + fstat once and hand the file object to the server's
+#                 wsgi.file_wrapper (gunicorn turns that into os.sendfile)
+# - "x-accel":    empty response with X-Accel-Redirect; nginx sends the file
+# - "x-sendfile": empty response with X-Sendfile; Apache/lighttpd send it
+DELIVERY_MODES = ("flask", "sendfile", "x-accel", "x-sendfile")
+
+SEGMENT_MIMETYPES = {
+    ".ts": "video/mp2t",
+    ".m4s": "video/iso.segment",
+    ".mp4": "video/mp4",
+    ".aac": "audio/aac",
+}
+
+
+def segment_mimetype(filename):
+    return SEGMENT_MIMETYPES.get(
+        os.path.splitext(filename)[1].lower(), "application/octet-stream"
+    )
+
+
+def _cache_immutable(resp, public):
+    """
+    Segments never change once written: let clients (and, if `public`,
+    shared proxies) keep them.
+    """
+    resp.cache_control.no_cache = None
+    if public:
+        resp.cache_control.public = True
+    else:
+        resp.cache_control.private = True
+    resp.cache_control.max_age = current_app.config.get("HLS_SEGMENT_MAX_AGE", 86400)
+    resp.cache_control.immutable = True
+    return resp
+
+
+def send_segment(filename, public=True, directory=None, accel_prefix=None):
+    """
+    Return a response for a segment under HLS_DIR using HLS_SEGMENT_DELIVERY.
+
+    Access decisions are made by the caller; this only moves bytes. Pass
+    public=False for segments that required authorization. In the
+    flask/sendfile modes ETag/If-None-Match and Range are handled here; in
+    the offload modes the proxy does it. In edge mode the segment is
+    first fetched into the local cache (see app/edge.py).
+
+    `directory` / `accel_prefix` serve from somewhere other than HLS_DIR
+    (e.g. the recording archive).
+    """
+    hls_dir = directory or current_app.config["HLS_DIR"]
+    mode = current_app.config.get("HLS_SEGMENT_DELIVERY", "flask")
+
+    if directory is None:
+        try:
+            local = edge_segment_path(filename)
+        except OriginError:
+            abort(502, "origin unavailable")
+        if local is None:
+            abort(404)
+        if local:
+            # Edge mode: serve the local copy (x-accel: point the prefix there)
+            hls_dir = current_app.extensions["edge"].directory
+
+    if mode == "x-accel":
+        prefix = accel_prefix or current_app.config.get("HLS_ACCEL_PREFIX", "/_hls_internal/")
+        if safe_join(hls_dir, filename) is None:
+            abort(404)
+        resp = Response(mimetype=segment_mimetype(filename))
+        resp.headers["X-Accel-Redirect"] = prefix.rstrip("/") + "/" + quote(filename)
+        return _cache_immutable(resp, public)
+
+    full_path = safe_join(hls_dir, filename)
+    if full_path is None:
+        abort(404)
+
+    if mode == "x-sendfile":
+        if not os.path.isfile(full_path):
+            abort(404)
+        resp = Response(mimetype=segment_mimetype(filename))
+        resp.headers["X-Sendfile"] = os.path.abspath(full_path)
+        return _cache_immutable(resp, public)
+
+    if mode == "sendfile":
+        try:
+            f = open(full_path, "rb")
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            abort(404)
+        st = os.fstat(f.fileno())
+        resp = Response(
+            wrap_file(request.environ, f),
+            mimetype=segment_mimetype(filename),
+            direct_passthrough=True,
+        )
+        resp.content_length = st.st_size
+        resp.last_modified = st.st_mtime
+        resp.set_etag(f"{st.st_mtime_ns:x}-{st.st_size:x}")
+        _cache_immutable(resp, public)
+        return resp.make_conditional(
+            request, accept_ranges=True, complete_length=st.st_size
+        )
+
+    if not os.path.isfile(full_path):
+        abort(404)
+    resp = send_from_directory(hls_dir, filename, mimetype=segment_mimetype(filename))
+    return _cache_immutable(resp, public)
@@ -0,0 +1,399 @@
+import os
+import time
+import fcntl
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from email.utils import parsedate_to_datetime
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+from flask import current_app
+from werkzeug.security import safe_join
+
+from .playlists import Playlist
+from .signing import GRANT_COOKIE
+from .singleflight import SingleFlight
+
+
+log = logging.getLogger(__name__)
+
+# Cross-process fill locks: segment names are hashed onto this many files
+_LOCK_STRIPES = 64
+
+
+class OriginError(Exception):
+    pass
+
+
+def default_cache_dir():
+    return os.path.join(tempfile.gettempdir(), "nvrwall-edge")
+
+
+class Origin:
+    """
+    HTTP client for the upstream nvrwall's /hls/.
+
+    The edge is an ordinary viewer of the origin: playlists are fetched with
+    its own token (HLS_ORIGIN_TOKEN) and the grant cookie the origin hands
+    back is kept and sent with segment requests, so the origin renews it
+    as usual and never sees the edge's viewers.
+    """
+
+    def __init__(self, base_url, token, timeout=10):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+        self._grant = None
+        self._lock = threading.Lock()
+
+    def get(self, path, params=None, with_token=False, timeout=None):
+        """
+        (status, headers, body) of GET <origin>/hls/<path>; 401, 403 and 404
+        are returned, other failures raise OriginError.
+        """
+        params = dict(params or {})
+        if with_token and self.token:
+            params["token"] = self.token
+        url = f"{self.base_url}/hls/{path}"
+        if params:
+            url += "?" + urlencode(params)
+        headers = {"User-Agent": "nvrwall-edge"}
+        grant = self._grant
+        if grant:
+            headers["Cookie"] = f"{GRANT_COOKIE}={grant}"
+        try:
+            with urllib.request.urlopen(
+                urllib.request.Request(url, headers=headers),
+                timeout=timeout or self.timeout,
+            ) as resp:
+                body = resp.read()
+                status, resp_headers = resp.status, resp.headers
+        except urllib.error.HTTPError as exc:
+            if exc.code in (401, 403, 404):
+                return exc.code, exc.headers, b""
+            raise OriginError(f"{path}: origin returned {exc.code}")
+        except (OSError, ValueError) as exc:
+            raise OriginError(f"{path}: {exc}")
+
+        for value in resp_headers.get_all("Set-Cookie") or ():
+            cookie = SimpleCookie()
+            cookie.load(value)
+            if GRANT_COOKIE in cookie:
+                with self._lock:
+                    self._grant = cookie[GRANT_COOKIE].value
+        return status, resp_headers, body
+
+    def get_segment(self, filename):
+        status, _headers, body = self.get(filename)
+        if status == 403:
+            # No or expired grant: any playlist load with the token renews it
+            stream = filename.rsplit("_", 1)[0] if "_" in filename else filename.split(".")[0]
+            self.get(f"{stream}.m3u8", with_token=True)
+            status, _headers, body = self.get(filename)
+        if status == 404:
+            return None
+        if status != 200:
+            raise OriginError(f"{filename}: origin returned {status}")
+        return body
+
+    def forget_grant(self):
+        with self._lock:
+            self._grant = None
+
+
+class EdgePlaylistCache:
+    """
+    Drop-in for PlaylistCache that reads playlists from the origin.
+
+    - a playlist is refetched at most every `ttl` seconds, whatever the
+      number of viewers; concurrent refreshes share one request
+    - on origin errors the last copy keeps being served, for at most
+      `stale_max` seconds after it was fetched
+    - if the origin refuses the edge (401/403, e.g. HLS_ORIGIN_TOKEN was
+      revoked) the playlist is dropped at once: nothing is served that
+      the origin no longer allows
+    - blocking reloads (_HLS_msn) are forwarded: all viewers waiting for
+      the same segment/part share one held request to the origin
+    - wait_for_async() viewers await one future per segment/part on the
+      loop, so a held origin request takes one thread however many viewers
+      wait on it: at most one per (playlist, msn, part) being waited for
+    """
+
+    def __init__(self, origin, cache_dir, ttl=1.0, stale_max=30.0):
+        self.origin = origin
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.stale_max = stale_max
+        self._entries = {}      # name -> (Playlist, fetched_at)
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._async_flights = {}  # (loop, name, msn, part) -> future of wait_for()
+
+    def get(self, name):
+        cached = self._entries.get(name)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            cached[0].last_access = time.monotonic()
+            return cached[0]
+        try:
+            playlist, _shared = self._flight.do(name, lambda: self._fetch(name))
+        except OriginError as exc:
+            log.warning("edge: %s", exc)
+            if cached is None or time.monotonic() - cached[1] > self.stale_max:
+                self._drop(name)
+                return None
+            return cached[0]
+        return playlist
+
+    def wait_for(self, name, msn, part=None, timeout=None):
+        entry = self.get(name)
+        if entry is None or entry.has(msn, part):
+            return entry
+        if timeout == 0:
+            return None
+        params = {"_HLS_msn": msn}
+        if part is not None:
+            params["_HLS_part"] = part
+        try:
+            entry, _shared = self._flight.do(
+                (name, msn, part), lambda: self._fetch(name, params)
+            )
+        except OriginError as exc:
+            log.warning("edge: %s", exc)
+            return None
+        return entry if entry is not None and entry.has(msn, part) else None
+
+    async def wait_for_async(self, name, msn, part=None, timeout=None):
+        # The origin holds the request; this side only waits for its answer.
+        # Viewers of the same segment/part share the thread doing it.
+        loop = asyncio.get_running_loop()
+        key = (loop, name, msn, part)
+        fut = self._async_flights.get(key)
+        if fut is None:
+            fut = loop.run_in_executor(None, self.wait_for, name, msn, part, timeout)
+            self._async_flights[key] = fut
+            fut.add_done_callback(lambda _fut: self._async_flights.pop(key, None))
+        # One viewer leaving must not cancel the others' wait
+        return await asyncio.shield(fut)
+
+    def _fetch(self, name, params=None):
+        target = None
+        if params:
+            # The origin may hold the request up to 3 target durations
+            current = self._entries.get(name)
+            target = (current[0].target_duration if current else None) or 2
+        timeout = self.origin.timeout + 3 * target if target else None
+        status, headers, body = self.origin.get(name, params, with_token=True, timeout=timeout)
+        if status in (401, 403):
+            # Retry once without the grant, in case only the grant went bad
+            self.origin.forget_grant()
+            status, headers, body = self.origin.get(name, params, with_token=True, timeout=timeout)
+            if status in (401, 403):
+                log.error("edge: %s: origin refused the edge token (%s)", name, status)
+                self._drop(name)
+                return None
+        if status == 404:
+            self._drop(name)
+            return None
+        if status != 200:
+            raise OriginError(f"{name}: origin returned {status}")
+
+        modified = headers.get("Last-Modified")
+        try:
+            mtime = parsedate_to_datetime(modified).timestamp() if modified else time.time()
+        except (TypeError, ValueError):
+            mtime = time.time()
+        playlist = Playlist(name, os.path.join(self.cache_dir, name), body, mtime, len(body))
+        with self._lock:
+            current = self._entries.get(name)
+            # A slower plain refresh must not replace a newer blocking one
+            if current is None or playlist.last_msn >= current[0].last_msn:
+                self._entries[name] = (playlist, time.monotonic())
+            else:
+                playlist = current[0]
+        return playlist
+
+    def _drop(self, name):
+        with self._lock:
+            self._entries.pop(name, None)
+
+
+class SegmentCache:
+    """
+    Segments fetched from the origin, kept under `directory` and evicted
+    least-recently-used once they take more than `max_bytes`.
+
+    One upstream fetch per segment per host: misses in this process are
+    collapsed with SingleFlight, misses in other workers wait on a striped
+    flock and then find the file already there. Hits refresh the file's
+    mtime (at most once a minute), which is what eviction orders by.
+    """
+
+    def __init__(self, origin, directory, max_bytes):
+        self.origin = origin
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+        self._approx_bytes = None
+        self._scanned_at = float("-inf")
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.fetched_bytes = 0
+        self.evicted = 0
+
+    def path(self, filename):
+        """
+        Local path of segment `filename`, fetched if needed; None if the
+        origin doesn't have it. Raises OriginError.
+        """
+        local = safe_join(self.directory, filename)
+        if local is None:
+            return None
+        try:
+            st = os.stat(local)
+        except FileNotFoundError:
+            pass
+        else:
+            if time.time() - st.st_mtime > 60:
+                try:
+                    os.utime(local)
+                except OSError:
+                    pass
+            with self._lock:
+                self.hits += 1
+            return local
+
+        found, shared = self._flight.do(filename, lambda: self._fill(filename, local))
+        with self._lock:
+            if shared:
+                self.coalesced += 1
+        return found
+
+    def _fill(self, filename, local):
+        os.makedirs(os.path.join(self.directory, ".locks"), exist_ok=True)
+        stripe = int.from_bytes(hashlib.blake2b(filename.encode(), digest_size=2).digest(), "big")
+        lock_path = os.path.join(self.directory, ".locks", f"{stripe % _LOCK_STRIPES}.lock")
+        with open(lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(local):
+                # Another worker fetched it while we waited
+                with self._lock:
+                    self.coalesced += 1
+                return local
+            data = self.origin.get_segment(filename)
+            if data is None:
+                return None
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            tmp = f"{local}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, local)
+        with self._lock:
+            self.misses += 1
+            self.fetched_bytes += len(data)
+            if self._approx_bytes is not None:
+                self._approx_bytes += len(data)
+        self._maybe_evict()
+        return local
+
+    def _maybe_evict(self):
+        over = self._approx_bytes is None or self._approx_bytes > self.max_bytes
+        if not over and time.monotonic() - self._scanned_at < 10:
+            return
+        with open(os.path.join(self.directory, ".locks", "evict.lock"), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # another worker is evicting
+            files, total = self._scan()
+            if total > self.max_bytes:
+                files.sort()
+                target = self.max_bytes * 0.9
+                for _mtime, size, path in files:
+                    if total <= target:
+                        break
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        continue
+                    total -= size
+                    with self._lock:
+                        self.evicted += 1
+        with self._lock:
+            self._approx_bytes = total
+            self._scanned_at = time.monotonic()
+
+    def _scan(self):
+        files, total = [], 0
+        stack = [self.directory]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.name.startswith(".") or entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        return files, total
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "fetched_bytes": self.fetched_bytes,
+                "evicted": self.evicted,
+                "cached_bytes": self._approx_bytes,
+            }
+
+
+def init_app(app):
+    """
+    Edge mode (HLS_ORIGIN_URL set): playlists and segments come from the
+    origin instead of HLS_DIR. Call after the playlists init_app, whose
+    cache this replaces.
+    """
+    config = app.config
+    if not config.get("HLS_ORIGIN_URL"):
+        return
+    origin = Origin(
+        config["HLS_ORIGIN_URL"],
+        config.get("HLS_ORIGIN_TOKEN"),
+        timeout=config.get("HLS_ORIGIN_TIMEOUT", 10),
+    )
+    cache_dir = config.get("HLS_EDGE_CACHE_DIR") or default_cache_dir()
+    app.extensions["playlist_cache"] = EdgePlaylistCache(
+        origin, cache_dir,
+        ttl=config.get("HLS_EDGE_PLAYLIST_TTL", 1.0),
+        stale_max=config.get("HLS_EDGE_STALE_MAX", 30),
+    )
+    app.extensions["edge"] = SegmentCache(
+        origin, cache_dir, config.get("HLS_EDGE_CACHE_MAX_BYTES", 2 * 1024 ** 3),
+    )
+
+
+def edge_segment_path(filename):
+    """
+    In edge mode the local path of a cached segment (see SegmentCache.path),
+    else False.
+    """
+    cache = current_app.extensions.get("edge")
+    if cache is None:
+        return False
+    return cache.path(filename)
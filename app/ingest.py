@@ -0,0 +1,343 @@
+import os
+import time
+import fcntl
+import ctypes
+import ctypes.util
+import signal
+import logging
+import threading
+import subprocess
+
+
+log = logging.getLogger(__name__)
+
+PR_SET_PDEATHSIG = 1
+
+
+def _die_with_parent():
+    """
+    preexec_fn: SIGTERM the packager if the supervisor dies (strictly: when
+    the forking thread exits, which is the long-lived supervisor thread).
+    """
+    libc_name = ctypes.util.find_library("c")
+    if libc_name:
+        ctypes.CDLL(libc_name).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+
+
+class ChannelProcess:
+    """
+    One ffmpeg packager: source -> HLS_DIR/<name>.m3u8, copy mode (no
+    re-encode) unless `transcode` asks for a low tier
+    ({"height": 360, "bitrate": "400k"}).
+
+    Segments are numbered from the epoch (-hls_start_number_source epoch)
+    so names never repeat across restarts; they are immutable for caches.
+    """
+
+    def __init__(self, name, source, hls_dir, ffmpeg="ffmpeg",
+                 segment_seconds=2, list_size=6, cpu=None, transcode=None):
+        self.name = name
+        self.source = source
+        self.hls_dir = hls_dir
+        self.ffmpeg = ffmpeg
+        self.segment_seconds = segment_seconds
+        self.list_size = list_size
+        self.cpu = cpu
+        self.transcode = transcode
+
+        self.proc = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.failures = 0
+        self.next_start = 0.0
+        self._lock_fd = None
+
+    @property
+    def playlist_path(self):
+        return os.path.join(self.hls_dir, f"{self.name}.m3u8")
+
+    def command(self):
+        cmd = [self.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "warning"]
+        if self.source.startswith("rtsp://"):
+            cmd += ["-rtsp_transport", "tcp"]
+        elif self.source.endswith(".m3u8"):
+            # Another tier's live playlist (e.g. transcoding ch1-sub to ch1-low)
+            cmd += ["-live_start_index", "-1"]
+        elif "://" not in self.source:
+            # Local file standing in for a camera: play it in real time, forever
+            cmd += ["-re", "-stream_loop", "-1"]
+        cmd += ["-i", self.source, "-map", "0:v:0", "-an"]
+        if self.transcode:
+            bitrate = self.transcode.get("bitrate", "400k")
+            cmd += [
+                "-vf", f"scale=-2:{int(self.transcode.get('height', 360))}",
+                "-c:v", "libx264", "-preset", "veryfast", "-tune", "zerolatency",
+                "-b:v", bitrate, "-maxrate", bitrate, "-bufsize", bitrate,
+                # Keyframe at every segment boundary, like the copied tiers
+                "-force_key_frames", f"expr:gte(t,n_forced*{self.segment_seconds})",
+                "-sc_threshold", "0",
+            ]
+        else:
+            cmd += ["-c:v", "copy"]
+        cmd += [
+            "-f", "hls",
+            "-hls_time", str(self.segment_seconds),
+            "-hls_list_size", str(self.list_size),
+            "-hls_flags", "delete_segments+temp_file+independent_segments+program_date_time",
+            "-hls_start_number_source", "epoch",
+            "-hls_segment_filename", os.path.join(self.hls_dir, f"{self.name}_%d.ts"),
+            self.playlist_path,
+        ]
+        return cmd
+
+    # ---- ownership ------------------------------------------------------------
+    def acquire(self):
+        """
+        Take the per-channel lock file so only one process packages a
+        channel, however many supervisors run. Returns True if owned.
+        """
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(
+            os.path.join(self.hls_dir, f".{self.name}.lock"),
+            os.O_RDWR | os.O_CREAT | os.O_CLOEXEC,
+            0o644,
+        )
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def release(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    # ---- process --------------------------------------------------------------
+    def start(self):
+        cpu = self.cpu
+
+        def preexec():
+            _die_with_parent()
+            if cpu is not None and hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, {cpu})
+
+        self.proc = subprocess.Popen(
+            self.command(),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            preexec_fn=preexec,
+        )
+        self.started_at = time.monotonic()
+        log.info("ingest %s: started pid %d", self.name, self.proc.pid)
+
+    def running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def stop(self, timeout=5.0):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.proc = None
+
+    def playlist_age(self):
+        """
+        Seconds since the packager last rewrote the playlist (None if absent).
+        """
+        try:
+            return time.time() - os.stat(self.playlist_path).st_mtime
+        except FileNotFoundError:
+            return None
+
+
+class IngestSupervisor:
+    """
+    Keeps one packager per configured channel alive.
+
+    - crashed packagers are restarted with exponential backoff
+    - a packager whose playlist is older than `stale_after` is restarted
+    - segments the live playlist no longer references are removed once
+      older than `segment_retention`
+    - packagers are pinned round-robin to the CPUs this process may use
+    """
+
+    def __init__(self, channels, hls_dir, ffmpeg="ffmpeg", segment_seconds=2,
+                 list_size=6, stale_after=15, backoff_max=60,
+                 segment_retention=120, interval=1.0, cpus=None):
+        self.hls_dir = hls_dir
+        self.stale_after = stale_after
+        self.backoff_max = backoff_max
+        self.segment_retention = segment_retention
+        self.interval = interval
+
+        if cpus is None:
+            cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        self.channels = []
+        for i, (name, source) in enumerate(sorted(channels.items())):
+            cpu = cpus[i % len(cpus)] if cpus else None
+            transcode = None
+            if isinstance(source, dict):
+                # {"source": ..., "transcode": {...}} for a transcoded tier
+                source, transcode = source["source"], source.get("transcode")
+            self.channels.append(ChannelProcess(
+                name, source, hls_dir, ffmpeg=ffmpeg,
+                segment_seconds=segment_seconds, list_size=list_size, cpu=cpu,
+                transcode=transcode,
+            ))
+
+        self._stopping = threading.Event()
+        self._thread = None
+        self._last_cleanup = 0.0
+
+    # ---- lifecycle ------------------------------------------------------------
+    def start(self):
+        """
+        Run the supervisor loop in a background thread.
+        """
+        os.makedirs(self.hls_dir, exist_ok=True)
+        self._thread = threading.Thread(
+            target=self.run_forever, name="ingest-supervisor", daemon=True
+        )
+        self._thread.start()
+
+    def run_forever(self):
+        os.makedirs(self.hls_dir, exist_ok=True)
+        try:
+            while not self._stopping.is_set():
+                self.tick()
+                self._stopping.wait(self.interval)
+        finally:
+            for ch in self.channels:
+                ch.stop()
+                ch.release()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(10)
+
+    # ---- one pass -------------------------------------------------------------
+    def tick(self):
+        now = time.monotonic()
+        for ch in self.channels:
+            if not ch.acquire():
+                continue  # another process owns this channel
+
+            if ch.running():
+                uptime = now - ch.started_at
+                age = ch.playlist_age()
+                if uptime > self.stale_after and (age is None or age > self.stale_after):
+                    log.warning("ingest %s: playlist stale (%s s), restarting", ch.name, age)
+                    ch.stop()
+                    self._schedule_restart(ch, now)
+                elif uptime > 2 * self.stale_after:
+                    ch.failures = 0
+                continue
+
+            if ch.proc is not None:
+                log.warning("ingest %s: exited with %s", ch.name, ch.proc.returncode)
+                ch.proc = None
+                self._schedule_restart(ch, now)
+            if now >= ch.next_start:
+                try:
+                    ch.start()
+                except OSError as exc:
+                    log.error("ingest %s: cannot start packager: %s", ch.name, exc)
+                    self._schedule_restart(ch, now)
+
+        if now - self._last_cleanup >= self.segment_retention / 4:
+            self._last_cleanup = now
+            self.cleanup_segments()
+
+    def _schedule_restart(self, ch, now):
+        ch.failures += 1
+        ch.restarts += 1
+        delay = min(self.backoff_max, 2 ** (ch.failures - 1))
+        ch.next_start = now + delay
+
+    def cleanup_segments(self):
+        """
+        Remove segments of our channels that the live playlist no longer
+        lists and that are older than `segment_retention`.
+        """
+        now = time.time()
+        for ch in self.channels:
+            if ch._lock_fd is None:
+                continue
+            try:
+                with open(ch.playlist_path, "rb") as f:
+                    live = {
+                        line.strip().decode(errors="replace")
+                        for line in f
+                        if line.strip() and not line.startswith(b"#")
+                    }
+            except FileNotFoundError:
+                live = set()
+            prefix = f"{ch.name}_"
+            with os.scandir(self.hls_dir) as it:
+                for entry in it:
+                    if not entry.name.startswith(prefix) or entry.name in live:
+                        continue
+                    try:
+                        if now - entry.stat().st_mtime > self.segment_retention:
+                            os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+    def status(self):
+        return {
+            ch.name: {
+                "owned": ch._lock_fd is not None,
+                "running": ch.running(),
+                "pid": ch.proc.pid if ch.running() else None,
+                "restarts": ch.restarts,
+                "playlist_age": ch.playlist_age(),
+            }
+            for ch in self.channels
+        }
+
+
+def supervisor_from_config(config):
+    return IngestSupervisor(
+        config["INGEST_CHANNELS"],
+        config["HLS_DIR"],
+        ffmpeg=config.get("FFMPEG_BIN", "ffmpeg"),
+        segment_seconds=config.get("INGEST_SEGMENT_SECONDS", 2),
+        list_size=config.get("INGEST_LIST_SIZE", 6),
+        stale_after=config.get("INGEST_STALE_SECONDS", 15),
+        backoff_max=config.get("INGEST_BACKOFF_MAX", 60),
+        segment_retention=config.get("INGEST_SEGMENT_RETENTION", 120),
+    )
+
+
+def init_app(app):
+    """
+    With INGEST_AUTOSTART, every worker process runs a supervisor on its
+    first request; the per-channel lock files make exactly one of them
+    package each channel, and another takes over if that worker dies.
+    """
+    if not app.config.get("INGEST_AUTOSTART") or not app.config.get("INGEST_CHANNELS"):
+        return
+
+    state = {"pid": None}
+    lock = threading.Lock()
+
+    @app.before_request
+    def _ensure_ingest():
+        if state["pid"] == os.getpid():
+            return
+        with lock:
+            if state["pid"] != os.getpid():
+                supervisor = supervisor_from_config(app.config)
+                supervisor.start()
+                app.extensions["ingest"] = supervisor
+                state["pid"] = os.getpid()
@@ -0,0 +1,600 @@
+import os
+import json
+import time
+import fcntl
+import bisect
+import logging
+import threading
+
+from flask import current_app, request
+
+
+log = logging.getLogger(__name__)
+
+# Request latency buckets (seconds)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Routes whose response is an open-ended stream: latency is time to first byte
+STREAM_ROUTES = frozenset(("mjpeg", "mosaic"))
+
+ROUTE_KEY = "nvrwall.route"
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, counts=None, total=0.0, count=0):
+        self.counts = counts or [0] * (len(BUCKETS) + 1)
+        self.sum = total
+        self.count = count
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for i, n in enumerate(other["counts"]):
+            self.counts[i] += n
+        self.sum += other["sum"]
+        self.count += other["count"]
+
+    def to_json(self):
+        return {"counts": self.counts, "sum": self.sum, "count": self.count}
+
+
+class Registry:
+    """
+    This worker's metrics. Recording is a dict update under one lock.
+
+    A background thread per worker publishes the registry to
+    `<shared_dir>/metrics-<pid>.json` every `publish_interval` seconds, off
+    the request path; /metrics merges the files of all live workers, so a
+    scrape sees the whole host whichever worker answers.
+
+    When a worker dies its counters are folded into `metrics-retired.json`
+    so the merged `_total` series never go down.
+    """
+
+    RETIRED = "metrics-retired.json"
+
+    def __init__(self, shared_dir, publish_interval=1.0, viewer_window=10.0, extra_fn=None):
+        self.shared_dir = shared_dir
+        self.publish_interval = publish_interval
+        self.viewer_window = viewer_window
+        self.extra_fn = extra_fn
+        self._lock = threading.Lock()
+        self._publisher_pid = None
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        self.requests = {}      # (route, status) -> count
+        self.latency = {}       # route -> Histogram
+        self.bytes = {}         # route -> bytes sent
+        self.db = {}            # op -> Histogram
+        self.hls_clients = {}   # stream -> {client: last seen (wall clock)}
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        # A forked worker starts from zero instead of double-counting the parent
+        if self._pid != os.getpid():
+            self._reset()
+
+    # ---- recording ------------------------------------------------------------
+    def observe_request(self, route, status, seconds, nbytes):
+        with self._lock:
+            self._check_pid()
+            key = (route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            hist = self.latency.get(route)
+            if hist is None:
+                hist = self.latency[route] = Histogram()
+            hist.observe(seconds)
+            self.bytes[route] = self.bytes.get(route, 0) + nbytes
+
+    def observe_bytes(self, route, nbytes):
+        with self._lock:
+            self._check_pid()
+            self.bytes[route] = self.bytes.get(route, 0) + nbytes
+
+    def observe_db(self, op, seconds):
+        with self._lock:
+            self._check_pid()
+            hist = self.db.get(op)
+            if hist is None:
+                hist = self.db[op] = Histogram()
+            hist.observe(seconds)
+
+    def seen_hls_client(self, stream, client):
+        now = time.time()
+        with self._lock:
+            self._check_pid()
+            clients = self.hls_clients.get(stream)
+            if clients is None:
+                clients = self.hls_clients[stream] = {}
+            clients[client] = now
+
+    # ---- publishing -----------------------------------------------------------
+    def snapshot(self, extra=None):
+        cutoff = time.time() - self.viewer_window
+        with self._lock:
+            self._check_pid()
+            for stream, clients in list(self.hls_clients.items()):
+                for client, seen in list(clients.items()):
+                    if seen < cutoff:
+                        del clients[client]
+                if not clients:
+                    del self.hls_clients[stream]
+            snap = {
+                "requests": [[r, s, n] for (r, s), n in self.requests.items()],
+                "latency": {r: h.to_json() for r, h in self.latency.items()},
+                "bytes": dict(self.bytes),
+                "db": {op: h.to_json() for op, h in self.db.items()},
+                "hls_clients": {s: sorted(c) for s, c in self.hls_clients.items()},
+            }
+        snap.update(extra or {})
+        return snap
+
+    def start_publisher(self):
+        """
+        Start this worker's publisher thread unless it is running. Cheap
+        enough to call on every request; a forked worker gets its own.
+        """
+        pid = os.getpid()
+        if self._publisher_pid == pid:
+            return
+        with self._lock:
+            if self._publisher_pid == pid:
+                return
+            self._publisher_pid = pid
+        threading.Thread(target=self._publish_loop, name="metrics-publisher", daemon=True).start()
+
+    def _publish_loop(self):
+        pid = os.getpid()
+        while self._publisher_pid == pid:
+            time.sleep(self.publish_interval)
+            try:
+                self.publish(self.extra_fn() if self.extra_fn else None)
+            except Exception as exc:
+                log.warning("cannot publish metrics: %s", exc)
+
+    def publish(self, extra=None):
+        os.makedirs(self.shared_dir, exist_ok=True)
+        path = os.path.join(self.shared_dir, f"metrics-{os.getpid()}.json")
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.snapshot(extra), f)
+        os.replace(tmp, path)
+
+    def collect(self, extra=None):
+        """
+        Snapshots of every live worker on this host, this one fresh, plus
+        the retired totals of dead workers (marked "retired").
+        """
+        snaps = [self.snapshot(extra)]
+        me = f"metrics-{os.getpid()}.json"
+        try:
+            names = os.listdir(self.shared_dir)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if not (name.startswith("metrics-") and name.endswith(".json")) or name == me:
+                continue
+            path = os.path.join(self.shared_dir, name)
+            try:
+                pid = int(name[len("metrics-"):-len(".json")])
+                os.kill(pid, 0)
+            except ValueError:
+                continue
+            except ProcessLookupError:
+                self._retire(path)
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(path) as f:
+                    snaps.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        try:
+            with open(os.path.join(self.shared_dir, self.RETIRED)) as f:
+                snaps.append(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as exc:
+            log.warning("cannot read retired metrics: %s", exc)
+        return snaps
+
+    def _retire(self, path):
+        """
+        Fold a dead worker's counters into the retired totals and remove
+        its file. Under a lock so concurrent scrapes fold it only once.
+        """
+        retired = os.path.join(self.shared_dir, self.RETIRED)
+        with open(os.path.join(self.shared_dir, "metrics.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(path) as f:
+                    dead = json.load(f)
+            except FileNotFoundError:
+                return
+            except (OSError, ValueError):
+                dead = {}
+            try:
+                with open(retired) as f:
+                    totals = json.load(f)
+            except FileNotFoundError:
+                totals = {"retired": True}
+            except ValueError:
+                log.warning("discarding unreadable %s", retired)
+                totals = {"retired": True}
+            fold_counters(totals, dead)
+            tmp = f"{retired}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(totals, f)
+            os.replace(tmp, retired)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def fold_counters(totals, snap):
+    """
+    Add the counters of `snap` (not its gauges) into `totals`, in place.
+    """
+    requests = {(r, s): n for r, s, n in totals.get("requests", [])}
+    for route, status, n in snap.get("requests", []):
+        requests[(route, status)] = requests.get((route, status), 0) + n
+    totals["requests"] = [[r, s, n] for (r, s), n in requests.items()]
+    for key in ("latency", "db"):
+        hists = totals.setdefault(key, {})
+        for name, h in snap.get(key, {}).items():
+            merged = Histogram(**_hist_args(hists.get(name)))
+            merged.merge(h)
+            hists[name] = merged.to_json()
+    for key in ("bytes", "db_stats", "access_log"):
+        sums = totals.setdefault(key, {})
+        for name, value in snap.get(key, {}).items():
+            sums[name] = sums.get(name, 0) + value
+    return totals
+
+
+def _hist_args(h):
+    if h is None:
+        return {}
+    return {"counts": list(h["counts"]), "total": h["sum"], "count": h["count"]}
+
+
+class MetricsMiddleware:
+    """
+    Times every request from the WSGI call until its body is closed and
+    counts the bytes sent. The route label is set by an after_request hook.
+
+    A wsgi.file_wrapper body (sendfile) is passed through untouched so the
+    server can still use sendfile; such requests are recorded when the app
+    returns, with Content-Length as the byte count.
+    """
+
+    def __init__(self, wsgi_app, registry):
+        self.wsgi_app = wsgi_app
+        self.registry = registry
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        state = {"status": 0, "length": 0}
+
+        def _start_response(status, headers, exc_info=None):
+            state["status"] = int(status[:3])
+            for name, value in headers:
+                if name.lower() == "content-length":
+                    state["length"] = int(value)
+            return start_response(status, headers, exc_info)
+
+        body = self.wsgi_app(environ, _start_response)
+
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if isinstance(file_wrapper, type) and isinstance(body, file_wrapper):
+            self._record(environ, state["status"], time.perf_counter() - started, state["length"])
+            return body
+        return _Body(self, environ, body, state, started)
+
+    def _record(self, environ, status, seconds, nbytes):
+        route = environ.get(ROUTE_KEY, "unmatched")
+        self.registry.observe_request(route, status, seconds, nbytes)
+        self.registry.start_publisher()
+
+
+class _Body:
+    __slots__ = ("middleware", "environ", "body", "state", "started", "nbytes", "recorded")
+
+    def __init__(self, middleware, environ, body, state, started):
+        self.middleware = middleware
+        self.environ = environ
+        self.body = body
+        self.state = state
+        self.started = started
+        self.nbytes = 0
+        self.recorded = False
+
+    def __iter__(self):
+        streaming = self.environ.get(ROUTE_KEY) in STREAM_ROUTES
+        for chunk in self.body:
+            self.nbytes += len(chunk)
+            if streaming and not self.recorded:
+                self.recorded = True
+                self.middleware._record(
+                    self.environ, self.state["status"],
+                    time.perf_counter() - self.started, 0,
+                )
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            if not self.recorded:
+                self.recorded = True
+                self.middleware._record(
+                    self.environ, self.state["status"],
+                    time.perf_counter() - self.started, self.nbytes,
+                )
+            elif self.nbytes:
+                # Streams: latency was recorded at the first frame; bytes now
+                self.middleware.registry.observe_bytes(
+                    self.environ.get(ROUTE_KEY, "unmatched"), self.nbytes
+                )
+
+
+def route_label():
+    """
+    Metric label of the current request: the endpoint name, with /hls/
+    split into playlist and segment and all /admin pages as "admin".
+    """
+    endpoint = request.endpoint
+    if endpoint is None:
+        return "unmatched"
+    name = endpoint.rsplit(".", 1)[-1]
+    if name == "serve_hls":
+        filename = (request.view_args or {}).get("filename", "")
+        return "hls_playlist" if filename.endswith(".m3u8") else "hls_segment"
+    if name.startswith("admin_"):
+        return "admin"
+    return name
+
+
+# ---- exposition ---------------------------------------------------------------
+def _labels(**labels):
+    inner = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + inner + "}" if inner else ""
+
+
+def _histogram_lines(name, hists, label):
+    lines = []
+    for key in sorted(hists):
+        h = hists[key]
+        cumulative = 0
+        for bound, n in zip(BUCKETS, h.counts):
+            cumulative += n
+            lines.append(f"{name}_bucket{_labels(**{label: key}, le=repr(bound))} {cumulative}")
+        lines.append(f"{name}_bucket{_labels(**{label: key}, le='+Inf')} {h.count}")
+        lines.append(f"{name}_sum{_labels(**{label: key})} {h.sum:.6f}")
+        lines.append(f"{name}_count{_labels(**{label: key})} {h.count}")
+    return lines
+
+
+def render(snaps, gauges):
+    """
+    Prometheus text format (0.0.4) for merged worker snapshots plus
+    host-level `gauges`: [(name, help, type, [(labels dict, value)])].
+    """
+    requests, nbytes = {}, {}
+    latency, db = {}, {}
+    for snap in snaps:
+        for route, status, n in snap.get("requests", []):
+            requests[(route, status)] = requests.get((route, status), 0) + n
+        for route, n in snap.get("bytes", {}).items():
+            nbytes[route] = nbytes.get(route, 0) + n
+        for target, key in ((latency, "latency"), (db, "db")):
+            for name, h in snap.get(key, {}).items():
+                target.setdefault(name, Histogram()).merge(h)
+
+    out = [
+        "# HELP nvrwall_http_requests_total Requests by route and status.",
+        "# TYPE nvrwall_http_requests_total counter",
+    ]
+    for (route, status), n in sorted(requests.items()):
+        out.append(f"nvrwall_http_requests_total{_labels(route=route, status=status)} {n}")
+    out += [
+        "# HELP nvrwall_http_request_duration_seconds Time until the response is sent (streams: first frame).",
+        "# TYPE nvrwall_http_request_duration_seconds histogram",
+    ]
+    out += _histogram_lines("nvrwall_http_request_duration_seconds", latency, "route")
+    out += [
+        "# HELP nvrwall_http_response_bytes_total Response body bytes by route.",
+        "# TYPE nvrwall_http_response_bytes_total counter",
+    ]
+    for route, n in sorted(nbytes.items()):
+        out.append(f"nvrwall_http_response_bytes_total{_labels(route=route)} {n}")
+    out += [
+        "# HELP nvrwall_db_query_seconds SQLite time in token validation and access-log flushes.",
+        "# TYPE nvrwall_db_query_seconds histogram",
+    ]
+    out += _histogram_lines("nvrwall_db_query_seconds", db, "op")
+
+    for name, help_text, kind, samples in gauges:
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            out.append(f"{name}{_labels(**labels)} {value}")
+    return "\n".join(out) + "\n"
+
+
+def merged_hls_clients(snaps):
+    """
+    stream -> number of distinct HLS clients seen by any worker.
+    """
+    clients = {}
+    for snap in snaps:
+        for stream, keys in snap.get("hls_clients", {}).items():
+            clients.setdefault(stream, set()).update(keys)
+    return {stream: len(keys) for stream, keys in clients.items()}
+
+
+def init_app(app):
+    """
+    - request count/latency/bytes for every request (WSGI middleware)
+    - DB timings from tokens / the access-log writer
+    - published to the shared dir so any worker can answer /metrics
+    """
+    from .mjpeg import default_shared_dir
+
+    registry = Registry(
+        os.path.join(app.config.get("MJPEG_SHARED_DIR") or default_shared_dir(), "metrics"),
+        publish_interval=app.config.get("METRICS_PUBLISH_INTERVAL", 1.0),
+        viewer_window=app.config.get("METRICS_VIEWER_WINDOW", 10.0),
+        extra_fn=lambda: worker_extra(app),
+    )
+    app.extensions["metrics"] = registry
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app, registry)
+
+    writer = app.extensions.get("access_log")
+    if writer is not None:
+        writer.observe = lambda seconds: registry.observe_db("access_log_flush", seconds)
+
+    @app.after_request
+    def _label_route(resp):
+        request.environ[ROUTE_KEY] = route_label()
+        return resp
+
+
+def worker_extra(app):
+    """
+    Per-worker values that are only known in the worker: shared-feed
+    viewers, connection and access-log writer counters.
+    """
+    feeds = {}
+    mjpeg = app.extensions.get("mjpeg")
+    if mjpeg is not None:
+        for feed in mjpeg.feeds():
+            feeds[f"mjpeg:{feed.name}"] = feed.viewers
+    mosaic = app.extensions.get("mosaic")
+    if mosaic is not None:
+        for feed in mosaic.feeds():
+            feeds[f"mosaic:{feed.name}"] = feed.viewers
+    writer = app.extensions["access_log"]
+    return {
+        "feeds": feeds,
+        "db_stats": app.extensions["db"].stats.snapshot(),
+        "access_log": {
+            "written": writer.written,
+            "dropped": writer.dropped,
+            "coalesced": writer.coalesced,
+        },
+    }
+
+
+def observe_db(op, seconds):
+    registry = current_app.extensions.get("metrics")
+    if registry is not None:
+        registry.observe_db(op, seconds)
+
+
+def seen_hls_client(stream, token_id):
+    registry = current_app.extensions.get("metrics")
+    if registry is not None:
+        registry.seen_hls_client(stream, f"{token_id}@{request.remote_addr}")
+
+
+def _sum_extra(snaps, key):
+    totals = {}
+    for snap in snaps:
+        for name, value in snap.get(key, {}).items():
+            totals[name] = totals.get(name, 0) + value
+    return totals
+
+
+def exposition():
+    """
+    The /metrics body: all live workers merged, plus per-channel viewers
+    and segment age read from disk and motion-analysis lag read from the
+    DB at scrape time.
+    """
+    from .tokens import get_db
+    from .channels import get_catalog
+    from .playlists import get_playlist
+    from .snapshots import newest_segment
+
+    app = current_app._get_current_object()
+    snaps = app.extensions["metrics"].collect(worker_extra(app))
+    catalog = get_catalog()
+
+    viewers = {}
+    for stream, n in merged_hls_clients(snaps).items():
+        channel = catalog.streams.get(stream)
+        if channel is not None:
+            key = (channel.name, "hls")
+            viewers[key] = viewers.get(key, 0) + n
+    for feed, n in _sum_extra(snaps, "feeds").items():
+        kind, _, name = feed.partition(":")
+        if kind == "mosaic":
+            key = ("mosaic", "mosaic")
+        else:
+            channel = catalog.streams.get(name)
+            if channel is None:
+                continue
+            key = (channel.name, "mjpeg")
+        viewers[key] = viewers.get(key, 0) + n
+
+    now = time.time()
+    playlist_age, segment_age = [], []
+    for channel in catalog.enabled:
+        for tier, stream in channel.renditions:
+            playlist = get_playlist(f"{stream}.m3u8")
+            if playlist is None:
+                continue
+            labels = {"channel": channel.name, "stream": stream, "tier": tier}
+            playlist_age.append((labels, f"{now - playlist.mtime:.3f}"))
+            segment = newest_segment(playlist)
+            try:
+                segment_age.append((labels, f"{now - os.stat(segment).st_mtime:.3f}"))
+            except (TypeError, OSError):
+                continue
+
+    # Footage recorded but not yet analyzed, per channel (see app/motion.py)
+    motion_lag = [
+        ({"channel": r["channel"]}, f"{max(now - r['analyzed_ts'], 0):.3f}")
+        for r in get_db().execute("SELECT channel, analyzed_ts FROM motion_progress ORDER BY channel")
+    ]
+
+    db_stats = _sum_extra(snaps, "db_stats")
+    writer = _sum_extra(snaps, "access_log")
+    gauges = [
+        ("nvrwall_viewers", "Active viewers per channel and kind (hls: distinct clients in the last "
+         f"{app.extensions['metrics'].viewer_window:g}s).", "gauge",
+         [({"channel": c, "kind": k}, n) for (c, k), n in sorted(viewers.items())]),
+        ("nvrwall_playlist_age_seconds", "Seconds since the packager last wrote the playlist.",
+         "gauge", playlist_age),
+        ("nvrwall_segment_age_seconds", "Seconds since the newest listed segment was written.",
+         "gauge", segment_age),
+        ("nvrwall_motion_lag_seconds", "Seconds since the start of the last segment the motion "
+         "analyzer finished.", "gauge", motion_lag),
+        ("nvrwall_db_lock_waits_total", "Statements that hit SQLITE_BUSY at least once.",
+         "counter", [({}, db_stats.get("lock_waits", 0))]),
+        ("nvrwall_db_lock_wait_seconds_total", "Time spent waiting on SQLite locks.",
+         "counter", [({}, f"{db_stats.get('lock_wait_seconds', 0):.6f}")]),
+        ("nvrwall_db_lock_timeouts_total", "Statements that gave up waiting for a lock.",
+         "counter", [({}, db_stats.get("lock_timeouts", 0))]),
+        ("nvrwall_db_lock_conflicts_total", "Writes refused inside a stale read transaction.",
+         "counter", [({}, db_stats.get("lock_conflicts", 0))]),
+        ("nvrwall_access_log_records_total", "Access-log records by outcome.", "counter",
+         [({"outcome": k}, writer.get(k, 0)) for k in ("written", "dropped", "coalesced")]),
+        ("nvrwall_workers", "Workers whose metrics are included.", "gauge",
+         [({}, sum(1 for snap in snaps if not snap.get("retired")))]),
+    ]
+    return render(snaps, gauges)
@@ -0,0 +1,350 @@
+"""
+Versioned schema for nvrwall.db.
+
+The schema version is SQLite's `PRAGMA user_version`: migration N brings
+a database from version N-1 to N. `migrate()` applies the pending ones in
+a single IMMEDIATE transaction (concurrent callers wait, then find nothing
+left to do); `check()` is what workers run at startup, one header read.
+
+Databases created before versioning (user_version 0, tables present) are
+adopted: every migration up to the first versioned release only creates
+what is missing.
+
+To change the schema, append a migration; never edit a released one.
+"""
+import os
+import sqlite3
+
+
+class SchemaError(Exception):
+    pass
+
+
+# ---- migrations ---------------------------------------------------------------
+def _base(db):
+    """
+    Tokens, access logs, settings, channels and layouts.
+    """
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            token TEXT UNIQUE NOT NULL,
+            description TEXT,
+            created_at TEXT NOT NULL,
+            expires_at TEXT,
+            revoked INTEGER NOT NULL DEFAULT 0,
+            last_used_at TEXT
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS access_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            token_id INTEGER,
+            path TEXT,
+            ip TEXT,
+            user_agent TEXT,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY(token_id) REFERENCES tokens(id)
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        """
+    )
+    # Cameras and wall layouts (see app/channels.py)
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS channels (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            title TEXT,
+            main_stream TEXT NOT NULL,
+            sub_stream TEXT,
+            position INTEGER NOT NULL DEFAULT 0,
+            enabled INTEGER NOT NULL DEFAULT 1
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS layouts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            grid INTEGER NOT NULL
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS layout_tiles (
+            layout_id INTEGER NOT NULL,
+            slot INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            span INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (layout_id, slot),
+            FOREIGN KEY(layout_id) REFERENCES layouts(id),
+            FOREIGN KEY(channel_id) REFERENCES channels(id)
+        )
+        """
+    )
+
+
+def _access_log_indexes(db):
+    """
+    Access-log indexes, hourly rollups and the last_used_at backfill.
+
+    Rollups are maintained by app/retention.py.
+    """
+    # Per-token log lookups and time-range scans over access_logs
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_access_logs_token_created
+        ON access_logs (token_id, created_at)
+        """
+    )
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_access_logs_created
+        ON access_logs (created_at)
+        """
+    )
+    # last_used_at is the denormalized last access; backfill tokens that
+    # were only ever logged before it was maintained
+    db.execute(
+        """
+        UPDATE tokens
+        SET last_used_at = (
+            SELECT MAX(created_at) FROM access_logs al WHERE al.token_id = tokens.id
+        )
+        WHERE last_used_at IS NULL
+          AND EXISTS (SELECT 1 FROM access_logs al WHERE al.token_id = tokens.id)
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS access_log_hourly (
+            hour TEXT NOT NULL,
+            token_id INTEGER,
+            path TEXT,
+            hits INTEGER NOT NULL,
+            distinct_ips INTEGER NOT NULL,
+            PRIMARY KEY (hour, token_id, path)
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_access_log_hourly_token
+        ON access_log_hourly (token_id, hour)
+        """
+    )
+
+
+def _channel_low_stream(db):
+    """
+    Transcoded low tier: channels.low_stream.
+    """
+    columns = {r[1] for r in db.execute("PRAGMA table_info(channels)")}
+    if "low_stream" not in columns:
+        db.execute("ALTER TABLE channels ADD COLUMN low_stream TEXT")
+
+
+def _segments(db):
+    """
+    Recorded footage catalog (see app/recording.py).
+
+    path is relative to RECORD_DIR, start_ts in unix seconds.
+    """
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS segments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            start_ts REAL NOT NULL,
+            duration REAL NOT NULL,
+            size INTEGER NOT NULL,
+            path TEXT NOT NULL
+        )
+        """
+    )
+    # /vod/ range lookups per channel
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_segments_channel_start
+        ON segments (channel, start_ts)
+        """
+    )
+    # Quota purges, oldest first across channels
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_segments_start
+        ON segments (start_ts)
+        """
+    )
+
+
+def _motion(db):
+    """
+    Motion index over recorded footage (see app/motion.py).
+    """
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS motion_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            start_ts REAL NOT NULL,
+            end_ts REAL NOT NULL,
+            score REAL NOT NULL
+        )
+        """
+    )
+    # Searches per channel...
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_motion_events_channel_start
+        ON motion_events (channel, start_ts)
+        """
+    )
+    # ...and across channels
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_motion_events_start
+        ON motion_events (start_ts)
+        """
+    )
+    # Analyzer progress per channel, with the event still open
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS motion_progress (
+            channel TEXT PRIMARY KEY,
+            analyzed_ts REAL NOT NULL,
+            open_start REAL,
+            open_end REAL,
+            open_score REAL
+        )
+        """
+    )
+
+
+def _segment_tier(db):
+    """
+    Sub-stream footage: segments.tier, indexed with the channel.
+
+    The recorder also archives sub-streams (for the motion analyzer);
+    /vod/ only plays tier "main".
+    """
+    columns = {r[1] for r in db.execute("PRAGMA table_info(segments)")}
+    if "tier" not in columns:
+        db.execute("ALTER TABLE segments ADD COLUMN tier TEXT NOT NULL DEFAULT 'main'")
+    db.execute("DROP INDEX IF EXISTS idx_segments_channel_start")
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_segments_channel_tier_start
+        ON segments (channel, tier, start_ts)
+        """
+    )
+
+
+# Version N = MIGRATIONS[N - 1]; append only
+MIGRATIONS = [
+    _base,
+    _access_log_indexes,
+    _channel_low_stream,
+    _segments,
+    _motion,
+    _segment_tier,
+]
+
+LATEST = len(MIGRATIONS)
+
+
+# ---- applying -----------------------------------------------------------------
+def _connect(db_path):
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    # Autocommit mode: transactions below are explicit
+    return sqlite3.connect(db_path, timeout=30, isolation_level=None)
+
+
+def current_version(db_path):
+    """
+    Schema version of the database at `db_path` (0 if it doesn't exist).
+    """
+    if not os.path.exists(db_path):
+        return 0
+    db = sqlite3.connect(db_path, timeout=30)
+    try:
+        return db.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        db.close()
+
+
+def pending(version):
+    """
+    [(version, description)] of the migrations after `version`.
+    """
+    return [
+        (n, (fn.__doc__ or fn.__name__).strip().splitlines()[0].rstrip("."))
+        for n, fn in enumerate(MIGRATIONS, start=1)
+        if n > version
+    ]
+
+
+def migrate(db_path):
+    """
+    Bring `db_path` to LATEST; returns the versions applied. Raises
+    SchemaError if the database is newer than this code.
+    """
+    db = _connect(db_path)
+    try:
+        # WAL is persistent: set once here rather than per connection
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            if version > LATEST:
+                raise SchemaError(
+                    f"{db_path} is at schema version {version}, newer than this code ({LATEST})"
+                )
+            applied = []
+            for n in range(version + 1, LATEST + 1):
+                MIGRATIONS[n - 1](db)
+                applied.append(n)
+            if applied:
+                db.execute(f"PRAGMA user_version = {LATEST}")
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return applied
+    finally:
+        db.close()
+
+
+def check(db_path, migrate_if_behind=False):
+    """
+    Startup check: the schema must be at LATEST. When it is behind, either
+    migrate (`migrate_if_behind`) or raise SchemaError pointing at
+    migrate.py.
+    """
+    version = current_version(db_path)
+    if version == LATEST:
+        return
+    if version < LATEST and migrate_if_behind:
+        migrate(db_path)
+        return
+    if version > LATEST:
+        raise SchemaError(
+            f"{db_path} is at schema version {version}, newer than this code ({LATEST})"
+        )
+    raise SchemaError(
+        f"{db_path} is at schema version {version}, this code needs {LATEST}: "
+        "run `python migrate.py`"
+    )
@@ -0,0 +1,411 @@
+import abc
+import os
+import time
+import fcntl
+import asyncio
+import select
+import logging
+import tempfile
+import threading
+import subprocess
+
+from flask import current_app
+
+
+log = logging.getLogger(__name__)
+
+BOUNDARY = b"frame"
+MIMETYPE = "multipart/x-mixed-replace; boundary=frame"
+
+_SOI = b"\xff\xd8"
+_EOI = b"\xff\xd9"
+
+
+def default_shared_dir():
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(base, "nvrwall")
+
+
+class FrameBuffer:
+    """
+    Latest JPEG frame of a feed. Readers only ever see the newest frame, so a
+    slow client skips frames instead of queueing them.
+
+    Readers are threads (wait_newer) or asyncio tasks (wait_newer_async,
+    woken through their event loop; see app/asgi.py).
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._waiters = []      # (loop, future) of async readers
+        self.frame = None
+        self.seq = 0
+
+    def publish(self, frame):
+        with self._cond:
+            self.frame = frame
+            self.seq += 1
+            self._cond.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for loop, fut in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, fut)
+            except RuntimeError:
+                pass  # loop closed
+
+    def wait_newer(self, seq, timeout):
+        """
+        Return (frame, seq) newer than `seq`, or (None, seq) on timeout.
+        """
+        with self._cond:
+            if self._cond.wait_for(lambda: self.seq != seq, timeout):
+                return self.frame, self.seq
+            return None, seq
+
+    async def wait_newer_async(self, seq, timeout):
+        """
+        wait_newer() for a coroutine: waits on the event loop, not a thread.
+        """
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if self.seq != seq:
+                return self.frame, self.seq
+            fut = loop.create_future()
+            self._waiters.append((loop, fut))
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            return None, seq
+        with self._cond:
+            return self.frame, self.seq
+
+
+def _wake(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+
+def multipart(frame):
+    return (
+        b"--" + BOUNDARY + b"\r\n"
+        b"Content-Type: image/jpeg\r\n"
+        b"Content-Length: " + str(len(frame)).encode() + b"\r\n\r\n"
+        + frame + b"\r\n"
+    )
+
+
+class SharedFeed(abc.ABC):
+    """
+    One producer per feed per host, fanned out to any number of viewers.
+
+    Within a process, viewers read from a FrameBuffer. Across gunicorn
+    workers, the process holding `<shared_dir>/<name>.lock` runs the
+    producer and writes each frame to `<name>.jpg`; the others follow that
+    file and signal interest by touching `<name>.want`. If the owner goes
+    away another worker with viewers takes over.
+
+    Viewers whose feed has produced nothing for `stall_timeout` seconds
+    are let go (players reconnect), so a dead source never pins a worker
+    thread and a viewer count.
+
+    Subclasses implement frames(should_stop), a generator of JPEG bytes.
+    """
+
+    poll_interval = 5   # seconds between keepalive checks while no frame comes
+
+    def __init__(self, name, shared_dir, fps=5, idle_timeout=10, stall_timeout=30):
+        self.name = name
+        self.shared_dir = shared_dir
+        self.fps = fps
+        self.idle_timeout = idle_timeout
+        self.stall_timeout = stall_timeout
+        self.buffer = FrameBuffer()
+
+        self.viewers = 0
+        self._last_viewer = 0.0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._lock_fd = None
+        self._followed_mtime = None
+
+        self._frame_path = os.path.join(shared_dir, f"{name}.jpg")
+        self._want_path = os.path.join(shared_dir, f"{name}.want")
+
+    # ---- viewer side ----------------------------------------------------------
+    def attach(self):
+        with self._lock:
+            self.viewers += 1
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                os.makedirs(self.shared_dir, exist_ok=True)
+                self._thread = threading.Thread(
+                    target=self._run, name=f"feed-{self.name}", daemon=True
+                )
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def detach(self):
+        with self._lock:
+            self.viewers -= 1
+            self._last_viewer = time.monotonic()
+
+    def stream(self, keepalive=None):
+        """
+        Yield multipart/x-mixed-replace parts until the client goes away,
+        `keepalive()` returns False (checked after every frame and every
+        empty wait) or the feed stalls for `stall_timeout`.
+        """
+        self.attach()
+        try:
+            seq = 0
+            last_frame = time.monotonic()
+            while keepalive is None or keepalive():
+                frame, seq = self.buffer.wait_newer(seq, timeout=min(self.poll_interval, self.stall_timeout))
+                if frame is None:
+                    if time.monotonic() - last_frame >= self.stall_timeout:
+                        log.info("feed %s: no frame for %ss, dropping viewer", self.name, self.stall_timeout)
+                        return
+                    continue
+                last_frame = time.monotonic()
+                yield multipart(frame)
+        finally:
+            self.detach()
+
+    async def astream(self, keepalive=None):
+        """
+        stream() as an async generator; `keepalive` is a coroutine function.
+        """
+        self.attach()
+        try:
+            seq = 0
+            last_frame = time.monotonic()
+            while keepalive is None or await keepalive():
+                frame, seq = await self.buffer.wait_newer_async(seq, timeout=min(self.poll_interval, self.stall_timeout))
+                if frame is None:
+                    if time.monotonic() - last_frame >= self.stall_timeout:
+                        log.info("feed %s: no frame for %ss, dropping viewer", self.name, self.stall_timeout)
+                        return
+                    continue
+                last_frame = time.monotonic()
+                yield multipart(frame)
+        finally:
+            self.detach()
+
+    # ---- feed thread ----------------------------------------------------------
+    def _wanted(self):
+        """
+        True while this process has viewers (or had them recently), or
+        another worker has signalled interest recently.
+        """
+        now = time.monotonic()
+        if self.viewers > 0 or now - self._last_viewer < self.idle_timeout:
+            return True
+        try:
+            return time.time() - os.stat(self._want_path).st_mtime < self.idle_timeout
+        except FileNotFoundError:
+            return False
+
+    def _touch_want(self):
+        if self.viewers > 0:
+            with open(self._want_path, "a"):
+                pass
+            os.utime(self._want_path)
+
+    def _try_own(self):
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(
+            os.path.join(self.shared_dir, f"{self.name}.lock"),
+            os.O_RDWR | os.O_CREAT | os.O_CLOEXEC,
+            0o644,
+        )
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def _run(self):
+        try:
+            while True:
+                with self._lock:
+                    # Decide to exit under the lock so attach() either sees
+                    # this thread alive-and-staying or starts a new one
+                    if not self._wanted():
+                        self._exit()
+                        return
+                if self._try_own():
+                    self._produce()
+                else:
+                    self._follow()
+        except Exception:
+            log.exception("feed %s failed", self.name)
+            with self._lock:
+                self._exit()
+
+    def _exit(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        self._thread = None
+
+    def _produce(self):
+        tmp = f"{self._frame_path}.{os.getpid()}.tmp"
+
+        def should_stop():
+            return not self._wanted()
+
+        for frame in self.frames(should_stop):
+            self.buffer.publish(frame)
+            with open(tmp, "wb") as f:
+                f.write(frame)
+            os.replace(tmp, self._frame_path)
+            if should_stop():
+                return
+        # Producer ended (source gone); don't spin
+        time.sleep(1)
+
+    def _follow(self):
+        """
+        Mirror the owner's frame file into our buffer for ~1 second.
+        """
+        deadline = time.monotonic() + 1.0
+        while time.monotonic() < deadline:
+            self._touch_want()
+            try:
+                st = os.stat(self._frame_path)
+                if st.st_mtime_ns != self._followed_mtime:
+                    self._followed_mtime = st.st_mtime_ns
+                    with open(self._frame_path, "rb") as f:
+                        frame = f.read()
+                    if frame:
+                        self.buffer.publish(frame)
+            except FileNotFoundError:
+                pass
+            time.sleep(1.0 / self.fps)
+
+    @abc.abstractmethod
+    def frames(self, should_stop):
+        """
+        Generator of JPEG frames until should_stop() or the source ends.
+        """
+
+
+def read_jpegs(stream, should_stop, stall_timeout=10):
+    """
+    Split a concatenated MJPEG byte stream (ffmpeg -f mjpeg) into frames.
+    """
+    buf = b""
+    fd = stream.fileno()
+    while not should_stop():
+        ready, _, _ = select.select([fd], [], [], stall_timeout)
+        if not ready:
+            log.warning("mjpeg source stalled for %ss", stall_timeout)
+            return
+        chunk = os.read(fd, 256 * 1024)
+        if not chunk:
+            return
+        buf += chunk
+        while True:
+            start = buf.find(_SOI)
+            if start < 0:
+                buf = b""
+                break
+            end = buf.find(_EOI, start + 2)
+            if end < 0:
+                buf = buf[start:]
+                break
+            yield buf[start:end + 2]
+            buf = buf[end + 2:]
+
+
+class ChannelFeed(SharedFeed):
+    """
+    MJPEG feed of one channel: a single ffmpeg decodes the channel's live
+    HLS playlist and re-encodes it to JPEG at `fps` / `width`.
+    """
+
+    def __init__(self, name, playlist_path, shared_dir, ffmpeg="ffmpeg",
+                 fps=5, width=640, quality=7, idle_timeout=10, stall_timeout=30):
+        super().__init__(name, shared_dir, fps=fps, idle_timeout=idle_timeout,
+                         stall_timeout=stall_timeout)
+        self.playlist_path = playlist_path
+        self.ffmpeg = ffmpeg
+        self.width = width
+        self.quality = quality
+
+    def command(self):
+        return [
+            self.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error",
+            "-live_start_index", "-1",
+            "-i", self.playlist_path,
+            "-an",
+            "-vf", f"fps={self.fps},scale={self.width}:-2",
+            "-q:v", str(self.quality),
+            "-f", "mjpeg", "pipe:1",
+        ]
+
+    def frames(self, should_stop):
+        proc = subprocess.Popen(
+            self.command(),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+        )
+        try:
+            yield from read_jpegs(proc.stdout, should_stop)
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+
+class FeedRegistry:
+    """
+    Feeds by name, created on first use (one per process).
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._feeds = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        feed = self._feeds.get(name)
+        if feed is None:
+            with self._lock:
+                feed = self._feeds.get(name)
+                if feed is None:
+                    feed = self._feeds[name] = self._factory(name)
+        return feed
+
+    def feeds(self):
+        with self._lock:
+            return list(self._feeds.values())
+
+
+def init_app(app):
+    config = app.config
+
+    def make_feed(name):
+        return ChannelFeed(
+            name,
+            os.path.join(config["HLS_DIR"], f"{name}.m3u8"),
+            config.get("MJPEG_SHARED_DIR") or default_shared_dir(),
+            ffmpeg=config.get("FFMPEG_BIN", "ffmpeg"),
+            fps=config.get("MJPEG_FPS", 5),
+            width=config.get("MJPEG_WIDTH", 640),
+            quality=config.get("MJPEG_QUALITY", 7),
+            idle_timeout=config.get("MJPEG_IDLE_TIMEOUT", 10),
+            stall_timeout=config.get("MJPEG_STALL_TIMEOUT", 30),
+        )
+
+    app.extensions["mjpeg"] = FeedRegistry(make_feed)
+
+
+def get_feed(name):
+    return current_app.extensions["mjpeg"].get(name)
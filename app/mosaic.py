@@ -0,0 +1,223 @@
+import os
+import math
+import hashlib
+import time
+import threading
+import subprocess
+
+from flask import current_app
+
+try:
+    import numpy as np
+except ImportError:  # optional: only the mosaic needs it
+    np = None
+
+from .mjpeg import SharedFeed, FeedRegistry, read_jpegs, default_shared_dir
+from .channels import get_catalog
+
+
+def grid_for(count):
+    """
+    (cols, rows) of the smallest near-square grid holding `count` tiles.
+    """
+    cols = max(1, math.ceil(math.sqrt(count)))
+    rows = max(1, math.ceil(count / cols))
+    return cols, rows
+
+
+class _TileDecoder:
+    """
+    Decodes one channel to raw RGB frames already scaled to the tile size
+    and copies each into its slot of the shared mosaic.
+    """
+
+    def __init__(self, command, tile, lock):
+        self.command = command
+        self.tile = tile                # view into the mosaic array
+        self.lock = lock
+        h, w, _ = tile.shape
+        self.back = bytearray(w * h * 3)  # reused read buffer
+        self.back_view = np.frombuffer(self.back, dtype=np.uint8).reshape(h, w, 3)
+        self.proc = None
+
+    def run(self, should_stop):
+        while not should_stop():
+            self.proc = subprocess.Popen(
+                self.command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            )
+            try:
+                while not should_stop():
+                    if not self._read_frame():
+                        break
+                    with self.lock:
+                        np.copyto(self.tile, self.back_view)
+            finally:
+                self.stop()
+            if not should_stop():
+                time.sleep(1)  # source missing/ended; retry
+
+    def _read_frame(self):
+        view = memoryview(self.back)
+        got = 0
+        while got < len(self.back):
+            n = self.proc.stdout.readinto(view[got:])
+            if not n:
+                return False
+            got += n
+        return True
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+
+class MosaicFeed(SharedFeed):
+    """
+    One low-resolution grid of all channels, composited server-side and
+    encoded once for every mosaic viewer (shared like any SharedFeed).
+
+    Each channel is decoded straight to its tile size by ffmpeg; tiles are
+    written into one preallocated (H, W, 3) array with NumPy slice
+    assignment, and the compositor hands a reused copy of it to a single
+    JPEG encoder at `fps`.
+    """
+
+    def __init__(self, playlists, shared_dir, name="mosaic", ffmpeg="ffmpeg",
+                 width=1280, height=720, fps=5, quality=7, idle_timeout=10,
+                 stall_timeout=30):
+        super().__init__(name, shared_dir, fps=fps, idle_timeout=idle_timeout,
+                         stall_timeout=stall_timeout)
+        self.playlists = playlists
+        self.ffmpeg = ffmpeg
+        self.quality = quality
+        self.cols, self.rows = grid_for(len(playlists))
+        # even tile sizes keep ffmpeg's scaler happy
+        self.tile_w = (width // self.cols) & ~1
+        self.tile_h = (height // self.rows) & ~1
+        self.width = self.tile_w * self.cols
+        self.height = self.tile_h * self.rows
+
+    def decoder_command(self, playlist):
+        return [
+            self.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error",
+            "-live_start_index", "-1",
+            "-i", playlist,
+            "-an",
+            "-vf", f"fps={self.fps},scale={self.tile_w}:{self.tile_h}",
+            "-pix_fmt", "rgb24", "-f", "rawvideo", "pipe:1",
+        ]
+
+    def encoder_command(self):
+        return [
+            self.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "rgb24",
+            "-s", f"{self.width}x{self.height}", "-r", str(self.fps),
+            "-i", "pipe:0",
+            "-q:v", str(self.quality),
+            "-f", "mjpeg", "pipe:1",
+        ]
+
+    def frames(self, should_stop):
+        mosaic = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        out = np.empty_like(mosaic)
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def stopped():
+            return stop.is_set() or should_stop()
+
+        decoders = []
+        for i, playlist in enumerate(self.playlists):
+            row, col = divmod(i, self.cols)
+            y, x = row * self.tile_h, col * self.tile_w
+            tile = mosaic[y:y + self.tile_h, x:x + self.tile_w]
+            decoder = _TileDecoder(self.decoder_command(playlist), tile, lock)
+            decoders.append(decoder)
+            threading.Thread(
+                target=decoder.run, args=(stopped,), name=f"mosaic-tile-{i}", daemon=True
+            ).start()
+
+        encoder = subprocess.Popen(
+            self.encoder_command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        )
+
+        def compositor():
+            interval = 1.0 / self.fps
+            next_at = time.monotonic()
+            try:
+                while not stopped():
+                    with lock:
+                        np.copyto(out, mosaic)
+                    encoder.stdin.write(out.data)
+                    encoder.stdin.flush()
+                    next_at += interval
+                    time.sleep(max(0.0, next_at - time.monotonic()))
+            except (BrokenPipeError, ValueError):
+                pass
+            finally:
+                stop.set()
+
+        threading.Thread(target=compositor, name="mosaic-compositor", daemon=True).start()
+
+        try:
+            yield from read_jpegs(encoder.stdout, stopped)
+        finally:
+            stop.set()
+            for decoder in decoders:
+                decoder.stop()
+            encoder.terminate()
+            try:
+                encoder.wait(5)
+            except subprocess.TimeoutExpired:
+                encoder.kill()
+                encoder.wait()
+
+
+def init_app(app):
+    """
+    Without numpy there is no mosaic; the endpoint answers 503.
+    """
+    if np is None:
+        app.extensions["mosaic"] = None
+        return
+    config = app.config
+
+    def make_feed(playlists):
+        # Named after its channel set so every worker shares the same files
+        digest = hashlib.blake2b("|".join(playlists).encode(), digest_size=4).hexdigest()
+        return MosaicFeed(
+            list(playlists),
+            config.get("MJPEG_SHARED_DIR") or default_shared_dir(),
+            name=f"mosaic-{digest}",
+            ffmpeg=config.get("FFMPEG_BIN", "ffmpeg"),
+            width=config.get("MOSAIC_WIDTH", 1280),
+            height=config.get("MOSAIC_HEIGHT", 720),
+            fps=config.get("MOSAIC_FPS", 5),
+            quality=config.get("MJPEG_QUALITY", 7),
+            idle_timeout=config.get("MJPEG_IDLE_TIMEOUT", 10),
+            stall_timeout=config.get("MJPEG_STALL_TIMEOUT", 30),
+        )
+
+    app.extensions["mosaic"] = FeedRegistry(make_feed)
+
+
+def get_mosaic_feed():
+    """
+    The mosaic of the first 16 enabled channels (sub-streams where they
+    exist), or None without numpy. Editing the channels switches new
+    viewers to a new feed; the old one stops once idle.
+    """
+    registry = current_app.extensions.get("mosaic")
+    if registry is None:
+        return None
+    hls_dir = current_app.config["HLS_DIR"]
+    playlists = tuple(
+        os.path.join(hls_dir, f"{ch.stream(small=True)}.m3u8")
+        for ch in get_catalog().enabled[:16]
+    )
+    return registry.get(playlists)
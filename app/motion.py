@@ -0,0 +1,453 @@
+import os
+import time
+import fcntl
+import logging
+import threading
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import numpy as np
+except ImportError:  # optional: only motion analysis needs it
+    np = None
+
+
+log = logging.getLogger(__name__)
+
+
+# ---- analysis (runs in the pool processes) ------------------------------------
+def _lower_priority(niceness):
+    if niceness:
+        os.nice(niceness)  # inherited by the ffmpeg children
+
+
+def analyze_segment(command, width, height, pixel_delta, previous=None, timeout=30):
+    """
+    Motion scores of one segment: `command` decodes it to gray rawvideo
+    frames of `width` x `height`, each frame is compared to the one before
+    it (the first to `previous`, the last frame of the segment before).
+
+    Returns (scores, last frame bytes); a score is the fraction of pixels
+    whose luma changed by more than `pixel_delta`.
+    """
+    proc = subprocess.run(
+        command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL, timeout=timeout,
+    )
+    size = width * height
+    count = len(proc.stdout) // size
+    if not count:
+        return [], previous
+    frames = np.frombuffer(proc.stdout, dtype=np.uint8, count=count * size).reshape(count, height, width)
+    if previous is not None and len(previous) == size:
+        frames = np.concatenate([np.frombuffer(previous, dtype=np.uint8).reshape(1, height, width), frames])
+        scores = []
+    else:
+        scores = [0.0]  # nothing to compare the first frame with
+    # One pass over the whole stack: |frame[i+1] - frame[i]| > delta, averaged per frame
+    changed = np.abs(np.diff(frames.astype(np.int16), axis=0)) > pixel_delta
+    scores.extend(changed.mean(axis=(1, 2)).tolist())
+    return scores, frames[-1].tobytes()
+
+
+# ---- events -------------------------------------------------------------------
+class _Channel:
+    """
+    Analysis state of one channel: how far it got, the last frame seen and
+    the event still open.
+    """
+
+    def __init__(self, name, analyzed_ts, event=None):
+        self.name = name
+        self.analyzed_ts = analyzed_ts  # start_ts of the last analyzed segment
+        self.analyzed_to = analyzed_ts  # ... plus its duration
+        self.previous = None
+        self.event = event              # [start, end, score] or None
+        self.task = None
+        self.caught_up = False          # no cataloged segment left to analyze
+        self.tier = "main"              # archived tier decoded ("sub" when there is one)
+
+
+class MotionAnalyzer:
+    """
+    Indexes motion in the recorded footage: every segment cataloged by the
+    recorder is decoded at low resolution and frame rate (gray, scaled by
+    ffmpeg), frames are differenced with numpy and runs of frames scoring
+    at least `threshold` become rows of `motion_events` (channel, start_ts,
+    end_ts, score = peak fraction of changed pixels).
+
+    - channels with a sub-stream are analyzed from its archived copy
+      (`sub_streams`, see Recorder): the frames are scaled down to
+      `width` x `height` anyway, and decoding the sub-stream costs a
+      fraction of the main one
+
+    - decoding happens in a process pool of `workers` processes running at
+      `niceness`, one ffmpeg thread each: the analyzer uses at most that
+      many cores, at lower priority than the web workers
+    - a channel has at most one segment in flight (frames are compared
+      across segment boundaries); channels furthest behind go first
+    - motion less than `merge_gap` seconds apart is one event; events are
+      split at `max_event` seconds so range queries stay bounded
+    - progress and the open event are kept in `motion_progress`, so a
+      restart resumes where it stopped; new channels start `backfill`
+      seconds back
+    - one analyzer per archive: `<record_dir>/.motion.lock`
+
+    `connect` returns the analyzer thread's DB connection.
+    """
+
+    def __init__(self, connect, record_dir, channels=None, ffmpeg="ffmpeg", workers=2,
+                 niceness=10, width=160, height=90, fps=2, pixel_delta=25,
+                 threshold=0.01, merge_gap=5.0, max_event=300.0, backfill=3600,
+                 max_age_days=14, poll_interval=1.0, timeout=30, sub_streams=True):
+        self.connect = connect
+        self.record_dir = record_dir
+        self.channels = channels
+        self.sub_streams = sub_streams
+        self.ffmpeg = ffmpeg
+        self.workers = workers
+        self.niceness = niceness
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.pixel_delta = pixel_delta
+        self.threshold = threshold
+        self.merge_gap = merge_gap
+        self.max_event = max_event
+        self.backfill = backfill
+        self.max_age_days = max_age_days
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+        self._state = {}            # channel -> _Channel
+        self._pool = None
+        self._purged_at = float("-inf")
+        self._lock_fd = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self.analyzed = 0
+        self.analyzed_seconds = 0.0
+        self.events = 0
+        self.errors = 0
+
+    # ---- lifecycle ------------------------------------------------------------
+    def acquire(self):
+        if self._lock_fd is not None:
+            return True
+        os.makedirs(self.record_dir, exist_ok=True)
+        fd = os.open(os.path.join(self.record_dir, ".motion.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        # Whoever analyzed before may have moved on: re-read the progress
+        self._state.clear()
+        return True
+
+    def release(self):
+        self._shutdown_pool()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run_forever, name="motion", daemon=True)
+        self._thread.start()
+
+    def run_forever(self):
+        db = self.connect()
+        while not self._stopping.is_set():
+            if self.acquire():
+                try:
+                    if self.tick(db):
+                        continue  # already waited on the pool
+                except BrokenProcessPool:
+                    self.errors += 1
+                    log.warning("motion: analysis pool died; restarting it")
+                    self._shutdown_pool()
+                except Exception:
+                    self.errors += 1
+                    log.exception("motion tick failed")
+            self._stopping.wait(self.poll_interval)
+        self.release()
+
+    def stop(self):
+        self._stopping.set()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            # spawn: the analyzer thread lives in a threaded web worker
+            self._pool = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_lower_priority,
+                initargs=(self.niceness,),
+            )
+        return self._pool
+
+    def _shutdown_pool(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        for state in self._state.values():
+            state.task = None
+
+    # ---- one pass -------------------------------------------------------------
+    def tick(self, db, now=None):
+        """
+        Schedule the next segment of idle channels, then wait up to
+        poll_interval for results and store them. Returns whether anything
+        was in flight (i.e. the pass already waited).
+        """
+        now = now or time.time()
+        self._schedule(db, now)
+        pending = {s.task[1]: s for s in self._state.values() if s.task is not None}
+        if not pending:
+            self._purge(db, now)
+            return False
+        done, _ = wait(pending, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+        for future in done:
+            self._finish(db, pending[future], future)
+        self._purge(db, now)
+        return True
+
+    def _channels(self, db, now):
+        rows = [
+            r for r in db.execute(
+                "SELECT name, sub_stream FROM channels WHERE enabled = 1 ORDER BY position, name"
+            )
+            if self.channels is None or r["name"] in self.channels
+        ]
+        names = [r["name"] for r in rows]
+        # Channels disabled, deleted or no longer selected: forget them once
+        # their segment in flight (if any) is done
+        for name in set(self._state) - set(names):
+            if self._state[name].task is None:
+                del self._state[name]
+        missing = [name for name in names if name not in self._state]
+        if missing:
+            stored = {
+                r["channel"]: r for r in db.execute(
+                    f"SELECT * FROM motion_progress WHERE channel IN ({','.join('?' * len(missing))})",
+                    missing,
+                )
+            }
+            for name in missing:
+                row = stored.get(name)
+                if row is None:
+                    self._state[name] = _Channel(name, now - self.backfill)
+                else:
+                    event = None
+                    if row["open_start"] is not None:
+                        event = [row["open_start"], row["open_end"], row["open_score"]]
+                    self._state[name] = _Channel(name, row["analyzed_ts"], event)
+        for r in rows:
+            state = self._state[r["name"]]
+            tier = "sub" if self.sub_streams and r["sub_stream"] else "main"
+            if state.tier != tier and state.task is None:
+                # Frames of the other tier are not comparable
+                state.tier = tier
+                state.previous = None
+        return [self._state[name] for name in names]
+
+    def _schedule(self, db, now):
+        idle = [s for s in self._channels(db, now) if s.task is None]
+        busy = sum(s.task is not None for s in self._state.values())
+        # Keep every pool process fed, with one queued job each
+        for state in sorted(idle, key=lambda s: s.analyzed_to):
+            if busy >= self.workers * 2:
+                break
+            row = db.execute(
+                """
+                SELECT start_ts, duration, path FROM segments
+                WHERE channel = ? AND tier = ? AND start_ts > ?
+                ORDER BY start_ts
+                LIMIT 1
+                """,
+                (state.name, state.tier, state.analyzed_ts),
+            ).fetchone()
+            state.caught_up = row is None
+            if row is None:
+                continue
+            future = self.pool.submit(
+                analyze_segment, self.command(os.path.join(self.record_dir, row["path"])),
+                self.width, self.height, self.pixel_delta, state.previous, self.timeout,
+            )
+            state.task = (row, future)
+            busy += 1
+
+    def command(self, path):
+        return [
+            self.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error",
+            "-threads", "1", "-skip_frame", "nonref", "-i", path, "-an",
+            "-vf", f"fps={self.fps},scale={self.width}:{self.height}:flags=area,format=gray",
+            "-f", "rawvideo", "pipe:1",
+        ]
+
+    def _finish(self, db, state, future):
+        segment, _ = state.task
+        state.task = None
+        try:
+            scores, state.previous = future.result()
+        except BrokenProcessPool:
+            raise
+        except Exception as exc:
+            # Unreadable or purged segment: count it and move past it
+            self.errors += 1
+            log.warning("motion: %s: %s", segment["path"], exc)
+            scores, state.previous = [], None
+
+        closed = self._track(state, segment, scores)
+        with db:
+            if closed:
+                db.executemany(
+                    "INSERT INTO motion_events (channel, start_ts, end_ts, score) VALUES (?, ?, ?, ?)",
+                    [(state.name, *event) for event in closed],
+                )
+            event = state.event or (None, None, None)
+            db.execute(
+                """
+                INSERT INTO motion_progress (channel, analyzed_ts, open_start, open_end, open_score)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(channel) DO UPDATE SET
+                    analyzed_ts = excluded.analyzed_ts,
+                    open_start = excluded.open_start,
+                    open_end = excluded.open_end,
+                    open_score = excluded.open_score
+                """,
+                (state.name, segment["start_ts"], *event),
+            )
+        state.analyzed_ts = segment["start_ts"]
+        state.analyzed_to = segment["start_ts"] + segment["duration"]
+        self.analyzed += 1
+        self.analyzed_seconds += segment["duration"]
+        self.events += len(closed)
+
+    def _track(self, state, segment, scores):
+        """
+        Fold one segment's frame scores into the channel's open event;
+        returns the events that closed.
+        """
+        closed = []
+        step = 1.0 / self.fps
+        event = state.event
+        for i, score in enumerate(scores):
+            if score < self.threshold:
+                continue
+            at = segment["start_ts"] + i * step
+            if event is not None and at - event[1] <= self.merge_gap and at - event[0] < self.max_event:
+                event[1] = at + step
+                event[2] = max(event[2], score)
+            else:
+                if event is not None:
+                    closed.append(tuple(event))
+                event = [at, at + step, score]
+        if event is not None and segment["start_ts"] + segment["duration"] - event[1] > self.merge_gap:
+            closed.append(tuple(event))
+            event = None
+        state.event = event
+        return closed
+
+    def _purge(self, db, now):
+        # Events outlive their footage only as long as the recorder keeps it
+        if not self.max_age_days or now - self._purged_at < 60:
+            return
+        self._purged_at = now
+        with db:
+            db.execute(
+                "DELETE FROM motion_events WHERE start_ts < ?",
+                (now - self.max_age_days * 86400,),
+            )
+
+    def status(self, now=None):
+        now = now or time.time()
+        behind = [now - s.analyzed_to for s in self._state.values() if not s.caught_up]
+        return {
+            "owned": self._lock_fd is not None,
+            "analyzed": self.analyzed,
+            "analyzed_seconds": round(self.analyzed_seconds, 1),
+            "events": self.events,
+            "errors": self.errors,
+            # Footage waiting to be analyzed, for the channel furthest behind
+            "lag_seconds": round(max(behind), 1) if behind else 0.0,
+        }
+
+
+def analyzer_from_config(config, connect):
+    return MotionAnalyzer(
+        connect,
+        config["RECORD_DIR"],
+        channels=config.get("MOTION_CHANNELS") or config.get("RECORD_CHANNELS"),
+        ffmpeg=config.get("FFMPEG_BIN", "ffmpeg"),
+        workers=config.get("MOTION_WORKERS", 2),
+        niceness=config.get("MOTION_NICE", 10),
+        width=config.get("MOTION_WIDTH", 160),
+        height=config.get("MOTION_HEIGHT", 90),
+        fps=config.get("MOTION_FPS", 2),
+        pixel_delta=config.get("MOTION_PIXEL_DELTA", 25),
+        threshold=config.get("MOTION_THRESHOLD", 0.01),
+        merge_gap=config.get("MOTION_MERGE_GAP", 5.0),
+        max_event=config.get("MOTION_MAX_EVENT_SECONDS", 300),
+        backfill=config.get("MOTION_BACKFILL_SECONDS", 3600),
+        max_age_days=config.get("RECORD_MAX_AGE_DAYS", 14),
+        sub_streams=config.get("RECORD_SUB_STREAMS", True),
+    )
+
+
+def init_app(app):
+    """
+    With MOTION_AUTOSTART, every worker runs an analyzer on its first
+    request; the lock file makes exactly one of them analyze. Needs
+    RECORD_DIR and numpy.
+    """
+    if not app.config.get("MOTION_AUTOSTART") or not app.config.get("RECORD_DIR"):
+        return
+    if np is None:
+        log.warning("MOTION_AUTOSTART is set but numpy is not installed; no motion analysis")
+        return
+
+    state = {"pid": None}
+    lock = threading.Lock()
+
+    @app.before_request
+    def _ensure_analyzer():
+        if state["pid"] == os.getpid():
+            return
+        with lock:
+            if state["pid"] != os.getpid():
+                analyzer = analyzer_from_config(app.config, app.extensions["db"].connection)
+                analyzer.start()
+                app.extensions["motion"] = analyzer
+                state["pid"] = os.getpid()
+
+
+# ---- search -------------------------------------------------------------------
+def find_events(db, start, end, channels=None, min_score=0.0, limit=500, max_event=300):
+    """
+    Motion events overlapping [start, end), oldest first, for `channels`
+    (None = all).
+
+    Events are never longer than `max_event` seconds, so overlapping ones
+    start in [start - max_event, end): one range scan per channel on
+    (channel, start_ts), or on (start_ts) across channels.
+    """
+    where = "start_ts >= ? AND start_ts < ? AND end_ts > ? AND score >= ?"
+    params = [start - max_event, end, start, min_score]
+    if channels:
+        where = f"channel IN ({','.join('?' * len(channels))}) AND {where}"
+        params[:0] = channels
+    return db.execute(
+        f"""
+        SELECT channel, start_ts, end_ts, score FROM motion_events
+        WHERE {where}
+        ORDER BY start_ts
+        LIMIT ?
+        """,
+        (*params, limit),
+    ).fetchall()
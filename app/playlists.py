@@ -0,0 +1,505 @@
+import os
+import re
+import time
+import asyncio
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import threading
+
+from flask import current_app
+from werkzeug.security import safe_join
+
+
+log = logging.getLogger(__name__)
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_DELETE_SELF
+_EVENT = struct.Struct("iIII")
+_TARGET_DURATION = re.compile(rb"^#EXT-X-TARGETDURATION:(\d+)", re.MULTILINE)
+_MEDIA_SEQUENCE = re.compile(rb"^#EXT-X-MEDIA-SEQUENCE:(\d+)", re.MULTILINE)
+_SERVER_CONTROL = b"#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES"
+_EXTINF = re.compile(rb"^#EXTINF:([0-9.]+)")
+
+
+class Playlist:
+    """
+    Current bytes of one playlist plus the validators to serve it with.
+    """
+
+    __slots__ = ("name", "path", "data", "mtime", "size", "etag",
+                 "target_duration", "last_msn", "pending_parts",
+                 "watched", "last_access", "_bandwidth")
+
+    def __init__(self, name, path, data, mtime, size, can_block_reload=False):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+
+        m = _TARGET_DURATION.search(data)
+        self.target_duration = int(m.group(1)) if m else None
+        if can_block_reload and m and b"#EXT-X-SERVER-CONTROL" not in data:
+            # Advertise LL-HLS blocking reload right after the target duration
+            end = data.find(b"\n", m.end())
+            end = len(data) if end < 0 else end + 1
+            data = data[:end] + _SERVER_CONTROL + b"\n" + data[end:]
+        self.data = data
+        self.etag = hashlib.blake2b(data, digest_size=8).hexdigest()
+
+        # Media sequence number of the last complete segment, and how many
+        # parts of the following (in-progress) segment are already listed
+        m = _MEDIA_SEQUENCE.search(data)
+        first_msn = int(m.group(1)) if m else 0
+        segments = 0
+        parts = 0
+        for line in data.splitlines():
+            if line.startswith(b"#EXTINF"):
+                segments += 1
+                parts = 0
+            elif line.startswith(b"#EXT-X-PART:"):
+                parts += 1
+        self.last_msn = first_msn + segments - 1
+        self.pending_parts = parts
+
+        self.watched = False
+        self.last_access = time.monotonic()
+        self._bandwidth = None
+
+    def has(self, msn, part=None):
+        """
+        True if segment `msn` (or part `part` of it) is in this playlist.
+        """
+        if msn <= self.last_msn:
+            return True
+        return part is not None and msn == self.last_msn + 1 and part < self.pending_parts
+
+    @property
+    def max_age(self):
+        """
+        Cache lifetime for this playlist: half the target duration, >= 1s.
+        """
+        return max(1, (self.target_duration or 2) // 2)
+
+    def bandwidth(self):
+        """
+        (peak, average) bits/s of the listed segments, from their sizes on
+        disk; None if none could be measured. Computed once per reload.
+        """
+        if self._bandwidth is None:
+            directory = os.path.dirname(self.path)
+            peak = total_bits = total_seconds = 0
+            duration = None
+            for line in self.data.splitlines():
+                m = _EXTINF.match(line)
+                if m:
+                    duration = float(m.group(1))
+                    continue
+                if duration is None or not line or line.startswith(b"#"):
+                    continue
+                try:
+                    bits = os.stat(os.path.join(directory, os.fsdecode(line.strip()))).st_size * 8
+                except OSError:
+                    bits = None
+                if bits is not None and duration > 0:
+                    peak = max(peak, bits / duration)
+                    total_bits += bits
+                    total_seconds += duration
+                duration = None
+            self._bandwidth = (int(peak), int(total_bits / total_seconds)) if total_seconds else ()
+        return self._bandwidth or None
+
+
+class _Inotify:
+    """
+    Minimal ctypes binding for inotify; raises OSError if unavailable.
+    """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError(errno.ENOSYS, "libc not found")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify not supported")
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {path}")
+        return wd
+
+    def read_events(self, timeout):
+        """
+        Yield (wd, mask, name) for pending events, waiting up to `timeout`.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _cookie, length = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            name = buf[offset:offset + length].rstrip(b"\0")
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PlaylistCache:
+    """
+    In-memory cache of .m3u8 files under `root`.
+
+    - a playlist is read from disk on first request and kept in memory
+    - directories holding cached playlists are watched with inotify; when
+      the packager rewrites a file it is re-read once, in the watcher thread
+    - without inotify (or if a watch can't be added) entries are re-stat'ed
+      every `poll_interval` seconds instead
+    - entries not requested for `idle_timeout` seconds are dropped
+    - wait_for() blocks until a playlist contains a given media sequence
+      number; all waiters of one playlist share a single Condition that
+      the reload notifies (LL-HLS blocking playlist reload);
+      wait_for_async() is the same for asyncio tasks (app/asgi.py)
+    """
+
+    def __init__(self, root, poll_interval=0.5, idle_timeout=60,
+                 use_inotify=True, can_block_reload=False):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.use_inotify = use_inotify
+        self.can_block_reload = can_block_reload
+
+        self._lock = threading.Lock()
+        self._entries = {}      # name -> Playlist
+        self._changed = {}      # name -> Condition, notified on every reload
+        self._async_waiters = {}  # name -> [(loop, future)], woken on reload
+        self._by_path = {}      # abs path -> name
+        self._watches = {}      # dir -> wd
+        self._wd_dirs = {}      # wd -> dir
+        self._inotify = None
+        self._pid = None
+        self._stopping = threading.Event()
+
+    # ---- public API -----------------------------------------------------------
+    def get(self, name):
+        """
+        Return the Playlist for `name` (relative to root) or None if missing.
+        """
+        if self._pid != os.getpid():
+            self.start()
+
+        entry = self._entries.get(name)
+        if entry is not None:
+            entry.last_access = time.monotonic()
+            return entry
+
+        path = safe_join(self.root, name)
+        if path is None:
+            return None
+        # Watch before reading so a rewrite in between is not missed
+        watched = self._watch_dir(os.path.dirname(path))
+        entry = self._load(name, path)
+        if entry is None:
+            return None
+        entry.watched = watched
+
+        with self._lock:
+            self._entries[name] = entry
+            self._by_path[path] = name
+        return entry
+
+    def wait_for(self, name, msn, part=None, timeout=None):
+        """
+        Return the Playlist for `name` once it contains segment `msn`
+        (part `part`), or None if it is missing or `timeout` expires.
+        """
+        entry = self.get(name)
+        if entry is None or entry.has(msn, part):
+            return entry
+
+        if timeout is None:
+            timeout = 3 * (entry.target_duration or 2)
+        deadline = time.monotonic() + timeout
+        cond = self._condition(name)
+        with cond:
+            while True:
+                entry = self.get(name)
+                if entry is None or entry.has(msn, part):
+                    return entry
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                cond.wait(remaining)
+
+    async def wait_for_async(self, name, msn, part=None, timeout=None):
+        """
+        wait_for() for a coroutine: waits on the event loop, not a thread.
+        """
+        entry = self.get(name)
+        if entry is None or entry.has(msn, part):
+            return entry
+
+        if timeout is None:
+            timeout = 3 * (entry.target_duration or 2)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            fut = loop.create_future()
+            waiter = (loop, fut)
+            with self._lock:
+                self._async_waiters.setdefault(name, []).append(waiter)
+            try:
+                # Registered before re-checking, so a reload in between wakes us
+                entry = self.get(name)
+                if entry is None or entry.has(msn, part):
+                    return entry
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                try:
+                    await asyncio.wait_for(fut, remaining)
+                except asyncio.TimeoutError:
+                    return None
+            finally:
+                self._drop_waiter(name, waiter)
+
+    def _drop_waiter(self, name, waiter):
+        # A waiter that returned without being woken must not pile up
+        # under `name` until the next reload (or forever, if none comes)
+        with self._lock:
+            waiters = self._async_waiters.get(name)
+            if waiters is None:
+                return
+            try:
+                waiters.remove(waiter)
+            except ValueError:
+                return  # already popped by _notify
+            if not waiters:
+                del self._async_waiters[name]
+
+    def _condition(self, name):
+        cond = self._changed.get(name)
+        if cond is None:
+            with self._lock:
+                cond = self._changed.setdefault(name, threading.Condition())
+        return cond
+
+    def _notify(self, name):
+        cond = self._changed.get(name)
+        if cond is not None:
+            with cond:
+                cond.notify_all()
+        if self._async_waiters.get(name):
+            with self._lock:
+                waiters = self._async_waiters.pop(name, ())
+            for loop, fut in waiters:
+                try:
+                    loop.call_soon_threadsafe(_wake, fut)
+                except RuntimeError:
+                    pass  # loop closed
+
+    def start(self):
+        """
+        Start the watcher/poller threads for this process (fork-safe).
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._entries.clear()
+            self._changed.clear()
+            self._async_waiters.clear()
+            self._by_path.clear()
+            self._watches.clear()
+            self._wd_dirs.clear()
+            self._stopping = threading.Event()
+            self._inotify = None
+            if self.use_inotify:
+                try:
+                    self._inotify = _Inotify()
+                except OSError as exc:
+                    log.warning("inotify unavailable (%s); polling playlists", exc)
+
+            if self._inotify is not None:
+                threading.Thread(
+                    target=self._watch_loop, name="playlist-inotify", daemon=True
+                ).start()
+            threading.Thread(
+                target=self._poll_loop, name="playlist-poll", daemon=True
+            ).start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        self._stopping.set()
+
+    # ---- loading --------------------------------------------------------------
+    def _load(self, name, path):
+        try:
+            with open(path, "rb") as f:
+                st = os.fstat(f.fileno())
+                data = f.read()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None
+        return Playlist(name, path, data, st.st_mtime, st.st_size,
+                        can_block_reload=self.can_block_reload)
+
+    def _reload(self, name):
+        old = self._entries.get(name)
+        if old is None:
+            return
+        new = self._load(name, old.path)
+        with self._lock:
+            if new is None:
+                self._entries.pop(name, None)
+                self._by_path.pop(old.path, None)
+            else:
+                new.watched = old.watched
+                new.last_access = old.last_access
+                self._entries[name] = new
+        self._notify(name)
+
+    def _drop(self, name):
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                self._by_path.pop(entry.path, None)
+        self._notify(name)
+
+    # ---- inotify --------------------------------------------------------------
+    def _watch_dir(self, directory):
+        if self._inotify is None:
+            return False
+        with self._lock:
+            if directory in self._watches:
+                return True
+            try:
+                wd = self._inotify.add_watch(directory, _WATCH_MASK)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    log.warning("cannot watch %s (%s); polling it", directory, exc)
+                return False
+            self._watches[directory] = wd
+            self._wd_dirs[wd] = directory
+            return True
+
+    def _watch_loop(self):
+        inotify = self._inotify
+        while not self._stopping.is_set():
+            for wd, mask, filename in inotify.read_events(1.0):
+                if mask & IN_Q_OVERFLOW:
+                    # Lost events: re-read everything we hold
+                    for name in list(self._entries):
+                        self._reload(name)
+                    continue
+                if mask & (IN_IGNORED | IN_DELETE_SELF):
+                    self._unwatch(wd)
+                    continue
+                directory = self._wd_dirs.get(wd)
+                if directory is None or not filename:
+                    continue
+                name = self._by_path.get(os.path.join(directory, filename))
+                if name is not None:
+                    self._reload(name)
+        inotify.close()
+
+    def _unwatch(self, wd):
+        with self._lock:
+            directory = self._wd_dirs.pop(wd, None)
+            if directory is None:
+                return
+            self._watches.pop(directory, None)
+            for entry in self._entries.values():
+                if os.path.dirname(entry.path) == directory:
+                    entry.watched = False
+
+    # ---- stat polling fallback ------------------------------------------------
+    def _poll_loop(self):
+        while not self._stopping.wait(self.poll_interval):
+            now = time.monotonic()
+            for name, entry in list(self._entries.items()):
+                if now - entry.last_access > self.idle_timeout:
+                    self._drop(name)
+                    continue
+                if entry.watched:
+                    continue
+                try:
+                    st = os.stat(entry.path)
+                except FileNotFoundError:
+                    self._drop(name)
+                    continue
+                if st.st_mtime != entry.mtime or st.st_size != entry.size:
+                    self._reload(name)
+
+
+def _wake(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+
+def master_playlist(variants, query=""):
+    """
+    Multivariant (master) playlist for one channel.
+
+    variants: (stream name, Playlist or None, fallback bandwidth) from the
+    highest rendition down. BANDWIDTH is measured from each rendition's
+    segments when possible. `query` is appended to every rendition URI.
+    """
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-INDEPENDENT-SEGMENTS"]
+    for name, playlist, fallback in variants:
+        measured = playlist.bandwidth() if playlist is not None else None
+        if measured:
+            attrs = f"BANDWIDTH={measured[0]},AVERAGE-BANDWIDTH={measured[1]}"
+        else:
+            attrs = f"BANDWIDTH={int(fallback)}"
+        lines.append(f"#EXT-X-STREAM-INF:{attrs}")
+        lines.append(f"{name}.m3u8{'?' + query if query else ''}")
+    return ("\n".join(lines) + "\n").encode()
+
+
+def init_app(app):
+    app.extensions["playlist_cache"] = PlaylistCache(
+        app.config["HLS_DIR"],
+        poll_interval=app.config.get("HLS_PLAYLIST_POLL_INTERVAL", 0.5),
+        use_inotify=app.config.get("HLS_PLAYLIST_INOTIFY", True),
+        can_block_reload=app.config.get("HLS_BLOCKING_RELOAD", True),
+    )
+
+
+def get_playlist(name):
+    """
+    Return the cached Playlist for `name` under HLS_DIR, or None.
+    """
+    return current_app.extensions["playlist_cache"].get(name)
+
+
+def wait_for_playlist(name, msn, part=None, timeout=None):
+    """
+    Blocking playlist reload: see PlaylistCache.wait_for().
+    """
+    return current_app.extensions["playlist_cache"].wait_for(
+        name, msn, part, timeout
+    )
@@ -0,0 +1,387 @@
+import os
+import math
+import time
+import fcntl
+import shutil
+import logging
+import datetime
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+# ---- archiving ----------------------------------------------------------------
+def parse_media_playlist(data):
+    """
+    [(duration, uri, program_date_time or None)] of a media playlist.
+    """
+    segments = []
+    duration = None
+    pdt = None
+    for line in data.decode(errors="replace").splitlines():
+        line = line.strip()
+        if line.startswith("#EXTINF:"):
+            try:
+                duration = float(line[len("#EXTINF:"):].split(",", 1)[0])
+            except ValueError:
+                duration = None
+        elif line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
+            try:
+                pdt = datetime.datetime.fromisoformat(line.split(":", 1)[1]).timestamp()
+            except ValueError:
+                pdt = None
+        elif line and not line.startswith("#"):
+            if duration is not None:
+                segments.append((duration, line, pdt))
+            duration = None
+            pdt = None
+    return segments
+
+
+def archive_path(channel, start_ts, uri, tier="main"):
+    """
+    '<channel>/<YYYY-MM-DD>/<HHMMSS.mmm>-<segment name>' (UTC), relative
+    to RECORD_DIR; other tiers than main go under '<channel>/<tier>/'.
+    """
+    dt = datetime.datetime.utcfromtimestamp(start_ts)
+    prefix = channel if tier == "main" else f"{channel}/{tier}"
+    return f"{prefix}/{dt:%Y-%m-%d}/{dt:%H%M%S}.{dt.microsecond // 1000:03d}-{os.path.basename(uri)}"
+
+
+class Recorder:
+    """
+    Copies live segments from HLS_DIR into a dated archive under
+    `record_dir` and catalogs them in `segments` (channel, tier, start_ts,
+    duration, size, path), indexed on (channel, tier, start_ts).
+
+    - each tick reads every recorded channel's main-stream playlist and
+      archives the segments newer than the last one cataloged; a segment's
+      start is its EXT-X-PROGRAM-DATE-TIME, else its mtime minus duration
+    - with `sub_streams`, sub-streams are archived too (tier "sub"): the
+      motion analyzer decodes those instead of the main stream
+    - segments are copied, not hard-linked. The built-in packager
+      (app/ingest.py) numbers segments from the epoch and never reuses a
+      name, but an external packager restarting from 0 would rewrite a
+      hard-linked archive file in place
+    - quotas: segments older than `max_age_days`, then the oldest ones
+      beyond `max_bytes`, are removed (rows first, then files)
+    - one recorder per archive: `<record_dir>/.recorder.lock`; others keep
+      retrying and take over when the owner goes away
+
+    `connect` returns the recorder thread's DB connection.
+    """
+
+    def __init__(self, connect, hls_dir, record_dir, channels=None, poll_interval=1.0,
+                 max_age_days=14, max_bytes=0, purge_batch=500, sub_streams=True):
+        self.connect = connect
+        self.hls_dir = hls_dir
+        self.record_dir = record_dir
+        self.channels = channels
+        self.sub_streams = sub_streams
+        self.poll_interval = poll_interval
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        self.purge_batch = purge_batch
+
+        self._last_start = {}       # (channel, tier) -> start_ts of its newest cataloged segment
+        self._total_bytes = None
+        self._aged_at = float("-inf")
+        self._lock_fd = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self.archived = 0
+        self.purged = 0
+        self.errors = 0
+
+    # ---- lifecycle ------------------------------------------------------------
+    def acquire(self):
+        if self._lock_fd is not None:
+            return True
+        os.makedirs(self.record_dir, exist_ok=True)
+        fd = os.open(os.path.join(self.record_dir, ".recorder.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        # Whoever recorded before may have moved on: re-read the catalog
+        self._last_start.clear()
+        self._total_bytes = None
+        return True
+
+    def release(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run_forever, name="recorder", daemon=True)
+        self._thread.start()
+
+    def run_forever(self):
+        db = self.connect()
+        while not self._stopping.is_set():
+            if self.acquire():
+                try:
+                    self.tick(db)
+                except Exception:
+                    self.errors += 1
+                    log.exception("recorder tick failed")
+            self._stopping.wait(self.poll_interval)
+        self.release()
+
+    def stop(self):
+        self._stopping.set()
+
+    # ---- one pass -------------------------------------------------------------
+    def tick(self, db, now=None):
+        now = now or time.time()
+        for channel, tier, stream in self._sources(db):
+            self.archive(db, channel, stream, tier)
+        self.enforce_quotas(db, now)
+
+    def _sources(self, db):
+        rows = db.execute(
+            "SELECT name, main_stream, sub_stream FROM channels WHERE enabled = 1 ORDER BY position, name"
+        ).fetchall()
+        sources = []
+        for r in rows:
+            if self.channels is not None and r["name"] not in self.channels:
+                continue
+            sources.append((r["name"], "main", r["main_stream"]))
+            if self.sub_streams and r["sub_stream"]:
+                sources.append((r["name"], "sub", r["sub_stream"]))
+        return sources
+
+    def archive(self, db, channel, stream, tier="main"):
+        """
+        Archive and catalog the new segments of one channel's `tier`;
+        returns how many.
+        """
+        playlist = os.path.join(self.hls_dir, f"{stream}.m3u8")
+        try:
+            with open(playlist, "rb") as f:
+                segments = parse_media_playlist(f.read())
+        except FileNotFoundError:
+            return 0
+
+        last = self._last_start.get((channel, tier))
+        if last is None:
+            row = db.execute(
+                "SELECT MAX(start_ts) AS last FROM segments WHERE channel = ? AND tier = ?",
+                (channel, tier),
+            ).fetchone()
+            last = row["last"] if row["last"] is not None else float("-inf")
+
+        rows = []
+        for duration, uri, pdt in segments:
+            src = os.path.join(os.path.dirname(playlist), uri)
+            try:
+                st = os.stat(src)
+            except FileNotFoundError:
+                continue
+            start = pdt if pdt is not None else st.st_mtime - duration
+            # Tolerance for mtime granularity between reads
+            if start <= last + 0.01:
+                continue
+            rel = archive_path(channel, start, uri, tier)
+            dst = os.path.join(self.record_dir, rel)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            try:
+                shutil.copyfile(src, f"{dst}.tmp")
+                os.replace(f"{dst}.tmp", dst)
+            except FileNotFoundError:
+                continue  # rotated away under us
+            rows.append((channel, tier, start, duration, st.st_size, rel))
+            last = start
+
+        if rows:
+            with db:
+                db.executemany(
+                    """
+                    INSERT INTO segments (channel, tier, start_ts, duration, size, path)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    rows,
+                )
+            self.archived += len(rows)
+            if self._total_bytes is not None:
+                self._total_bytes += sum(r[4] for r in rows)
+        self._last_start[(channel, tier)] = last
+        return len(rows)
+
+    # ---- quotas ---------------------------------------------------------------
+    def enforce_quotas(self, db, now):
+        if self.max_age_days and now - self._aged_at >= 60:
+            self._aged_at = now
+            cutoff = now - self.max_age_days * 86400
+            while self._purge(db, "WHERE start_ts < ?", (cutoff,)):
+                pass
+        if self.max_bytes:
+            if self._total_bytes is None:
+                row = db.execute("SELECT COALESCE(SUM(size), 0) AS total FROM segments").fetchone()
+                self._total_bytes = row["total"]
+            while self._total_bytes > self.max_bytes:
+                if not self._purge(db, "", (), excess=self._total_bytes - self.max_bytes):
+                    break
+
+    def _purge(self, db, where, params, excess=None):
+        """
+        Remove the oldest `purge_batch` segments matching `where` (only as
+        many as free `excess` bytes, if given); returns how many went.
+        """
+        rows = db.execute(
+            f"SELECT id, path, size FROM segments {where} ORDER BY start_ts LIMIT ?",
+            (*params, self.purge_batch),
+        ).fetchall()
+        if excess is not None:
+            freed = 0
+            for n, r in enumerate(rows):
+                freed += r["size"]
+                if freed >= excess:
+                    rows = rows[:n + 1]
+                    break
+        if not rows:
+            return 0
+        with db:
+            db.executemany("DELETE FROM segments WHERE id = ?", [(r["id"],) for r in rows])
+        dirs = set()
+        for r in rows:
+            path = os.path.join(self.record_dir, r["path"])
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            dirs.add(os.path.dirname(path))
+        for directory in dirs:
+            try:
+                os.rmdir(directory)  # only succeeds once a day is empty
+            except OSError:
+                pass
+        self.purged += len(rows)
+        if self._total_bytes is not None:
+            self._total_bytes -= sum(r["size"] for r in rows)
+        return len(rows)
+
+    def status(self):
+        return {
+            "owned": self._lock_fd is not None,
+            "archived": self.archived,
+            "purged": self.purged,
+            "errors": self.errors,
+            "bytes": self._total_bytes,
+        }
+
+
+def recorder_from_config(config, connect):
+    return Recorder(
+        connect,
+        config["HLS_DIR"],
+        config["RECORD_DIR"],
+        channels=config.get("RECORD_CHANNELS"),
+        poll_interval=config.get("RECORD_POLL_INTERVAL", 1.0),
+        max_age_days=config.get("RECORD_MAX_AGE_DAYS", 14),
+        max_bytes=config.get("RECORD_MAX_BYTES", 0),
+        sub_streams=config.get("RECORD_SUB_STREAMS", True),
+    )
+
+
+def init_app(app):
+    """
+    With RECORD_AUTOSTART, every worker runs a recorder on its first
+    request; the archive lock file makes exactly one of them record.
+    """
+    if not app.config.get("RECORD_AUTOSTART") or not app.config.get("RECORD_DIR"):
+        return
+
+    state = {"pid": None}
+    lock = threading.Lock()
+
+    @app.before_request
+    def _ensure_recorder():
+        if state["pid"] == os.getpid():
+            return
+        with lock:
+            if state["pid"] != os.getpid():
+                recorder = recorder_from_config(app.config, app.extensions["db"].connection)
+                recorder.start()
+                app.extensions["recorder"] = recorder
+                state["pid"] = os.getpid()
+
+
+# ---- playback -----------------------------------------------------------------
+def parse_time(value):
+    """
+    Unix seconds from "1700000000[.5]" or an ISO 8601 time (naive = UTC).
+    Raises ValueError.
+    """
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    dt = datetime.datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+
+def find_segments(db, channel, start, end, limit):
+    """
+    Cataloged main-stream segments of `channel` overlapping [start, end),
+    oldest first.
+
+    Two seeks on (channel, tier, start_ts): the segment in progress at
+    `start`, then the range from there.
+    """
+    row = db.execute(
+        """
+        SELECT MAX(start_ts) AS first FROM segments
+        WHERE channel = ? AND tier = 'main' AND start_ts <= ?
+        """,
+        (channel, start),
+    ).fetchone()
+    first = row["first"] if row["first"] is not None else start
+    return db.execute(
+        """
+        SELECT start_ts, duration, path FROM segments
+        WHERE channel = ? AND tier = 'main' AND start_ts >= ? AND start_ts < ?
+        ORDER BY start_ts
+        LIMIT ?
+        """,
+        (channel, first, end, limit),
+    ).fetchall()
+
+
+def vod_playlist(segments, query="", gap=1.0):
+    """
+    EXT-X-PLAYLIST-TYPE:VOD playlist for `segments` (rows of find_segments).
+
+    URIs are "files/<archive path>" relative to /vod/, with `query`
+    appended. Holes longer than `gap` seconds (recorder or camera down)
+    get EXT-X-DISCONTINUITY, and every run starts with its wall-clock time
+    (EXT-X-PROGRAM-DATE-TIME) so players can show and seek by time.
+    """
+    target = max((math.ceil(s["duration"]) for s in segments), default=1)
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{target}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    expected = None
+    for s in segments:
+        if expected is None or abs(s["start_ts"] - expected) > gap:
+            if expected is not None:
+                lines.append("#EXT-X-DISCONTINUITY")
+            when = datetime.datetime.fromtimestamp(s["start_ts"], datetime.timezone.utc)
+            lines.append(f"#EXT-X-PROGRAM-DATE-TIME:{when.isoformat(timespec='milliseconds')}")
+        lines.append(f"#EXTINF:{s['duration']:.3f},")
+        lines.append(f"files/{s['path']}{'?' + query if query else ''}")
+        expected = s["start_ts"] + s["duration"]
+    lines.append("#EXT-X-ENDLIST")
+    return ("\n".join(lines) + "\n").encode()
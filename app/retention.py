@@ -0,0 +1,177 @@
+import time
+import datetime
+
+
+# settings key: access_logs rows before this hour are rolled up
+ROLLUP_WATERMARK_KEY = "access_log_rollup_until"
+
+# Hours that ended less than this long ago are not rolled up yet, so the
+# batched access-log writer can still deliver their last rows
+ROLLUP_GRACE = datetime.timedelta(minutes=5)
+
+
+def _hour(dt: datetime.datetime) -> str:
+    """
+    'YYYY-MM-DDTHH', the prefix of access_logs.created_at for that hour.
+    """
+    return dt.strftime("%Y-%m-%dT%H")
+
+
+def _next_hour(hour: str) -> str:
+    dt = datetime.datetime.strptime(hour, "%Y-%m-%dT%H")
+    return _hour(dt + datetime.timedelta(hours=1))
+
+
+def get_rollup_watermark(db) -> str | None:
+    row = db.execute(
+        "SELECT value FROM settings WHERE key = ?", (ROLLUP_WATERMARK_KEY,)
+    ).fetchone()
+    return row["value"] if row else None
+
+
+def _set_rollup_watermark(db, hour: str) -> None:
+    db.execute(
+        """
+        INSERT INTO settings (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        """,
+        (ROLLUP_WATERMARK_KEY, hour),
+    )
+
+
+def rollup_access_logs(db, now: datetime.datetime | None = None) -> int:
+    """
+    Aggregate complete hours of access_logs into access_log_hourly.
+
+    Each hour is one short transaction (and advances the watermark), so
+    writers are never blocked for long. Returns the number of hours rolled.
+    """
+    now = now or datetime.datetime.utcnow()
+    end = _hour(now - ROLLUP_GRACE)
+
+    hour = get_rollup_watermark(db)
+    if hour is None:
+        row = db.execute("SELECT MIN(created_at) AS first FROM access_logs").fetchone()
+        if row["first"] is None:
+            return 0
+        hour = row["first"][:13]
+
+    rolled = 0
+    while hour < end:
+        # Skip straight to the next hour that has rows
+        row = db.execute(
+            "SELECT MIN(created_at) AS first FROM access_logs WHERE created_at >= ?",
+            (hour,),
+        ).fetchone()
+        if row["first"] is None or row["first"][:13] >= end:
+            hour = end
+            _set_rollup_watermark(db, hour)
+            db.commit()
+            break
+        hour = row["first"][:13]
+        next_hour = _next_hour(hour)
+
+        db.execute(
+            """
+            INSERT INTO access_log_hourly (hour, token_id, path, hits, distinct_ips)
+            SELECT ?, token_id, path, COUNT(*), COUNT(DISTINCT ip)
+            FROM access_logs
+            WHERE created_at >= ? AND created_at < ?
+            GROUP BY token_id, path
+            ON CONFLICT (hour, token_id, path) DO UPDATE SET
+                hits = excluded.hits,
+                distinct_ips = excluded.distinct_ips
+            """,
+            (hour, hour, next_hour),
+        )
+        _set_rollup_watermark(db, next_hour)
+        db.commit()
+        hour = next_hour
+        rolled += 1
+
+    return rolled
+
+
+def purge_access_logs(db, retention_days: int, batch_size: int = 1000,
+                      pause: float = 0.05, now: datetime.datetime | None = None) -> int:
+    """
+    Delete raw access_logs older than `retention_days` that are already
+    rolled up, `batch_size` rows per transaction with `pause` seconds in
+    between. Returns the number of rows deleted.
+    """
+    now = now or datetime.datetime.utcnow()
+    cutoff = (now - datetime.timedelta(days=retention_days)).isoformat()
+    watermark = get_rollup_watermark(db)
+    if watermark is None:
+        return 0
+    cutoff = min(cutoff, watermark)
+
+    deleted = 0
+    while True:
+        cur = db.execute(
+            """
+            DELETE FROM access_logs
+            WHERE id IN (
+                SELECT id FROM access_logs WHERE created_at < ? LIMIT ?
+            )
+            """,
+            (cutoff, batch_size),
+        )
+        db.commit()
+        deleted += cur.rowcount
+        if cur.rowcount < batch_size:
+            return deleted
+        time.sleep(pause)
+
+
+def run_retention(db, retention_days: int, batch_size: int = 1000,
+                  pause: float = 0.05) -> dict:
+    """
+    Roll up complete hours, then purge raw rows past the retention window.
+    """
+    rolled = rollup_access_logs(db)
+    deleted = purge_access_logs(db, retention_days, batch_size, pause)
+    return {"hours_rolled": rolled, "rows_deleted": deleted}
+
+
+def access_summary(db, since: datetime.datetime, until: datetime.datetime,
+                   token_id: int | None = None):
+    """
+    Hits and distinct IPs per (hour, path) for the hours from `since`
+    through `until` (inclusive), newest first.
+
+    Hours before the rollup watermark come from access_log_hourly, the rest
+    from raw access_logs, so long ranges never scan the raw table. Distinct
+    IPs are counted per token, then summed.
+    """
+    start, end = _hour(since), _next_hour(_hour(until))
+    split = get_rollup_watermark(db) or start
+    split = max(start, min(split, end))
+
+    token_filter = ""
+    params_rollup = [start, split]
+    params_raw = [split, end]
+    if token_id is not None:
+        token_filter = " AND token_id = ?"
+        params_rollup.append(token_id)
+        params_raw.append(token_id)
+
+    return db.execute(
+        f"""
+        SELECT hour, path, SUM(hits) AS hits, SUM(distinct_ips) AS distinct_ips
+        FROM (
+            SELECT hour, path, hits, distinct_ips
+            FROM access_log_hourly
+            WHERE hour >= ? AND hour < ?{token_filter}
+            UNION ALL
+            SELECT substr(created_at, 1, 13) AS hour, path,
+                   COUNT(*) AS hits, COUNT(DISTINCT ip) AS distinct_ips
+            FROM access_logs
+            WHERE created_at >= ? AND created_at < ?{token_filter}
+            GROUP BY hour, token_id, path
+        )
+        GROUP BY hour, path
+        ORDER BY hour DESC, path
+        """,
+        params_rollup + params_raw,
+    ).fetchall()
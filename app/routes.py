@@ -1,213 +1,96 @@
 from flask import (
     Blueprint, request, abort, jsonify,
-    render_template_string, Response, send_from_directory,
-    current_app, session, redirect, url_for
+    render_template, Response,
+    current_app, session, redirect, url_for, make_response,
+    stream_with_context,
 )
 
-import os
+import hmac
+import time
+import datetime
+
+from urllib.parse import urlencode
 
 from .tokens import (
+    get_db,
     is_token_valid,
     log_access,
     list_tokens,
     revoke_token,
     create_token,
+    create_tokens,
+    revoke_tokens,
+    extend_tokens,
     verify_admin_password,
+    db_stats,
+)
+from .playlists import get_playlist, wait_for_playlist, master_playlist
+from .delivery import send_segment
+from .signing import request_grant, set_grant_cookie
+from .retention import access_summary
+from .mjpeg import get_feed, MIMETYPE as MJPEG_MIMETYPE
+from .mosaic import get_mosaic_feed
+from .snapshots import get_snapshot, SnapshotError
+from .recording import parse_time, find_segments, vod_playlist
+from .motion import find_events
+from .metrics import exposition, seen_hls_client
+from .asgi import ASGI_KEY, ASYNC_FEED_KEY, PREWAITED_KEY
+from .channels import (
+    GRIDS,
+    get_catalog,
+    save_channel,
+    delete_channel,
+    save_layout,
+    delete_layout,
+    parse_tiles,
 )
 
 bp = Blueprint("routes", __name__)
 
-# Absolute path to your HLS folder
-HLS_DIR = "/home/enjoy/nvr/hls"
 
 # --- HEALTH CHECK ---
-# app/routes.py
-
-from flask import (
-    Blueprint, request, abort, jsonify,
-    render_template_string, Response, send_from_directory,
-    current_app, session, redirect, url_for
-)
-
-bp = Blueprint("routes", __name__)
-
 @bp.get("/")
 def index():
     ip = request.headers.get("X-Forwarded-For", request.remote_addr)
-
-    html = """
-    <!doctype html>
-    <html lang="en">
-    <head>
-        <meta charset="utf-8" />
-        <title>Secure Monitoring Portal</title>
-        <style>
-            :root {
-                --bg: #020617;
-                --panel: #020617;
-                --accent: #f97316;
-                --accent2: #22c55e;
-                --border: #1f2937;
-                --text: #e5e7eb;
-                --muted: #9ca3af;
-                --danger: #ef4444;
-            }
-            * { box-sizing: border-box; }
-            body {
-                margin: 0;
-                font-family: system-ui, -apple-system, Segoe UI, Roboto, sans-serif;
-                background: radial-gradient(circle at top, #111827 0, #020617 55%);
-                color: var(--text);
-                min-height: 100vh;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                padding: 24px;
-            }
-            .wrap {
-                max-width: 900px;
-                width: 100%;
-                background: var(--panel);
-                border-radius: 16px;
-                border: 1px solid var(--border);
-                box-shadow: 0 24px 60px rgba(0,0,0,0.7);
-                padding: 24px 28px 20px;
-            }
-            header {
-                display: flex;
-                justify-content: space-between;
-                align-items: center;
-                border-bottom: 1px solid var(--border);
-                padding-bottom: 12px;
-                margin-bottom: 16px;
-            }
-            .title-block h1 {
-                font-size: 22px;
-                margin: 0 0 4px;
-                letter-spacing: 0.05em;
-                text-transform: uppercase;
-            }
-            .badge {
-                padding: 4px 10px;
-                border-radius: 999px;
-                font-size: 11px;
-                font-weight: 600;
-                text-transform: uppercase;
-            }
-            .badge-critical {
-                background: rgba(248, 113, 113, 0.12);
-                color: var(--danger);
-                border: 1px solid rgba(248, 113, 113, 0.45);
-            }
-            .warning-box {
-                border-radius: 12px;
-                border: 1px solid rgba(248, 250, 252, 0.08);
-                background: radial-gradient(circle at top left, rgba(248, 113, 113, 0.1), transparent 55%);
-                padding: 16px 18px;
-                margin-bottom: 18px;
-            }
-            .warning-box h2 {
-                margin: 0 0 8px;
-                font-size: 16px;
-                color: var(--danger);
-                text-transform: uppercase;
-                letter-spacing: 0.12em;
-            }
-            .button-row {
-                margin-top: 14px;
-                display: flex;
-                gap: 10px;
-            }
-            button {
-                padding: 8px 16px;
-                border: none;
-                border-radius: 6px;
-                font-size: 13px;
-                cursor: pointer;
-                transition: 0.2s;
-            }
-            .btn-understand {
-                background: var(--accent2);
-                color: black;
-                font-weight: 600;
-            }
-            .btn-understand:hover {
-                filter: brightness(1.15);
-            }
-            .btn-leave {
-                background: var(--danger);
-                color: white;
-                font-weight: 600;
-            }
-            .btn-leave:hover {
-                filter: brightness(1.2);
-            }
-            #acknowledged-box {
-                display: none;
-                margin-top: 20px;
-                font-size: 14px;
-                color: var(--muted);
-                text-align: center;
-            }
-        </style>
-    </head>
-    <body>
-        <div class="wrap">
-            <header>
-                <div class="title-block">
-                    <h1>Secure Monitoring Portal</h1>
-                    <span>Unauthorized access is strictly prohibited</span>
-                </div>
-                <span class="badge badge-critical">Access Logged</span>
-            </header>
-
-            <div id="warning-section">
-                <div class="warning-box">
-                    <h2>Restricted Private System</h2>
-                    <p>
-                        This system is part of a private electronic surveillance and cyber security environment.
-                        All connections, including IP address, time of access, and requested resources,
-                        are automatically logged and reviewed.
-                    </p>
-                    <p>
-                        Unauthorized use may result in access termination, blacklisting, and reporting
-                        to the appropriate authorities.
-                    </p>
-
-                    <div class="button-row">
-                        <button class="btn-understand" onclick="acknowledge()">I Understand</button>
-                        <button class="btn-leave" onclick="leave()">Leave</button>
-                    </div>
-                </div>
-            </div>
-
-            <div id="acknowledged-box">
-                ✔ Your access attempt has been logged.<br>
-                If you reached this page by accident, you may now close the tab safely.
-            </div>
-
-        </div>
-
-        <script>
-            function acknowledge() {
-                document.getElementById("warning-section").style.display = "none";
-                document.getElementById("acknowledged-box").style.display = "block";
-            }
-            function leave() {
-                window.location.href = "https://www.google.com/";
-            }
-        </script>
-    </body>
-    </html>
-    """
-
-    return render_template_string(html, ip=ip)
+    return render_template("index.html", ip=ip)
 
 
 # --- watchdog ---
 @bp.get("/health")
 def health():
-    return jsonify(status="ok"), 200
+    body = {"status": "ok", "db": db_stats()}
+    supervisor = current_app.extensions.get("ingest")
+    if supervisor is not None:
+        body["ingest"] = supervisor.status()
+    edge = current_app.extensions.get("edge")
+    if edge is not None:
+        body["edge"] = edge.stats()
+    recorder = current_app.extensions.get("recorder")
+    if recorder is not None:
+        body["recorder"] = recorder.status()
+    analyzer = current_app.extensions.get("motion")
+    if analyzer is not None:
+        body["motion"] = analyzer.status()
+    return jsonify(body), 200
+
+
+# --- METRICS ---
+@bp.get("/metrics")
+def metrics():
+    """
+    Prometheus text format, merged over all workers on this host.
+    Open like /health unless METRICS_TOKEN is set.
+    """
+    secret = current_app.config.get("METRICS_TOKEN")
+    if secret:
+        auth = request.headers.get("Authorization", "")
+        given = auth[len("Bearer "):] if auth.startswith("Bearer ") else request.args.get("token", "")
+        if not hmac.compare_digest(given.encode(), secret.encode()):
+            abort(401)
+    resp = Response(exposition(), mimetype="text/plain")
+    resp.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    resp.cache_control.no_store = True
+    return resp
 
 
 # --- ADMIN AUTH CHECK ---
@@ -229,41 +112,7 @@ def admin_login():
         else:
             error = "Invalid login credentials."
 
-    html = """
-    <!doctype html>
-    <html>
-    <head>
-        <title>Admin Login</title>
-        <style>
-            body { font-family: system-ui, sans-serif; background:#0f172a; color:#e5e7eb; display:flex; align-items:center; justify-content:center; height:100vh; margin:0; }
-            .box { background:#020617; padding:24px 28px; border-radius:12px; box-shadow:0 10px 30px rgba(0,0,0,0.5); width:320px; }
-            h1 { font-size:20px; margin-top:0; margin-bottom:12px; }
-            label { display:block; font-size:13px; margin-bottom:4px; }
-            input[type=password] { width:100%; padding:8px; border-radius:6px; border:1px solid #374151; background:#0b1120; color:#e5e7eb; }
-            input[type=text] { width:100%; padding:8px; border-radius:6px; border:1px solid #374151; background:#0b1120; color:#e5e7eb; }
-            button { margin-top:12px; width:100%; padding:8px; border:none; border-radius:6px; background:#2563eb; color:white; font-weight:500; cursor:pointer; }
-            button:hover { background:#1d4ed8; }
-            .error { color:#f87171; font-size:13px; margin-top:8px; }
-        </style>
-    </head>
-    <body>
-        <div class="box">
-            <h1>Admin Login</h1>
-            <form method="post">
-                <label for="user">Admin username</label>
-                <input id="user" name="user" type="text" required />
-                <label for="password">Password</label>
-                <input id="password" name="password" type="password" required />
-                {% if error %}
-                    <div class="error">{{ error }}</div>
-                {% endif %}
-                <button type="submit">Login</button>
-            </form>
-        </div>
-    </body>
-    </html>
-    """
-    return render_template_string(html, error=error)
+    return render_template("admin_login.html", error=error)
 
 # --- ADMIN LOGOUT ---
 @bp.get("/admin/logout")
@@ -289,10 +138,133 @@ def api_revoke_token():
     if not tok:
         abort(400, "missing token")
 
-    revoke_token(tok)
+    # revoke_token() takes an id; look the token string up instead
+    rows, _missing = revoke_tokens(tokens=[tok])
+    if not rows:
+        abort(404, "unknown token")
     return jsonify({"status": "revoked"})
 
 
+# --- TOKENS: BULK API (admin session) ---
+def _bulk_request():
+    """
+    JSON body of a bulk token call; 401 without an admin session.
+    """
+    if not is_admin_logged_in():
+        abort(401, "admin login required")
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, dict):
+        abort(400, "expected a JSON object")
+    return data
+
+
+def _bulk_selection(data):
+    """
+    ids / tokens / description_like of a bulk revoke or extend, checked.
+    """
+    ids = data.get("ids") or []
+    toks = data.get("tokens") or []
+    pattern = data.get("description_like") or None
+    if not isinstance(ids, list) or not isinstance(toks, list):
+        abort(400, "ids and tokens must be lists")
+    if len(ids) + len(toks) > current_app.config.get("TOKENS_BULK_MAX", 1000):
+        abort(400, "too many ids/tokens in one call")
+    if not (ids or toks or pattern):
+        abort(400, "select tokens by ids, tokens or description_like")
+    try:
+        ids = [int(i) for i in ids]
+    except (TypeError, ValueError):
+        abort(400, "ids must be integers")
+    if not all(isinstance(t, str) for t in toks) or not isinstance(pattern, (str, type(None))):
+        abort(400, "tokens and description_like must be strings")
+    return {"ids": ids, "tokens": toks, "description_like": pattern}
+
+
+@bp.get("/tokens")
+def api_list_tokens():
+    """
+    Tokens newest first, keyset-paginated like the admin page:
+    ?q= (description substring / token prefix), ?before=<id>, ?limit=.
+    """
+    if not is_admin_logged_in():
+        abort(401, "admin login required")
+    max_page = current_app.config.get("TOKENS_BULK_MAX", 1000)
+    limit = min(max(request.args.get("limit", 100, type=int), 1), max_page)
+    search = request.args.get("q", "").strip()
+    rows = list_tokens(
+        search=search or None,
+        before_id=request.args.get("before", type=int),
+        limit=limit + 1,
+    )
+    next_before = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_before = rows[-1]["id"]
+    return jsonify({
+        "tokens": [
+            {
+                "id": r["id"],
+                "token": r["token"],
+                "description": r["description"],
+                "created_at": r["created_at"],
+                "expires_at": r["expires_at"],
+                "revoked": bool(r["revoked"]),
+                "expired": bool(r["is_expired"]),
+                "last_used_at": r["last_used_at"],
+            }
+            for r in rows
+        ],
+        "next_before": next_before,
+    })
+
+
+@bp.post("/tokens/bulk")
+def api_bulk_create_tokens():
+    """
+    {"tokens": [{"description": ..., "days_valid": ...}, ...]}: all created
+    in one transaction.
+    """
+    specs = _bulk_request().get("tokens")
+    if not isinstance(specs, list) or not all(isinstance(x, dict) for x in specs):
+        abort(400, "tokens must be a list of objects")
+    if len(specs) > current_app.config.get("TOKENS_BULK_MAX", 1000):
+        abort(400, "too many tokens in one call")
+    try:
+        for spec in specs:
+            if spec.get("days_valid") is not None:
+                spec["days_valid"] = int(spec["days_valid"])
+    except (TypeError, ValueError):
+        abort(400, "days_valid must be an integer")
+    return jsonify({"tokens": create_tokens(specs)})
+
+
+@bp.post("/tokens/bulk/revoke")
+def api_bulk_revoke_tokens():
+    """
+    Revoke by {"ids": [...], "tokens": [...], "description_like": "lobby-%"}
+    (any combination) in one transaction.
+    """
+    rows, missing = revoke_tokens(**_bulk_selection(_bulk_request()))
+    return jsonify({"revoked": rows, "not_found": missing})
+
+
+@bp.post("/tokens/bulk/extend")
+def api_bulk_extend_tokens():
+    """
+    {"days": N, <selection as for revoke>}: expiring tokens get N more
+    days (from now if already expired), in one transaction.
+    """
+    data = _bulk_request()
+    try:
+        days = int(data.get("days"))
+    except (TypeError, ValueError):
+        abort(400, "days must be an integer")
+    if days <= 0:
+        abort(400, "days must be positive")
+    rows, missing = extend_tokens(days, **_bulk_selection(data))
+    return jsonify({"tokens": rows, "not_found": missing})
+
+
 # --- WALL VIEW (HLS) ---
 @bp.get("/wall")
 def wall():
@@ -308,110 +280,425 @@ def wall():
         user_agent=request.headers.get("User-Agent", ""),
     )
 
-    html = """
-    <!doctype html>
-    <html>
-    <head>
-        <title>NVR Wall - 4 Cameras</title>
-        <script src="https://cdn.jsdelivr.net/npm/hls.js@latest"></script>
-        <style>
-            html, body {
-                margin: 0;
-                padding: 0;
-                width: 100%;
-                height: 100%;
-                background: #000;
-                overflow: hidden;
-            }
-            .row {
-                display: flex;
-                width: 100vw;
-                height: 50vh;      /* two rows: each is half screen height */
-            }
-            .row video {
-                flex: 1 1 50%;      /* each video half the row width */
-                height: 100%;
-                width: 50%;
-                object-fit: fill;   /* stretch to fill its quadrant */
-                background: #000;
-                display: block;
-            }
-        </style>
-    </head>
-    <body>
-        <div class="row">
-            <video id="v1" autoplay muted></video>
-            <video id="v2" autoplay muted></video>
-        </div>
-        <div class="row">
-            <video id="v3" autoplay muted></video>
-            <video id="v4" autoplay muted></video>
-        </div>
-
-        <script>
-            function setupVideo(id, url) {
-                const video = document.getElementById(id);
-                if (Hls.isSupported()) {
-                    const hls = new Hls();
-                    hls.loadSource(url);
-                    hls.attachMedia(video);
-                } else if (video.canPlayType("application/vnd.apple.mpegurl")) {
-                    video.src = url;
-                } else {
-                    video.outerHTML = "<p style='color:white'>HLS not supported.</p>";
-                }
-            }
+    # mode=mjpeg: plain <img> tiles for browsers/TVs without hls.js
+    # mode=mosaic: one server-composited stream of all channels
+    mode = request.args.get("mode", "hls")
+
+    # layout=<name> (stored layout) or grid=1..4 (&page=N) over all channels
+    catalog = get_catalog()
+    layout = None
+    layout_name = request.args.get("layout")
+    if layout_name:
+        layout = catalog.layouts.get(layout_name)
+        if layout is None:
+            abort(404, "unknown layout")
+    grid = request.args.get("grid", type=int)
+    if grid is not None and grid not in GRIDS:
+        abort(400, "grid must be 1, 2, 3 or 4")
+    page = max(0, request.args.get("page", 0, type=int))
+    grid, tiles = catalog.tiles(layout=layout, grid=grid, page=page)
+
+    resp = make_response(render_template(
+        "wall.html",
+        token=token,
+        mode=mode,
+        grid=grid,
+        tiles=tiles,
+        live_sync_count=current_app.config.get("HLS_LIVE_SYNC_SEGMENTS", 2),
+    ))
+    # Signed grant for /hls/: playlists and segments are checked without the DB
+    return set_grant_cookie(resp, token_id, sorted(catalog.streams))
+
+
+# --- MJPEG (one shared decoder per channel) ---
+@bp.get("/mjpeg/<channel>")
+def mjpeg(channel):
+    """
+    multipart/x-mixed-replace JPEG stream of one channel.
+
+    All viewers share one decoder per channel (see app/mjpeg.py); slow
+    clients skip frames. The token is re-checked every HLS_GRANT_TTL
+    seconds so a revoked token ends the stream.
+    """
+    token = request.args.get("token", "")
+    token_id = is_token_valid(token)
+    if token_id is None:
+        abort(401, "Invalid or revoked token")
+    if channel not in get_catalog().streams:
+        abort(404)
+
+    log_access(
+        token_id=token_id,
+        path=f"/mjpeg/{channel}",
+        ip=request.remote_addr,
+        user_agent=request.headers.get("User-Agent", ""),
+    )
 
-            const token = "{{ token }}";
+    recheck_every = current_app.config.get("HLS_GRANT_TTL", 120)
+    state = {"next_check": time.monotonic() + recheck_every}
+
+    def keepalive():
+        if time.monotonic() < state["next_check"]:
+            return True
+        state["next_check"] = time.monotonic() + recheck_every
+        return is_token_valid(token) is not None
+
+    feed = get_feed(channel)
+    if ASGI_KEY in request.environ:
+        # app/asgi.py sends the frames from its event loop instead
+        request.environ[ASYNC_FEED_KEY] = (feed, keepalive)
+    resp = Response(
+        stream_with_context(feed.stream(keepalive)),
+        mimetype=MJPEG_MIMETYPE,
+    )
+    resp.cache_control.no_store = True
+    return resp
 
-            setupVideo("v1", "/hls/ch1.m3u8?token=" + encodeURIComponent(token));
-            setupVideo("v2", "/hls/ch2.m3u8?token=" + encodeURIComponent(token));
-            setupVideo("v3", "/hls/ch3.m3u8?token=" + encodeURIComponent(token));
-            setupVideo("v4", "/hls/ch4.m3u8?token=" + encodeURIComponent(token));
-        </script>
-    </body>
-    </html>
+
+# --- MOSAIC (all channels, composited server-side) ---
+@bp.get("/mosaic")
+@bp.get("/mosaic.mjpg")
+def mosaic():
+    """
+    multipart/x-mixed-replace JPEG stream of every channel tiled into one
+    low-resolution grid, encoded once per host and shared by all viewers
+    (see app/mosaic.py). 503 when numpy is not installed.
     """
-    return render_template_string(html, token=token)
+    token = request.args.get("token", "")
+    token_id = is_token_valid(token)
+    if token_id is None:
+        abort(401, "Invalid or revoked token")
+    feed = get_mosaic_feed()
+    if feed is None:
+        abort(503, "mosaic unavailable (numpy not installed)")
 
+    log_access(
+        token_id=token_id,
+        path="/mosaic",
+        ip=request.remote_addr,
+        user_agent=request.headers.get("User-Agent", ""),
+    )
 
+    recheck_every = current_app.config.get("HLS_GRANT_TTL", 120)
+    state = {"next_check": time.monotonic() + recheck_every}
 
-# --- SERVE HLS FILES ---
-@bp.get("/hls/<path:filename>")
-def serve_hls(filename):
+    def keepalive():
+        if time.monotonic() < state["next_check"]:
+            return True
+        state["next_check"] = time.monotonic() + recheck_every
+        return is_token_valid(token) is not None
+
+    if ASGI_KEY in request.environ:
+        request.environ[ASYNC_FEED_KEY] = (feed, keepalive)
+    resp = Response(
+        stream_with_context(feed.stream(keepalive)),
+        mimetype=MJPEG_MIMETYPE,
+    )
+    resp.cache_control.no_store = True
+    return resp
+
+
+# --- SNAPSHOTS (cached JPEG still per channel) ---
+@bp.get("/snapshot/<channel>")
+@bp.get("/snapshot/<channel>.jpg")
+def snapshot(channel):
     """
-    Serve HLS playlists and segments.
+    Latest keyframe of a channel as JPEG, from a per-process TTL cache
+    (see app/snapshots.py): concurrent requests share one extraction.
 
-    - For .m3u8: check token + log access (hits DB)
-    - For .ts: no token/DB check (avoid DB lock)
-    - Disable caching to avoid stale HLS
+    - ?token= or an admin session
+    - ?stream=main for the main stream; the sub-stream is used by default
     """
-    # Only validate/log for playlists
-    if filename.endswith(".m3u8"):
-        token = request.args.get("token", "")
+    if not is_admin_logged_in():
+        token_id = is_token_valid(request.args.get("token", ""))
+        if token_id is None:
+            abort(401, "Invalid or revoked token")
+        log_access(
+            token_id=token_id,
+            path=f"/snapshot/{channel}",
+            ip=request.remote_addr,
+            user_agent=request.headers.get("User-Agent", ""),
+        )
+
+    ch = get_catalog().by_name.get(channel)
+    if ch is None or not ch.enabled:
+        abort(404)
+    stream = ch.stream(small=request.args.get("stream") != "main")
+    playlist = get_playlist(f"{stream}.m3u8")
+    if playlist is None:
+        abort(404)
+    try:
+        snap = get_snapshot(stream, playlist)
+    except SnapshotError:
+        abort(503, "snapshot unavailable")
+
+    resp = Response(snap.data, mimetype="image/jpeg")
+    resp.set_etag(snap.etag)
+    resp.last_modified = snap.taken_at
+    resp.cache_control.private = True
+    resp.cache_control.max_age = current_app.config.get("SNAPSHOT_TTL", 10)
+    return resp.make_conditional(request)
+
+
+# --- VOD (recorded footage, see app/recording.py) ---
+@bp.get("/vod/<channel>")
+@bp.get("/vod/<channel>.m3u8")
+def vod(channel):
+    """
+    VOD playlist of a channel's recorded segments in [from, to).
+
+    - from / to: unix seconds or ISO 8601 (naive = UTC); to defaults to
+      now, from to one hour before `to`; at most RECORD_VOD_MAX_HOURS
+    - ?token= or an admin session; segment URIs carry the token
+    - one range query on segments (channel, start_ts)
+    """
+    if not current_app.config.get("RECORD_DIR"):
+        abort(404)
+    token = request.args.get("token", "")
+    if not is_admin_logged_in():
         token_id = is_token_valid(token)
         if token_id is None:
             abort(401, "Invalid or revoked token")
+        log_access(
+            token_id=token_id,
+            path=f"/vod/{channel}",
+            ip=request.remote_addr,
+            user_agent=request.headers.get("User-Agent", ""),
+        )
 
+    try:
+        end = parse_time(request.args["to"]) if request.args.get("to") else time.time()
+        start = parse_time(request.args["from"]) if request.args.get("from") else end - 3600
+    except ValueError:
+        abort(400, "from/to must be unix seconds or ISO 8601")
+    max_hours = current_app.config.get("RECORD_VOD_MAX_HOURS", 6)
+    if not start < end or end - start > max_hours * 3600:
+        abort(400, f"from must be before to, at most {max_hours} hours apart")
+    if channel not in get_catalog().by_name:
+        abort(404)
+
+    segments = find_segments(get_db(), channel, start, end, limit=max_hours * 3600)
+    if not segments:
+        abort(404, "no recordings in that range")
+    resp = Response(
+        vod_playlist(segments, query=urlencode({"token": token}) if token else ""),
+        mimetype="application/vnd.apple.mpegurl",
+    )
+    resp.add_etag()
+    # Holds the viewer's token: never in shared caches
+    resp.cache_control.private = True
+    resp.cache_control.max_age = 10
+    return resp.make_conditional(request)
+
+
+@bp.get("/vod/files/<path:filename>")
+def vod_file(filename):
+    """
+    A recorded segment; ?token= (token cache, not logged) or admin session.
+    """
+    record_dir = current_app.config.get("RECORD_DIR")
+    if not record_dir:
+        abort(404)
+    if not is_admin_logged_in() and is_token_valid(request.args.get("token", "")) is None:
+        abort(401, "Invalid or revoked token")
+    return send_segment(
+        filename,
+        public=False,
+        directory=record_dir,
+        accel_prefix=current_app.config.get("RECORD_ACCEL_PREFIX", "/_vod_internal/"),
+    )
+
+
+# --- MOTION SEARCH (see app/motion.py) ---
+@bp.get("/motion")
+def motion_events():
+    """
+    JSON list of motion events overlapping [from, to), oldest first.
+
+    - from / to as for /vod/ (default: the last hour)
+    - channel (repeatable) limits the search; min_score, limit
+    - ?token= or an admin session; each event links its /vod/ playlist
+      (add the token)
+    """
+    if not current_app.config.get("RECORD_DIR"):
+        abort(404)
+    if not is_admin_logged_in():
+        token_id = is_token_valid(request.args.get("token", ""))
+        if token_id is None:
+            abort(401, "Invalid or revoked token")
         log_access(
             token_id=token_id,
-            path=f"/hls/{filename}",
+            path="/motion",
             ip=request.remote_addr,
             user_agent=request.headers.get("User-Agent", ""),
         )
 
-    full_path = os.path.join(HLS_DIR, filename)
-    if not os.path.isfile(full_path):
+    try:
+        end = parse_time(request.args["to"]) if request.args.get("to") else time.time()
+        start = parse_time(request.args["from"]) if request.args.get("from") else end - 3600
+        min_score = float(request.args.get("min_score", 0))
+        max_events = current_app.config.get("MOTION_QUERY_MAX_EVENTS", 1000)
+        limit = min(int(request.args.get("limit", max_events)), max_events)
+    except ValueError:
+        abort(400, "from/to must be unix seconds or ISO 8601, min_score/limit numbers")
+    if not start < end:
+        abort(400, "from must be before to")
+    channels = request.args.getlist("channel")
+    catalog = get_catalog()
+    if any(name not in catalog.by_name for name in channels):
         abort(404)
 
-    resp = send_from_directory(HLS_DIR, filename)
+    rows = find_events(
+        get_db(), start, end, channels=channels or None, min_score=min_score,
+        limit=max(limit, 0), max_event=current_app.config.get("MOTION_MAX_EVENT_SECONDS", 300),
+    )
+    return jsonify({
+        "from": start,
+        "to": end,
+        "events": [
+            {
+                "channel": r["channel"],
+                "start": r["start_ts"],
+                "end": r["end_ts"],
+                "score": round(r["score"], 4),
+                "vod": f"/vod/{r['channel']}.m3u8?"
+                       + urlencode({"from": f"{r['start_ts']:.3f}", "to": f"{r['end_ts']:.3f}"}),
+            }
+            for r in rows
+        ],
+    })
 
-    # Stop browser from caching HLS files aggressively
-    resp.cache_control.no_store = True
-    resp.cache_control.must_revalidate = True
-    resp.expires = 0
 
-    return resp
+# --- SERVE HLS FILES ---
+@bp.get("/hls/<path:filename>")
+def serve_hls(filename):
+    """
+    Serve HLS playlists and segments.
+
+    - <channel>.master.m3u8: master playlist listing the channel's
+      renditions (main, sub, low); authorized and logged once per load
+    - For .m3u8: served from the in-memory cache, cacheable for half the
+      target duration; logged only when the ?token= had to be checked
+    - _HLS_msn / _HLS_part (LL-HLS blocking reload): the request is held
+      until the playlist contains that segment/part
+    - For .ts: authorized by the signed grant cookie only (no DB), delivered
+      according to HLS_SEGMENT_DELIVERY (flask / sendfile / x-accel /
+      x-sendfile), immutable
+    - ETag / If-None-Match (304) and Range requests are honoured
+
+    Authorization uses the HMAC grant cookie issued by /wall. Only when it is
+    missing or past half its lifetime is the ?token= checked (token cache /
+    DB) and a fresh grant attached, so a revoked token stops working within
+    HLS_GRANT_TTL.
+    """
+    grant = request_grant()
+
+    ttl = current_app.config.get("HLS_GRANT_TTL", 120)
+
+    if filename.endswith(".master.m3u8"):
+        catalog = get_catalog()
+        channel = catalog.by_name.get(filename[:-len(".master.m3u8")])
+        if channel is None or not channel.enabled or channel.master is None:
+            abort(404)
+
+        renew = False
+        if grant is not None and grant.remaining() > ttl / 2 and all(
+            grant.allows(f"{stream}.m3u8") for stream in channel.streams
+        ):
+            token_id = grant.token_id
+        else:
+            token_id = is_token_valid(request.args.get("token", ""))
+            if token_id is None:
+                abort(401, "Invalid or revoked token")
+            renew = True
+
+        log_access(
+            token_id=token_id,
+            path=f"/hls/{filename}",
+            ip=request.remote_addr,
+            user_agent=request.headers.get("User-Agent", ""),
+        )
+
+        fallback = current_app.config.get("HLS_FALLBACK_BANDWIDTH", {})
+        token = request.args.get("token")
+        variants = []
+        for tier, stream in channel.renditions:
+            playlist = get_playlist(f"{stream}.m3u8")
+            # Skip tiers that aren't being packaged right now (never main)
+            if playlist is not None or tier == "main":
+                variants.append((stream, playlist, fallback.get(tier, 1_000_000)))
+        body = master_playlist(
+            variants,
+            # Renditions carry the token so they can renew the grant later
+            query=urlencode({"token": token}) if token else "",
+        )
+        resp = Response(body, mimetype="application/vnd.apple.mpegurl")
+        resp.add_etag()
+        # Holds the viewer's token: never in shared caches
+        resp.cache_control.private = True
+        resp.cache_control.max_age = 10
+        if renew:
+            set_grant_cookie(resp, token_id, sorted(catalog.streams))
+        return resp.make_conditional(request)
+
+    if filename.endswith(".m3u8"):
+        # Rendition reloads inside a valid grant are neither re-checked nor
+        # logged: the master (or /wall) load already was
+        renew = False
+        if grant is not None and grant.allows(filename) and grant.remaining() > ttl / 2:
+            token_id = grant.token_id
+        else:
+            token_id = is_token_valid(request.args.get("token", ""))
+            if token_id is None:
+                abort(401, "Invalid or revoked token")
+            renew = True
+            log_access(
+                token_id=token_id,
+                path=f"/hls/{filename}",
+                ip=request.remote_addr,
+                user_agent=request.headers.get("User-Agent", ""),
+            )
+
+        msn = request.args.get("_HLS_msn", type=int)
+        part = request.args.get("_HLS_part", type=int)
+        if part is not None and msn is None:
+            abort(400, "_HLS_part requires _HLS_msn")
+
+        playlist = get_playlist(filename)
+        if playlist is None:
+            abort(404)
+        seen_hls_client(filename[:-len(".m3u8")], token_id)
+
+        if msn is not None:
+            # LL-HLS blocking reload: hold until the packager writes `msn`
+            if msn > playlist.last_msn + 2:
+                abort(400, "_HLS_msn too far in the future")
+            # Under app/asgi.py the wait already happened on the event loop
+            timeout = 0 if request.environ.get(PREWAITED_KEY) else None
+            playlist = wait_for_playlist(filename, msn, part, timeout=timeout)
+            if playlist is None:
+                abort(503, "playlist update timed out")
+
+        resp = Response(playlist.data, mimetype="application/vnd.apple.mpegurl")
+        resp.set_etag(playlist.etag)
+        resp.last_modified = playlist.mtime
+        # A renewing response carries the viewer's grant: private (see
+        # set_grant_cookie); only plain reloads may sit in shared caches
+        resp.cache_control.public = not renew
+        if msn is not None:
+            # Unique per update: safe to cache for several target durations
+            resp.cache_control.max_age = 6 * (playlist.target_duration or 2)
+        else:
+            # Live playlists change every segment: cache for half a target duration
+            resp.cache_control.max_age = playlist.max_age
+        if renew:
+            set_grant_cookie(resp, token_id, sorted(get_catalog().streams))
+        return resp.make_conditional(request)
+
+    signed = current_app.config.get("HLS_SIGNED_SEGMENTS", True)
+    if signed and (grant is None or not grant.allows(filename)):
+        abort(403, "Missing or expired HLS grant")
+    return send_segment(filename, public=not signed)
 
 
 # --- ADMIN: LIST TOKENS ---
@@ -441,156 +728,25 @@ def admin_tokens():
 
         new_token_value = create_token(description, days_valid=days_valid)
 
-    rows = list_tokens()
-
-    html = """
-    <!doctype html>
-    <html>
-    <head>
-        <title>NVR Tokens Admin</title>
-        <style>
-            body { font-family: system-ui, sans-serif; background:#0f172a; color:#e5e7eb; padding:20px; }
-            h1 { margin-top:0; }
-            a { color:#60a5fa; text-decoration:none; }
-            a:hover { text-decoration:underline; }
-            table { border-collapse: collapse; width: 100%; margin-top: 1rem; }
-            th, td { border: 1px solid #374151; padding: 6px 8px; font-size: 13px; }
-            th { background:#111827; text-align:left; }
-            tr:nth-child(even) { background:#111827; }
-            tr:nth-child(odd) { background:#020617; }
-            .badge { padding: 2px 6px; border-radius: 999px; font-size: 11px; }
-            .ok { background:#065f46; }
-            .revoked { background:#7f1d1d; }
-            .expired { background:#92400e; }
-            .token { font-family: monospace; font-size: 11px; }
-            .top-bar { display:flex; justify-content:space-between; align-items:center; }
-            .form-row { margin-top:1rem; padding:12px; background:#020617; border-radius:8px; border:1px solid #1f2937; }
-            label { font-size:13px; display:block; margin-bottom:4px; }
-            input[type=text], input[type=number] { padding:6px; border-radius:6px; border:1px solid #374151; background:#0b1120; color:#e5e7eb; width:100%; max-width:260px; }
-            button { padding:6px 12px; border:none; border-radius:6px; background:#2563eb; color:white; font-size:13px; cursor:pointer; }
-            button:hover { background:#1d4ed8; }
-            .new-token-box { margin-top:10px; padding:8px; background:#022c22; border-radius:6px; font-family:monospace; font-size:12px; }
-            button.copy-btn {
-                padding:4px 8px;
-                border:none;
-                border-radius:6px;
-                background:#059669;
-                color:white;
-                font-size:12px;
-                cursor:pointer;
-            }
-            button.copy-btn:hover { background:#047857; }
-        </style>
-    </head>
-    <body>
-        <div class="top-bar">
-            <h1>Token Admin</h1>
-            <div>
-                <a href="/admin/logout">Logout</a>
-            </div>
-        </div>
-
-        <div class="form-row">
-            <form method="post">
-                <div style="display:flex; gap:16px; flex-wrap:wrap; align-items:flex-end;">
-                    <div>
-                        <label for="description">Description</label>
-                        <input id="description" name="description" type="text" placeholder="e.g. Upstairs TV" />
-                    </div>
-                    <div>
-                        <label for="days_valid">Valid for (days)</label>
-                        <input id="days_valid" name="days_valid" type="number" min="1" placeholder="30" />
-                    </div>
-                    <div>
-                        <button type="submit">Create Token</button>
-                    </div>
-                </div>
-            </form>
-
-            {% if new_token %}
-                <div class="new-token-box">
-                    New token (copy & save now): {{ new_token }}
-                </div>
-            {% endif %}
-        </div>
-
-        <table>
-            <thead>
-                <tr>
-                    <th>ID</th>
-                    <th>Description</th>
-                    <th>Token</th>
-                    <th>Created</th>
-                    <th>Expires</th>
-                    <th>Last Used</th>
-                    <th>Status</th>
-                    <th>Revoke</th>
-                    <th>Share</th>
-                </tr>
-            </thead>
-            <tbody>
-            {% for t in tokens %}
-                <tr>
-                    <td>{{ t.id }}</td>
-                    <td>{{ t.description or '' }}</td>
-                    <td class="token">{{ t.token }}</td>
-                    <td>{{ t.created_at }}</td>
-                    <td>{{ t.expires_at or '' }}</td>
-                    <td>{{ t.last_access_at or t.last_used_at or '' }}</td>
-                    <td>
-                        {% if t.revoked %}
-                            <span class="badge revoked">revoked</span>
-                        {% elif t.is_expired %}
-                            <span class="badge expired">expired</span>
-                        {% else %}
-                            <span class="badge ok">active</span>
-                        {% endif %}
-                    </td>
-                    <td>
-                        {% if not t.revoked %}
-                            <a href="/admin/tokens/revoke?id={{ t.id }}">Revoke</a>
-                        {% endif %}
-                    </td>
-                    <td>
-                        <button type="button" onclick="copyUrl('{{ t.token }}')">
-                            Copy URL
-                        </button>
-                    </td>
-                </tr>
-            {% endfor %}
-            </tbody>
-        </table>
-    </body>
-    <script>
-        function copyUrl(token) {
-            const url = window.location.origin + '/wall?token=' + token;
-            if (navigator.clipboard && navigator.clipboard.writeText) {
-                navigator.clipboard.writeText(url).then(() => {
-                    // Small, non-intrusive feedback
-                    console.log('Copied:', url);
-                }).catch(err => {
-                    console.error('Clipboard error:', err);
-                    alert('Could not copy URL');
-                });
-            } else {
-                // Fallback for very old browsers
-                const temp = document.createElement('input');
-                temp.value = url;
-                document.body.appendChild(temp);
-                temp.select();
-                try {
-                    document.execCommand('copy');
-                    console.log('Copied (fallback):', url);
-                } catch (e) {
-                    alert('Could not copy URL');
-                }
-                document.body.removeChild(temp);
-            }
-        }
-    </script>
-    </html>
-    """
-    return render_template_string(html, tokens=rows, new_token=new_token_value)
+    search = request.args.get("q", "").strip()
+    before_id = request.args.get("before", type=int)
+    page_size = current_app.config.get("ADMIN_TOKENS_PAGE_SIZE", 50)
+
+    # Fetch one extra row to know whether an older page exists
+    rows = list_tokens(search=search or None, before_id=before_id, limit=page_size + 1)
+    next_before = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_before = rows[-1]["id"]
+
+    return render_template(
+        "admin_tokens.html",
+        tokens=rows,
+        new_token=new_token_value,
+        search=search,
+        before_id=before_id,
+        next_before=next_before,
+    )
 
 
 # --- ADMIN: REVOKE TOKEN ---
@@ -610,3 +766,73 @@ def admin_revoke_token():
     revoke_token(token_id)
     return redirect(url_for("routes.admin_tokens"))
 
+
+
+# --- ADMIN: ACCESS LOG SUMMARY ---
+@bp.get("/admin/access")
+def admin_access():
+    """
+    Hourly hits per path, optionally for one token.
+    Long ranges are served from the hourly rollups (see app/retention.py).
+    """
+    if not is_admin_logged_in():
+        return redirect(url_for("routes.admin_login", next=request.path))
+
+    token_id = request.args.get("token_id", type=int)
+    hours = request.args.get("hours", 24, type=int)
+    hours = max(1, min(hours, 24 * 366))
+
+    until = datetime.datetime.utcnow()
+    since = until - datetime.timedelta(hours=hours)
+    rows = access_summary(get_db(), since, until, token_id=token_id)
+
+    return render_template("admin_access.html", rows=rows, token_id=token_id, hours=hours)
+
+
+# --- ADMIN: CHANNELS & LAYOUTS ---
+@bp.route("/admin/channels", methods=["GET", "POST"])
+def admin_channels():
+    """
+    Admin UI:
+    - Add/update/delete channels (main + optional sub-stream / low tier)
+    - Add/replace/delete named wall layouts ("ch1:2 ch2 ch3", :N = span)
+    Changes reach every worker within CHANNEL_CACHE_INTERVAL seconds.
+    """
+    if not is_admin_logged_in():
+        return redirect(url_for("routes.admin_login", next=request.path))
+
+    error = None
+    if request.method == "POST":
+        form = request.form
+        action = form.get("action")
+        try:
+            if action == "save_channel":
+                save_channel(
+                    form.get("name", "").strip(),
+                    main=form.get("main", "").strip() or None,
+                    sub=form.get("sub", "").strip() or None,
+                    low=form.get("low", "").strip() or None,
+                    title=form.get("title", "").strip() or None,
+                    position=int(form.get("position") or 0),
+                    enabled=form.get("enabled") == "1",
+                )
+            elif action == "delete_channel":
+                delete_channel(form.get("name", ""))
+            elif action == "save_layout":
+                save_layout(
+                    form.get("name", "").strip(),
+                    int(form.get("grid") or 0),
+                    parse_tiles(form.get("tiles", "")),
+                )
+            elif action == "delete_layout":
+                delete_layout(form.get("name", ""))
+            else:
+                abort(400, "unknown action")
+        except ValueError as exc:
+            error = str(exc)
+        else:
+            return redirect(url_for("routes.admin_channels"))
+
+    catalog = get_catalog()
+
+    return render_template("admin_channels.html", catalog=catalog, grids=GRIDS, error=error)
@@ -0,0 +1,109 @@
+import re
+import hmac
+import time
+import base64
+import hashlib
+
+from flask import current_app, request
+
+
+# Cookie carrying the HLS grant; scoped to /hls/ so it only rides on
+# playlist/segment requests
+GRANT_COOKIE = "nvr_hls"
+
+_CHANNEL_NAME = re.compile(r"^[A-Za-z0-9-]+$")
+
+
+class Grant:
+    """
+    A verified HLS grant: token_id may fetch `channels` until `expires_at`.
+    """
+
+    __slots__ = ("token_id", "expires_at", "channels")
+
+    def __init__(self, token_id, expires_at, channels):
+        self.token_id = token_id
+        self.expires_at = expires_at
+        self.channels = channels
+
+    def remaining(self, now=None):
+        return self.expires_at - (now if now is not None else time.time())
+
+    def allows(self, filename):
+        """
+        True if `filename` belongs to one of the granted channels.
+
+        A file belongs to channel "ch1" if it is "ch1.m3u8", "ch1_*", "ch1-*"
+        or lives under "ch1/".
+        """
+        for channel in self.channels:
+            if filename.startswith(channel) and (
+                len(filename) == len(channel) or filename[len(channel)] in "._-/"
+            ):
+                return True
+        return False
+
+
+def _signature(payload: str) -> str:
+    key = current_app.config["SECRET_KEY"]
+    if isinstance(key, str):
+        key = key.encode()
+    digest = hmac.new(key, b"hls-grant|" + payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:18]).decode()
+
+
+def issue_grant(token_id: int, channels, ttl: int) -> str:
+    """
+    Return a signed grant value "<token_id>:<expires>:<ch1~ch2>:<sig>".
+    """
+    for channel in channels:
+        if not _CHANNEL_NAME.match(channel):
+            raise ValueError(f"invalid channel name for grant: {channel!r}")
+    payload = f"{token_id}:{int(time.time()) + ttl}:{'~'.join(channels)}"
+    return f"{payload}:{_signature(payload)}"
+
+
+def verify_grant(value: str | None) -> Grant | None:
+    """
+    Return the Grant if `value` is authentic and unexpired, else None.
+    Pure CPU: no DB access.
+    """
+    if not value:
+        return None
+    try:
+        payload, sig = value.rsplit(":", 1)
+        token_id, expires_at, channels = payload.split(":")
+        grant = Grant(int(token_id), int(expires_at), channels.split("~"))
+    except ValueError:
+        return None
+    if not hmac.compare_digest(sig, _signature(payload)):
+        return None
+    if grant.remaining() <= 0:
+        return None
+    return grant
+
+
+def request_grant() -> Grant | None:
+    return verify_grant(request.cookies.get(GRANT_COOKIE))
+
+
+def set_grant_cookie(resp, token_id: int, channels):
+    """
+    Attach a fresh grant for `channels` to `resp`.
+
+    The cookie belongs to one viewer, so `resp` becomes private: a shared
+    cache must never store it and hand the grant to someone else.
+    """
+    ttl = current_app.config.get("HLS_GRANT_TTL", 120)
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    resp.set_cookie(
+        GRANT_COOKIE,
+        issue_grant(token_id, channels, ttl),
+        max_age=ttl,
+        path="/hls/",
+        httponly=True,
+        samesite="Lax",
+        secure=request.is_secure,
+    )
+    return resp
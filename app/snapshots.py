@@ -0,0 +1,211 @@
+import os
+import time
+import fcntl
+import hashlib
+import logging
+import threading
+import subprocess
+
+from flask import current_app
+
+from .singleflight import SingleFlight
+
+
+log = logging.getLogger(__name__)
+
+_SOI = b"\xff\xd8"
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class Snapshot:
+    """
+    One JPEG still of a stream and the segment it was taken from.
+    """
+
+    __slots__ = ("data", "etag", "segment", "taken_at", "checked_at")
+
+    def __init__(self, data, segment, taken_at=None):
+        self.data = data
+        self.etag = hashlib.blake2b(data, digest_size=8).hexdigest()
+        self.segment = segment
+        self.taken_at = taken_at or time.time()
+        self.checked_at = time.monotonic()
+
+
+def newest_segment(playlist):
+    """
+    Path of the last segment listed in a Playlist, or None.
+    """
+    for line in reversed(playlist.data.splitlines()):
+        line = line.strip()
+        if line and not line.startswith(b"#"):
+            return os.path.join(os.path.dirname(playlist.path), os.fsdecode(line))
+    return None
+
+
+class SnapshotCache:
+    """
+    Latest still per stream, shared by all requests of this process and,
+    through `shared_dir`, by all workers of the host.
+
+    - a snapshot is reused for `ttl` seconds
+    - after that it is only re-extracted if the playlist has a newer
+      segment; otherwise the old one is simply re-validated
+    - at most one ffmpeg per stream and host: concurrent misses in this
+      process wait for it (SingleFlight), other workers wait on
+      `<shared_dir>/<stream>.lock` and then read the still it wrote to
+      `<shared_dir>/<stream>.snap` (the segment path, a newline, the JPEG)
+    """
+
+    def __init__(self, ffmpeg="ffmpeg", ttl=10, width=640, quality=5, timeout=10,
+                 shared_dir=None):
+        self.ffmpeg = ffmpeg
+        self.ttl = ttl
+        self.width = width
+        self.quality = quality
+        self.timeout = timeout
+        self.shared_dir = shared_dir
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self.extractions = 0
+        self.coalesced = 0
+        self.shared = 0
+
+    def get(self, stream, playlist):
+        entry = self._entries.get(stream)
+        if entry is not None and time.monotonic() - entry.checked_at < self.ttl:
+            return entry
+
+        segment = newest_segment(playlist)
+        if segment is None:
+            if entry is not None:
+                return entry
+            raise SnapshotError(f"{stream}: no segments")
+        if entry is not None and entry.segment == segment:
+            entry.checked_at = time.monotonic()
+            return entry
+
+        try:
+            entry, shared = self._flight.do(stream, lambda: self._refresh(stream, segment))
+        except SnapshotError:
+            # e.g. the segment rotated away mid-extraction: serve the last one
+            if entry is not None:
+                return entry
+            raise
+        if shared:
+            with self._lock:
+                self.coalesced += 1
+        return entry
+
+    def _refresh(self, stream, segment):
+        if self.shared_dir is None:
+            return self._store(stream, Snapshot(self.extract(segment), segment))
+        entry = self._read_shared(stream, segment)
+        if entry is not None:
+            return self._store(stream, entry, shared=True)
+        os.makedirs(self.shared_dir, exist_ok=True)
+        with open(os.path.join(self.shared_dir, f"{stream}.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another worker may have extracted it while we waited
+            entry = self._read_shared(stream, segment)
+            if entry is not None:
+                return self._store(stream, entry, shared=True)
+            entry = Snapshot(self.extract(segment), segment)
+            path = os.path.join(self.shared_dir, f"{stream}.snap")
+            tmp = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(os.fsencode(segment) + b"\n" + entry.data)
+                os.replace(tmp, path)
+            except OSError as exc:
+                log.warning("cannot share snapshot of %s: %s", stream, exc)
+        return self._store(stream, entry)
+
+    def _read_shared(self, stream, segment):
+        path = os.path.join(self.shared_dir, f"{stream}.snap")
+        try:
+            with open(path, "rb") as f:
+                taken_at = os.fstat(f.fileno()).st_mtime
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        shared_segment, _, jpeg = data.partition(b"\n")
+        if os.fsdecode(shared_segment) != segment or not jpeg.startswith(_SOI):
+            return None
+        return Snapshot(jpeg, segment, taken_at)
+
+    def _store(self, stream, entry, shared=False):
+        with self._lock:
+            self._entries[stream] = entry
+            if shared:
+                self.shared += 1
+            else:
+                self.extractions += 1
+        return entry
+
+    def command(self, segment):
+        return [
+            self.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error",
+            # Decode keyframes only; every segment starts with one
+            "-skip_frame", "nokey",
+            "-i", segment,
+            "-an", "-vsync", "passthrough",
+            "-vf", f"scale={self.width}:-2",
+            "-q:v", str(self.quality),
+            "-f", "image2pipe", "-c:v", "mjpeg", "pipe:1",
+        ]
+
+    def extract(self, segment):
+        """
+        JPEG of the last keyframe in `segment`.
+        """
+        try:
+            proc = subprocess.run(
+                self.command(segment),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=self.timeout,
+            )
+        except subprocess.TimeoutExpired:
+            raise SnapshotError(f"{segment}: ffmpeg timed out")
+        except OSError as exc:
+            raise SnapshotError(f"cannot run ffmpeg: {exc}")
+        data = proc.stdout
+        start = data.rfind(_SOI)
+        if proc.returncode != 0 or start < 0:
+            log.warning("snapshot of %s failed: %s", segment,
+                        proc.stderr.decode(errors="replace").strip())
+            raise SnapshotError(f"{segment}: no frame decoded")
+        return data[start:]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "cached": len(self._entries),
+                "extractions": self.extractions,
+                "coalesced": self.coalesced,
+                "shared": self.shared,
+            }
+
+
+def init_app(app):
+    from .mjpeg import default_shared_dir
+
+    config = app.config
+    app.extensions["snapshots"] = SnapshotCache(
+        ffmpeg=config.get("FFMPEG_BIN", "ffmpeg"),
+        ttl=config.get("SNAPSHOT_TTL", 10),
+        width=config.get("SNAPSHOT_WIDTH", 640),
+        quality=config.get("SNAPSHOT_QUALITY", 5),
+        timeout=config.get("SNAPSHOT_TIMEOUT", 10),
+        shared_dir=os.path.join(config.get("MJPEG_SHARED_DIR") or default_shared_dir(), "snapshots"),
+    )
+
+
+def get_snapshot(stream, playlist):
+    return current_app.extensions["snapshots"].get(stream, playlist)
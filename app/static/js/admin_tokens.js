@@ -0,0 +1,25 @@
+function copyUrl(token) {
+    const url = window.location.origin + '/wall?token=' + token;
+    if (navigator.clipboard && navigator.clipboard.writeText) {
+        navigator.clipboard.writeText(url).then(() => {
+            // Small, non-intrusive feedback
+            console.log('Copied:', url);
+        }).catch(err => {
+            console.error('Clipboard error:', err);
+            alert('Could not copy URL');
+        });
+    } else {
+        // Fallback for very old browsers
+        const temp = document.createElement('input');
+        temp.value = url;
+        document.body.appendChild(temp);
+        temp.select();
+        try {
+            document.execCommand('copy');
+            console.log('Copied (fallback):', url);
+        } catch (e) {
+            alert('Could not copy URL');
+        }
+        document.body.removeChild(temp);
+    }
+}
@@ -0,0 +1,59 @@
+// Wall bootstrap. Per-viewer settings come from data-* attributes on the
+// .wall element, so this file is the same for everyone and cached for good.
+(function () {
+    const wall = document.querySelector(".wall");
+    if (!wall) {
+        return;
+    }
+    const token = wall.dataset.token;
+    const mode = wall.dataset.mode;
+    const liveSyncCount = parseInt(wall.dataset.liveSync, 10) || 2;
+
+    function streamUrl(stream) {
+        if (mode === "mjpeg") {
+            return "/mjpeg/" + stream + "?token=" + encodeURIComponent(token);
+        }
+        return "/hls/" + stream + ".m3u8?token=" + encodeURIComponent(token);
+    }
+
+    function play(el, stream) {
+        const url = streamUrl(stream);
+        if (mode === "mjpeg") {
+            el.src = url;
+            return;
+        }
+        if (el.hls) {
+            el.hls.destroy();
+            el.hls = null;
+        }
+        if (window.Hls && Hls.isSupported()) {
+            // lowLatencyMode uses blocking playlist reloads (_HLS_msn)
+            const hls = new Hls({
+                lowLatencyMode: true,
+                liveSyncDurationCount: liveSyncCount,
+            });
+            hls.loadSource(url);
+            hls.attachMedia(el);
+            el.hls = hls;
+        } else if (el.canPlayType("application/vnd.apple.mpegurl")) {
+            el.src = url;
+        } else {
+            el.outerHTML = "<p style='color:white'>HLS not supported.</p>";
+        }
+    }
+
+    // Enlarged tiles switch to the main stream, back to the tile's own when shrunk
+    function toggle(el) {
+        const enlarged = el.classList.toggle("enlarged");
+        if (el.dataset.stream !== el.dataset.main) {
+            play(el, enlarged ? el.dataset.main : el.dataset.stream);
+        }
+    }
+
+    wall.querySelectorAll("video, img").forEach(el => {
+        if (mode !== "mjpeg") {
+            play(el, el.dataset.stream);
+        }
+        el.addEventListener("click", () => toggle(el));
+    });
+})();
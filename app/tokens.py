@@ -1,10 +1,17 @@
 import os
+import time
 import sqlite3
 import secrets
 import datetime
+import threading
+from collections import OrderedDict
 from flask import g, current_app
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from .access_log import AccessLogWriter
+from .connections import ConnectionManager
+from .metrics import observe_db
+
 
 # Path to SQLite DB (adjust if yours is different)
 DB_PATH = os.path.join(
@@ -15,83 +22,55 @@ DB_PATH = os.path.join(
 
 def get_db():
     """
-    Get a per-request SQLite connection with:
-    - timeout to reduce 'database is locked'
+    Get the SQLite connection for this request:
+    - reused per thread (see ConnectionManager), WAL + tuned pragmas
+    - lock waits up to DB_TIMEOUT seconds, counted in db_stats()
     - row_factory=Row for dict-like access
     """
     if "db" not in g:
-        g.db = sqlite3.connect(
-            DB_PATH,
-            timeout=10,              # wait up to 10s if locked
-            check_same_thread=False, # allow use across threads (gunicorn workers)
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = current_app.extensions["db"].connection()
     return g.db
 
 
 def close_db(e=None):
-    db = g.pop("db", None)
-    if db is not None:
-        db.close()
+    # The connection stays open for the next request on this thread;
+    # only an unfinished transaction is rolled back.
+    if g.pop("db", None) is not None:
+        current_app.extensions["db"].release()
 
 
-def init_app(app):
+def db_stats():
     """
-    Call this from create_app() so teardown happens automatically.
+    Connection acquire and lock-wait counters for this process.
     """
-    app.teardown_appcontext(close_db)
+    return current_app.extensions["db"].stats.snapshot()
 
 
-def init_db():
+def init_app(app):
     """
-    Create tables if they do not exist.
-    You can delete the old nvrwall.db once to reset to this schema.
+    Call this from create_app() so teardown happens automatically.
     """
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    db = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False)
-    db.row_factory = sqlite3.Row
-    cur = db.cursor()
-
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS tokens (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            token TEXT UNIQUE NOT NULL,
-            description TEXT,
-            created_at TEXT NOT NULL,
-            expires_at TEXT,
-            revoked INTEGER NOT NULL DEFAULT 0,
-            last_used_at TEXT
-        )
-        """
+    app.teardown_appcontext(close_db)
+    app.extensions["db"] = ConnectionManager(
+        DB_PATH,
+        timeout=app.config.get("DB_TIMEOUT", 10),
+        mmap_size=app.config.get("DB_MMAP_SIZE", 64 * 1024 * 1024),
+        cache_size_kib=app.config.get("DB_CACHE_SIZE_KIB", 8192),
+        statement_cache=app.config.get("DB_STATEMENT_CACHE", 256),
     )
-
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS access_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            token_id INTEGER,
-            path TEXT,
-            ip TEXT,
-            user_agent TEXT,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY(token_id) REFERENCES tokens(id)
-        )
-        """
+    app.extensions["token_cache"] = TokenCache(
+        max_size=app.config.get("TOKEN_CACHE_SIZE", 1024),
+        ttl=app.config.get("TOKEN_CACHE_TTL", 60),
+        generation_interval=app.config.get("TOKEN_REVOCATION_DELAY", 5),
     )
-    
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS settings (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-        """
+    app.extensions["access_log"] = AccessLogWriter(
+        app.extensions["db"].connection,
+        flush_interval=app.config.get("ACCESS_LOG_FLUSH_MS", 500) / 1000.0,
+        batch_size=app.config.get("ACCESS_LOG_BATCH_SIZE", 200),
+        max_pending=app.config.get("ACCESS_LOG_MAX_PENDING", 10000),
+        overflow=app.config.get("ACCESS_LOG_OVERFLOW", "coalesce"),
     )
 
-    db.commit()
-    db.close()
-
 
 # ---- Admin password operations ------------------------------------------------
 def set_admin_password(password: str) -> None:
@@ -104,15 +83,6 @@ def set_admin_password(password: str) -> None:
     db.row_factory = sqlite3.Row
     cur = db.cursor()
 
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS settings (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-        """
-    )
-
     pwd_hash = generate_password_hash(password)
 
     # Upsert into settings
@@ -134,14 +104,6 @@ def get_admin_password_hash():
     Return stored admin password hash or None if not set.
     """
     db = get_db()
-    db.execute(
-        """
-        CREATE TABLE IF NOT EXISTS settings (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-        """
-    )
     row = db.execute(
         "SELECT value FROM settings WHERE key = 'admin_password_hash'"
     ).fetchone()
@@ -160,6 +122,97 @@ def verify_admin_password(password: str) -> bool:
     return check_password_hash(stored, password)
 
 
+# ---- Token validation cache --------------------------------------------------
+class TokenCache:
+    """
+    Bounded LRU of validated tokens: token -> (token_id, expires_at).
+
+    - entries are trusted for `ttl` seconds, then re-read from the DB
+    - every `generation_interval` seconds the token generation counter in
+      `settings` is compared; any create/revoke in another worker bumps it
+      and drops this cache, so a revoke is seen within that interval
+    """
+
+    def __init__(self, max_size=1024, ttl=60, generation_interval=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation_interval = generation_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self._generation_checked_at = float("-inf")
+
+    def get(self, token):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                return None
+            if entry[2] <= now:
+                del self._entries[token]
+                return None
+            self._entries.move_to_end(token)
+            return entry[0], entry[1]
+
+    def put(self, token, token_id, expires_at):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[token] = (token_id, expires_at, time.monotonic() + self.ttl)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def check_generation(self, db):
+        """
+        Drop all entries if the DB generation changed since the last check.
+        Only touches the DB once per `generation_interval`; returns True
+        when it did.
+        """
+        now = time.monotonic()
+        if now - self._generation_checked_at < self.generation_interval:
+            return False
+        self._generation_checked_at = now
+        generation = _read_token_generation(db)
+        if generation != self._generation:
+            self.clear()
+            self._generation = generation
+        return True
+
+
+def _token_cache():
+    return current_app.extensions.get("token_cache")
+
+
+def _read_token_generation(db):
+    row = db.execute(
+        "SELECT value FROM settings WHERE key = 'token_generation'"
+    ).fetchone()
+    return row["value"] if row else None
+
+
+def _bump_token_generation(db):
+    """
+    Bump the cross-worker token generation counter (caller commits).
+    """
+    db.execute(
+        """
+        INSERT INTO settings (key, value) VALUES ('token_generation', '1')
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+        """
+    )
+
+
+def _invalidate_token_cache():
+    cache = _token_cache()
+    if cache is not None:
+        cache.clear()
+
+
 # ---- Token operations --------------------------------------------------------
 def create_token(description: str, days_valid: int | None = None) -> str:
     """
@@ -182,18 +235,36 @@ def create_token(description: str, days_valid: int | None = None) -> str:
         """,
         (token, description, now.isoformat(), expires_at),
     )
+    _bump_token_generation(db)
     db.commit()
+    _invalidate_token_cache()
     return token
 
 
 def is_token_valid(token: str | None) -> int | None:
     """
     Return token_id if valid (exists, not revoked, not expired), else None.
+
+    Valid tokens are served from the in-process TokenCache; only misses
+    (and the periodic generation check) hit the DB.
     """
     if not token:
         return None
 
     db = get_db()
+    cache = _token_cache()
+    if cache is not None:
+        started = time.perf_counter()
+        if cache.check_generation(db):
+            observe_db("token_generation", time.perf_counter() - started)
+        hit = cache.get(token)
+        if hit is not None:
+            token_id, exp = hit
+            if exp is not None and datetime.datetime.utcnow() > exp:
+                return None
+            return token_id
+
+    started = time.perf_counter()
     row = db.execute(
         """
         SELECT id, revoked, expires_at
@@ -202,6 +273,7 @@ def is_token_valid(token: str | None) -> int | None:
         """,
         (token,),
     ).fetchone()
+    observe_db("token_lookup", time.perf_counter() - started)
 
     if row is None:
         return None
@@ -209,6 +281,7 @@ def is_token_valid(token: str | None) -> int | None:
     if row["revoked"]:
         return None
 
+    exp = None
     if row["expires_at"]:
         try:
             exp = datetime.datetime.fromisoformat(row["expires_at"])
@@ -219,6 +292,8 @@ def is_token_valid(token: str | None) -> int | None:
             # bad date stored; treat as invalid
             return None
 
+    if cache is not None:
+        cache.put(token, row["id"], exp)
     return row["id"]
 
 
@@ -228,19 +303,196 @@ def revoke_token(token_id: int) -> None:
     """
     db = get_db()
     db.execute("UPDATE tokens SET revoked = 1 WHERE id = ?", (token_id,))
+    _bump_token_generation(db)
     db.commit()
+    _invalidate_token_cache()
 
 
-def list_tokens():
+# ---- Bulk token operations ---------------------------------------------------
+def _token_selection(ids=None, tokens=None, description_like=None):
+    """
+    (WHERE clause, params) matching any of `ids`, `tokens` (token strings)
+    or descriptions LIKE `description_like`. Raises ValueError if nothing
+    is selected.
+    """
+    where = []
+    params = []
+    if ids:
+        where.append(f"id IN ({','.join('?' * len(ids))})")
+        params += [int(i) for i in ids]
+    if tokens:
+        where.append(f"token IN ({','.join('?' * len(tokens))})")
+        params += [str(t) for t in tokens]
+    if description_like:
+        where.append("description LIKE ?")
+        params.append(description_like)
+    if not where:
+        raise ValueError("select tokens by ids, tokens or description_like")
+    return "(" + " OR ".join(where) + ")", params
+
+
+def _missing(rows, ids=None, tokens=None):
+    """
+    The requested ids and token strings that matched no row.
     """
-    Return all tokens with derived fields:
-    - last_access_at from access_logs
+    found_ids = {r["id"] for r in rows}
+    found_tokens = {r["token"] for r in rows}
+    return {
+        "ids": [i for i in ids or () if int(i) not in found_ids],
+        "tokens": [t for t in tokens or () if t not in found_tokens],
+    }
+
+
+def _write(db, statements):
+    """
+    Run `statements(db)` in one IMMEDIATE transaction with a single token
+    generation bump and commit; returns its result.
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        result = statements(db)
+        _bump_token_generation(db)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    _invalidate_token_cache()
+    return result
+
+
+def create_tokens(specs) -> list[dict]:
+    """
+    Create many tokens in one transaction.
+
+    specs: iterable of {"description": str, "days_valid": int | None}
+    Returns [{"id", "token", "description", "expires_at"}] in order.
+    """
+    now = datetime.datetime.utcnow()
+    rows = []
+    for spec in specs:
+        days_valid = spec.get("days_valid")
+        expires_at = None
+        if days_valid:
+            expires_at = (now + datetime.timedelta(days=int(days_valid))).isoformat()
+        rows.append({
+            "token": secrets.token_urlsafe(48),
+            "description": spec.get("description", ""),
+            "expires_at": expires_at,
+        })
+
+    def insert(db):
+        for row in rows:
+            cur = db.execute(
+                """
+                INSERT INTO tokens (token, description, created_at, expires_at, revoked)
+                VALUES (?, ?, ?, ?, 0)
+                """,
+                (row["token"], row["description"], now.isoformat(), row["expires_at"]),
+            )
+            row["id"] = cur.lastrowid
+        return rows
+
+    if not rows:
+        return []
+    return _write(get_db(), insert)
+
+
+def revoke_tokens(ids=None, tokens=None, description_like=None):
+    """
+    Revoke every selected token (see _token_selection) in one transaction.
+
+    Returns (rows, missing): [{"id", "description"}] of the matched tokens
+    (already revoked ones included) and the ids/tokens that matched none.
+    """
+    where, params = _token_selection(ids, tokens, description_like)
+
+    def update(db):
+        return db.execute(
+            f"UPDATE tokens SET revoked = 1 WHERE {where} RETURNING id, token, description",
+            params,
+        ).fetchall()
+
+    rows = sorted(_write(get_db(), update), key=lambda r: r["id"])
+    return (
+        [{"id": r["id"], "description": r["description"]} for r in rows],
+        _missing(rows, ids, tokens),
+    )
+
+
+def extend_tokens(days: int, ids=None, tokens=None, description_like=None):
+    """
+    Push back the expiry of every selected, unrevoked, expiring token by
+    `days` (counted from now if it already expired), in one transaction.
+    Tokens without an expiry keep none.
+
+    Returns (rows, missing): [{"id", "description", "expires_at",
+    "revoked"}] of all matched tokens after the update, and the ids/tokens
+    that matched none.
+    """
+    where, params = _token_selection(ids, tokens, description_like)
+    now_iso = datetime.datetime.utcnow().isoformat()
+
+    def update(db):
+        db.execute(
+            f"""
+            UPDATE tokens
+            SET expires_at = strftime('%Y-%m-%dT%H:%M:%f', max(expires_at, ?), ?)
+            WHERE revoked = 0 AND expires_at IS NOT NULL AND {where}
+            """,
+            (now_iso, f"+{int(days)} days", *params),
+        )
+        return db.execute(
+            f"""
+            SELECT id, token, description, expires_at, revoked FROM tokens
+            WHERE {where} ORDER BY id
+            """,
+            params,
+        ).fetchall()
+
+    rows = _write(get_db(), update)
+    return (
+        [
+            {
+                "id": r["id"],
+                "description": r["description"],
+                "expires_at": r["expires_at"],
+                "revoked": bool(r["revoked"]),
+            }
+            for r in rows
+        ],
+        _missing(rows, ids, tokens),
+    )
+
+
+def list_tokens(search: str | None = None, before_id: int | None = None,
+                limit: int | None = None):
+    """
+    Return tokens, newest first, with derived fields:
+    - last_access_at (denormalized tokens.last_used_at)
     - is_expired flag
+
+    search: substring of the description, or prefix of the token
+    before_id: keyset cursor; only tokens with id < before_id
+    limit: page size (None = all)
     """
     db = get_db()
     now_iso = datetime.datetime.utcnow().isoformat()
-    rows = db.execute(
-        """
+
+    where = []
+    params = [now_iso]
+    if search:
+        pattern = (
+            search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        )
+        where.append(
+            "(t.description LIKE ? ESCAPE '\\' OR t.token LIKE ? ESCAPE '\\')"
+        )
+        params += [f"%{pattern}%", f"{pattern}%"]
+    if before_id is not None:
+        where.append("t.id < ?")
+        params.append(before_id)
+
+    sql = """
         SELECT
             t.id,
             t.token,
@@ -249,39 +501,31 @@ def list_tokens():
             t.expires_at,
             t.revoked,
             t.last_used_at,
-            (
-              SELECT MAX(created_at)
-              FROM access_logs al
-              WHERE al.token_id = t.id
-            ) AS last_access_at,
+            t.last_used_at AS last_access_at,
             CASE
               WHEN t.expires_at IS NOT NULL AND t.expires_at < ? THEN 1
               ELSE 0
             END AS is_expired
         FROM tokens t
-        ORDER BY t.created_at DESC
-        """,
-        (now_iso,),
-    ).fetchall()
-    return rows
+    """
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY t.id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+
+    return db.execute(sql, params).fetchall()
 
 
 def log_access(token_id: int, path: str, ip: str | None, user_agent: str | None):
     """
     Log token usage and update last_used_at on the token.
+
+    The record is queued for the background AccessLogWriter; this never
+    touches the DB in the request.
     """
-    db = get_db()
     now_iso = datetime.datetime.utcnow().isoformat()
-
-    db.execute(
-        """
-        INSERT INTO access_logs (token_id, path, ip, user_agent, created_at)
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        (token_id, path, ip, user_agent, now_iso),
+    current_app.extensions["access_log"].submit(
+        token_id, path, ip, user_agent, now_iso
     )
-    db.execute(
-        "UPDATE tokens SET last_used_at = ? WHERE id = ?",
-        (now_iso, token_id),
-    )
-    db.commit()
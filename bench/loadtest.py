@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+"""
+Load-test the HLS path with simulated wall viewers.
+
+- a packager thread keeps a synthetic HLS_DIR rolling: one segment per
+  channel every --segment-seconds, a sliding playlist of --list-size
+- tokens are minted with create_token (one per simulated wall)
+- each viewer behaves like one hls.js tile: loads /wall once for the grant
+  cookie, then reloads /hls/<ch>.m3u8?token=... (after a target duration
+  when it got a new segment, half of one otherwise) and fetches each new
+  segment, starting --live-sync segments behind live
+
+By default the app runs here in --workers pre-forked processes (threaded
+werkzeug servers sharing one listening socket, like gunicorn), so SQLite
+sees real cross-process contention and server CPU can be measured apart
+from the clients. With --url the load goes to a running server instead;
+--db and --hls-dir must then be that server's, and CPU is not reported.
+
+Reported: p50/p99 latency per request kind, throughput, HTTP errors, DB
+lock waits/timeouts (from /metrics) and server CPU per request. --json
+writes the results with the commit and parameters; --baseline compares
+against such a file and exits 1 on a regression beyond --tolerance.
+
+    python bench/loadtest.py --viewers 64 --duration 30 --workers 2 --json run.json
+    python bench/loadtest.py --viewers 64 --duration 30 --workers 2 --baseline run.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import signal
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+import multiprocessing
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app.tokens as tokens  # noqa: E402
+from app import create_app  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KINDS = ("wall", "playlist", "segment")
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+# ---- synthetic packager -------------------------------------------------------
+class Packager:
+    """
+    Rolls `<ch>.m3u8` + `<ch>_<seq>.ts` for every channel, the way the
+    ffmpeg HLS muxer does (segment first, then playlist via rename).
+    """
+
+    def __init__(self, hls_dir, channels, segment_seconds, list_size, segment_kb):
+        self.hls_dir = hls_dir
+        self.channels = channels
+        self.segment_seconds = segment_seconds
+        self.list_size = list_size
+        self.payload = os.urandom(segment_kb * 1024)
+        self.seq = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _write(self, seq):
+        first = max(0, seq - self.list_size + 1)
+        target = max(1, round(self.segment_seconds))
+        for ch in self.channels:
+            with open(os.path.join(self.hls_dir, f"{ch}_{seq}.ts"), "wb") as f:
+                f.write(self.payload)
+            lines = [
+                "#EXTM3U",
+                "#EXT-X-VERSION:3",
+                f"#EXT-X-TARGETDURATION:{target}",
+                f"#EXT-X-MEDIA-SEQUENCE:{first}",
+            ]
+            for n in range(first, seq + 1):
+                lines += [f"#EXTINF:{self.segment_seconds:.3f},", f"{ch}_{n}.ts"]
+            path = os.path.join(self.hls_dir, f"{ch}.m3u8")
+            with open(f"{path}.tmp", "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(f"{path}.tmp", path)
+            # Keep a couple of unlisted segments for slow viewers
+            try:
+                os.unlink(os.path.join(self.hls_dir, f"{ch}_{first - 3}.ts"))
+            except FileNotFoundError:
+                pass
+
+    def start(self):
+        for _ in range(self.list_size):
+            self._write(self.seq)
+            self.seq += 1
+        self._thread = threading.Thread(target=self._run, name="packager", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        next_at = time.monotonic() + self.segment_seconds
+        while not self._stop.wait(max(0.0, next_at - time.monotonic())):
+            self._write(self.seq)
+            self.seq += 1
+            next_at += self.segment_seconds
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+# ---- server -------------------------------------------------------------------
+def serve(sock_fd, db_path, cpu_path):
+    """
+    One pre-forked worker: a threaded werkzeug server on the shared socket.
+    On SIGTERM it records its CPU time and exits.
+    """
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    tokens.DB_PATH = db_path
+    app = create_app()
+    server = make_server("127.0.0.1", 0, app, threaded=True, fd=sock_fd)
+    cpu_start = time.process_time()
+
+    def _term(signum, frame):
+        with open(cpu_path, "w") as f:
+            f.write(str(time.process_time() - cpu_start))
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, _term)
+    server.serve_forever()
+
+
+class Workers:
+    def __init__(self, count, db_path, workdir):
+        self.count = count
+        self.db_path = db_path
+        self.workdir = workdir
+        self.procs = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(1024)
+        self.port = self.sock.getsockname()[1]
+
+    def start(self):
+        ctx = multiprocessing.get_context("fork")
+        for n in range(self.count):
+            proc = ctx.Process(
+                target=serve,
+                args=(self.sock.fileno(), self.db_path, os.path.join(self.workdir, f"cpu-{n}")),
+                daemon=True,
+            )
+            proc.start()
+            self.procs.append(proc)
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=5)
+                conn.request("GET", "/health")
+                if conn.getresponse().status == 200:
+                    conn.close()
+                    return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise SystemExit("workers did not start")
+                time.sleep(0.1)
+
+    def stop(self):
+        """
+        Total CPU seconds the workers spent serving.
+        """
+        cpu = 0.0
+        for n, proc in enumerate(self.procs):
+            proc.terminate()
+            proc.join(10)
+            try:
+                with open(os.path.join(self.workdir, f"cpu-{n}")) as f:
+                    cpu += float(f.read())
+            except (OSError, ValueError):
+                return None
+        self.sock.close()
+        return cpu
+
+
+# ---- viewers ------------------------------------------------------------------
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = {kind: [] for kind in KINDS}
+        self.bytes = 0
+        self.errors = {}
+
+    def add(self, kind, seconds, status, nbytes):
+        with self._lock:
+            self.latency[kind].append(seconds)
+            self.bytes += nbytes
+            if status >= 400 or status == 0:
+                key = f"{kind}:{status or 'conn'}"
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+
+class Viewer(threading.Thread):
+    """
+    One hls.js tile: a keep-alive connection with its own cookie jar.
+    """
+
+    def __init__(self, host, port, token, stream, live_sync, stats, stop):
+        super().__init__(daemon=True)
+        self.host = host
+        self.port = port
+        self.token = token
+        self.stream = stream
+        self.live_sync = live_sync
+        self.stats = stats
+        self.stop = stop
+        self.cookies = SimpleCookie()
+        self.conn = None
+
+    def get(self, kind, path):
+        headers = {"User-Agent": "nvrwall-loadtest"}
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={m.value}" for k, m in self.cookies.items())
+        started = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            self.conn.request("GET", path, headers=headers)
+            resp = self.conn.getresponse()
+            body = resp.read()
+        except (OSError, http.client.HTTPException):
+            self.stats.add(kind, time.perf_counter() - started, 0, 0)
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+            return 0, b""
+        self.stats.add(kind, time.perf_counter() - started, resp.status, len(body))
+        for value in resp.headers.get_all("Set-Cookie") or ():
+            self.cookies.load(value)
+        return resp.status, body
+
+    def run(self):
+        self.get("wall", f"/wall?token={self.token}")
+        next_seq = None
+        while not self.stop.is_set():
+            status, body = self.get("playlist", f"/hls/{self.stream}.m3u8?token={self.token}")
+            target, segments = parse_playlist(body) if status == 200 else (2.0, [])
+            if next_seq is None and segments:
+                next_seq = segments[max(0, len(segments) - self.live_sync)][0]
+            new = [(seq, uri) for seq, uri in segments if next_seq is not None and seq >= next_seq]
+            for seq, uri in new:
+                if self.stop.is_set():
+                    break
+                self.get("segment", f"/hls/{uri}")
+                next_seq = seq + 1
+            # hls.js: a full target duration after a change, half otherwise
+            self.stop.wait(target if new else target / 2)
+        if self.conn is not None:
+            self.conn.close()
+
+
+def parse_playlist(body):
+    target, seq, segments = 2.0, 0, []
+    for line in body.decode(errors="replace").splitlines():
+        if line.startswith("#EXT-X-TARGETDURATION:"):
+            target = float(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            seq = int(line.split(":", 1)[1])
+        elif line and not line.startswith("#"):
+            segments.append((seq, line))
+            seq += 1
+    return target, segments
+
+
+# ---- results ------------------------------------------------------------------
+_METRIC = re.compile(r'^(nvrwall_[a-z_]+)(\{[^}]*\})? ([0-9.eE+-]+)$')
+
+
+def scrape_db_metrics(host, port):
+    """
+    Lock waits/timeouts and DB time summed over all workers, from /metrics.
+    """
+    conn = http.client.HTTPConnection(host, port, timeout=10)
+    try:
+        conn.request("GET", "/metrics")
+        resp = conn.getresponse()
+        text = resp.read().decode()
+    except OSError:
+        return {}
+    finally:
+        conn.close()
+    if resp.status != 200:
+        return {}
+    out = {}
+    for line in text.splitlines():
+        m = _METRIC.match(line)
+        if m is None:
+            continue
+        name, labels, value = m.group(1), m.group(2) or "", float(m.group(3))
+        if name in ("nvrwall_db_lock_waits_total", "nvrwall_db_lock_timeouts_total",
+                    "nvrwall_db_lock_wait_seconds_total", "nvrwall_workers"):
+            out[name[len("nvrwall_"):]] = value
+        elif name in ("nvrwall_db_query_seconds_sum", "nvrwall_db_query_seconds_count"):
+            op = re.search(r'op="([^"]+)"', labels).group(1)
+            out.setdefault("db_query", {}).setdefault(op, {})[name.rsplit("_", 1)[1]] = value
+        elif name == "nvrwall_access_log_records_total":
+            outcome = re.search(r'outcome="([^"]+)"', labels).group(1)
+            out[f"access_log_{outcome}"] = value
+    return out
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(stats, elapsed, cpu, db):
+    total = sum(len(v) for v in stats.latency.values())
+    result = {
+        "requests": total,
+        "req_s": total / elapsed,
+        "mb_s": stats.bytes / elapsed / 1e6,
+        "errors": dict(sorted(stats.errors.items())),
+        "cpu_seconds": cpu,
+        "cpu_ms_per_request": 1000 * cpu / total if cpu is not None and total else None,
+        "db": db,
+        "latency_ms": {},
+    }
+    for kind in KINDS:
+        samples = stats.latency[kind]
+        result["latency_ms"][kind] = {
+            "count": len(samples),
+            "p50": 1000 * percentile(samples, 50),
+            "p99": 1000 * percentile(samples, 99),
+            "max": 1000 * max(samples, default=0.0),
+        }
+    return result
+
+
+def print_result(result):
+    print(f"{'kind':<10}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind, lat in result["latency_ms"].items():
+        print(f"{kind:<10}{lat['count']:>8}{lat['p50']:>10.2f}{lat['p99']:>10.2f}{lat['max']:>10.2f}")
+    print(f"throughput: {result['req_s']:.1f} req/s, {result['mb_s']:.1f} MB/s")
+    if result["cpu_ms_per_request"] is not None:
+        print(f"server CPU: {result['cpu_seconds']:.2f} s, {result['cpu_ms_per_request']:.3f} ms/request")
+    db = result["db"]
+    if db:
+        print(
+            f"db: {db.get('lock_waits_total', 0):.0f} lock waits "
+            f"({db.get('lock_wait_seconds_total', 0):.3f} s), "
+            f"{db.get('lock_timeouts_total', 0):.0f} lock timeouts"
+        )
+    print(f"errors: {result['errors'] or 'none'}")
+
+
+# Lower is better for all of these
+COMPARED = (
+    ("playlist p99 ms", lambda r: r["latency_ms"]["playlist"]["p99"]),
+    ("segment p99 ms", lambda r: r["latency_ms"]["segment"]["p99"]),
+    ("cpu ms/request", lambda r: r["cpu_ms_per_request"]),
+)
+
+
+def compare(result, baseline, tolerance):
+    """
+    Print the change against `baseline`; True if anything regressed by
+    more than `tolerance` (a fraction), or errors appeared.
+    """
+    if baseline["params"] != result["params"]:
+        print("warning: baseline was run with different parameters")
+    regressed = False
+    print(f"\nvs {baseline.get('commit') or 'baseline'}:")
+    for label, get in COMPARED:
+        old, new = get(baseline), get(result)
+        if old is None or new is None or old <= 0:
+            continue
+        change = (new - old) / old
+        flag = ""
+        if change > tolerance:
+            flag = "  REGRESSION"
+            regressed = True
+        print(f"  {label:<16}{old:>10.3f} -> {new:>10.3f}  {100 * change:+6.1f}%{flag}")
+    if sum(result["errors"].values()) > sum(baseline["errors"].values()):
+        print("  more errors than baseline  REGRESSION")
+        regressed = True
+    return regressed
+
+
+def parse_config(items):
+    config = {}
+    for item in items:
+        key, _, value = item.partition("=")
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--viewers", type=int, default=32, help="simulated hls.js tiles")
+    parser.add_argument("--walls", type=int, default=8, help="tokens; viewers are spread over them")
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--segment-seconds", type=float, default=2.0)
+    parser.add_argument("--segment-kb", type=int, default=256)
+    parser.add_argument("--list-size", type=int, default=6)
+    parser.add_argument("--live-sync", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--config", action="append", default=[], metavar="KEY=JSON",
+                        help="app config override for the workers, e.g. TOKEN_CACHE_SIZE=0")
+    parser.add_argument("--url", help="load a running server instead (needs --db, --hls-dir)")
+    parser.add_argument("--db", help="that server's SQLite DB (tokens are minted there)")
+    parser.add_argument("--hls-dir", help="that server's HLS_DIR (synthetic streams go there)")
+    parser.add_argument("--json", help="write results here")
+    parser.add_argument("--baseline", help="compare with a previous --json")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    if args.url and not (args.db and args.hls_dir):
+        parser.error("--url needs --db and --hls-dir")
+
+    workdir = tempfile.mkdtemp(prefix="nvrwall-loadtest-")
+    hls_dir = args.hls_dir or os.path.join(workdir, "hls")
+    os.makedirs(hls_dir, exist_ok=True)
+    channels = [f"ch{n}" for n in range(1, args.channels + 1)]
+
+    config = {
+        "HLS_DIR": hls_dir,
+        "HLS_CHANNELS": channels,
+        "MJPEG_SHARED_DIR": os.path.join(workdir, "shm"),
+        "METRICS_PUBLISH_INTERVAL": 0.2,
+        # Walls load hls.js; don't depend on it being vendored in this checkout
+        "HLS_JS_CDN": True,
+    }
+    config.update(parse_config(args.config))
+    settings = os.path.join(workdir, "settings.py")
+    with open(settings, "w") as f:
+        for key, value in config.items():
+            f.write(f"{key} = {value!r}\n")
+    os.environ["NVRWALL_SETTINGS"] = settings
+
+    tokens.DB_PATH = args.db or os.path.join(workdir, "nvrwall.db")
+    app = create_app()
+    with app.app_context():
+        wall_tokens = [tokens.create_token(f"loadtest wall {n}") for n in range(args.walls)]
+
+    packager = Packager(hls_dir, channels, args.segment_seconds, args.list_size, args.segment_kb)
+    packager.start()
+
+    workers = None
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        workers = Workers(args.workers, tokens.DB_PATH, workdir)
+        workers.start()
+        host, port = "127.0.0.1", workers.port
+
+    stats = Stats()
+    stop = threading.Event()
+    viewers = [
+        Viewer(host, port, wall_tokens[n % args.walls], channels[n % args.channels],
+               args.live_sync, stats, stop)
+        for n in range(args.viewers)
+    ]
+    started = time.perf_counter()
+    for viewer in viewers:
+        viewer.start()
+    time.sleep(args.duration)
+    stop.set()
+    for viewer in viewers:
+        viewer.join()
+    elapsed = time.perf_counter() - started
+    packager.stop()
+
+    time.sleep(0.3)  # let every worker publish its last metrics
+    db = scrape_db_metrics(host, port)
+    cpu = workers.stop() if workers is not None else None
+
+    result = summarize(stats, elapsed, cpu, db)
+    result["commit"] = git_commit()
+    result["params"] = {
+        key: getattr(args, key)
+        for key in ("viewers", "walls", "channels", "duration", "segment_seconds",
+                    "segment_kb", "list_size", "live_sync", "workers", "config", "url")
+    }
+    print_result(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if compare(result, json.load(f), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Compare HLS segment delivery modes (HLS_SEGMENT_DELIVERY).
+
+Runs the app in a threaded local HTTP server against a synthetic HLS_DIR
+and fetches segments with N concurrent clients. For each mode it reports:
+
+- req/s and MB/s seen by the clients
+- worker occupancy: time from the app receiving the request until its
+  response body has been fully handed to the server (mean / p99)
+
+In the x-accel / x-sendfile modes there is no proxy in front, so clients
+only receive the (empty) offload response; the interesting number there is
+how briefly a worker is held.
+
+    python bench/segment_delivery.py --clients 8 --requests 400 --size-kb 1024
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import http.client
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.serving import make_server  # noqa: E402
+
+import app.tokens as tokens  # noqa: E402
+from app import create_app  # noqa: E402
+from app.delivery import DELIVERY_MODES  # noqa: E402
+from app.signing import GRANT_COOKIE, issue_grant  # noqa: E402
+
+
+class OccupancyMiddleware:
+    """
+    Record how long each request keeps the WSGI app busy.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        body = self.wsgi_app(environ, start_response)
+        middleware = self
+
+        class _Body:
+            def __iter__(self):
+                return iter(body)
+
+            def close(self):
+                if hasattr(body, "close"):
+                    body.close()
+                with middleware._lock:
+                    middleware.samples.append(time.perf_counter() - started)
+
+        # Keep the server's file_wrapper fast path for "sendfile" mode
+        if isinstance(body, environ.get("wsgi.file_wrapper", ())):
+            with self._lock:
+                self.samples.append(time.perf_counter() - started)
+            return body
+        return _Body()
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_mode(mode, hls_dir, segments, clients, requests_total):
+    app = create_app()
+    app.config["HLS_DIR"] = hls_dir
+    app.config["HLS_SEGMENT_DELIVERY"] = mode
+    middleware = OccupancyMiddleware(app.wsgi_app)
+    app.wsgi_app = middleware
+    with app.app_context():
+        cookie = f"{GRANT_COOKIE}={issue_grant(1, ['ch1'], 3600)}"
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    port = server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    received = [0]
+    lock = threading.Lock()
+    per_client = requests_total // clients
+
+    def client(n):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        got = 0
+        for i in range(per_client):
+            conn.request(
+                "GET",
+                f"/hls/{segments[(n + i) % len(segments)]}",
+                headers={"Cookie": cookie},
+            )
+            resp = conn.getresponse()
+            got += len(resp.read())
+            if resp.status != 200:
+                raise SystemExit(f"{mode}: HTTP {resp.status}")
+        conn.close()
+        with lock:
+            received[0] += got
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+
+    done = per_client * clients
+    occ = middleware.samples
+    return {
+        "mode": mode,
+        "req_s": done / elapsed,
+        "mb_s": received[0] / elapsed / 1e6,
+        "occ_mean_ms": 1000 * sum(occ) / max(len(occ), 1),
+        "occ_p99_ms": 1000 * percentile(occ, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--segments", type=int, default=6)
+    parser.add_argument("--size-kb", type=int, default=1024)
+    parser.add_argument("--modes", default=",".join(DELIVERY_MODES))
+    args = parser.parse_args()
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    workdir = tempfile.mkdtemp(prefix="nvrwall-bench-")
+    tokens.DB_PATH = os.path.join(workdir, "nvrwall.db")
+    # As in the tests: don't depend on hls.js being vendored in this checkout
+    settings = os.path.join(workdir, "settings.py")
+    with open(settings, "w") as f:
+        f.write("HLS_JS_CDN = True\n")
+    os.environ["NVRWALL_SETTINGS"] = settings
+    hls_dir = os.path.join(workdir, "hls")
+    os.makedirs(hls_dir)
+    segments = []
+    for i in range(args.segments):
+        name = f"ch1_{i:05d}.ts"
+        with open(os.path.join(hls_dir, name), "wb") as f:
+            f.write(os.urandom(args.size_kb * 1024))
+        segments.append(name)
+
+    print(f"{'mode':<12}{'req/s':>10}{'MB/s':>10}{'occ mean ms':>14}{'occ p99 ms':>12}")
+    for mode in args.modes.split(","):
+        r = run_mode(mode, hls_dir, segments, args.clients, args.requests)
+        print(
+            f"{r['mode']:<12}{r['req_s']:>10.1f}{r['mb_s']:>10.1f}"
+            f"{r['occ_mean_ms']:>14.2f}{r['occ_p99_ms']:>12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark /wall latency: inline templates vs cached templates.
+
+- inline: the template source is passed to render_template_string on every
+  request (how the pages used to be rendered), so Jinja parses and compiles
+  it each time
+- cached: render_template; compiled once per process
+
+Both run the full request (token check, catalog, grant cookie) through the
+test client, so the difference is the template cost.
+
+    python bench/wall_render.py --requests 2000 --grid 4
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import flask  # noqa: E402
+
+import app.routes as routes  # noqa: E402
+import app.tokens as tokens  # noqa: E402
+from app import create_app  # noqa: E402
+from app.channels import save_channel  # noqa: E402
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def inline_render(name, **context):
+    """
+    Old behaviour: template source as a string, compiled per request.
+    """
+    source, _, _ = flask.current_app.jinja_loader.get_source(flask.current_app.jinja_env, name)
+    return flask.render_template_string(source, **context)
+
+
+def run(client, url, requests):
+    samples = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        resp = client.get(url)
+        samples.append(time.perf_counter() - started)
+        if resp.status_code != 200:
+            raise SystemExit(f"HTTP {resp.status_code}")
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--grid", type=int, default=2)
+    parser.add_argument("--mode", default="hls")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="nvrwall-bench-")
+    tokens.DB_PATH = os.path.join(workdir, "nvrwall.db")
+    app = create_app()
+    # Renders /wall; the CDN URL keeps it working without vendored hls.js
+    app.config["HLS_JS_CDN"] = True
+    client = app.test_client()
+    with app.test_request_context():
+        for i in range(1, 17):
+            save_channel(f"ch{i}", sub=f"ch{i}-sub", position=i)
+        token = tokens.create_token("bench")
+    url = f"/wall?token={token}&grid={args.grid}&mode={args.mode}"
+
+    cached_render = routes.render_template
+    print(f"{'templates':<10}{'req/s':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for label, render in (("inline", inline_render), ("cached", cached_render)):
+        routes.render_template = render
+        run(client, url, 50)  # warm up (token cache, catalog, first compile)
+        samples = run(client, url, args.requests)
+        total = sum(samples)
+        print(
+            f"{label:<10}{len(samples) / total:>10.1f}{1000 * total / len(samples):>10.3f}"
+            f"{1000 * percentile(samples, 50):>10.3f}{1000 * percentile(samples, 99):>10.3f}"
+        )
+    routes.render_template = cached_render
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+"""
+Run the RTSP -> HLS ingest supervisor (INGEST_CHANNELS) in the foreground.
+
+Use this under systemd when the web app runs with gunicorn --preload or
+on a different box than the packagers.
+"""
+import signal
+import logging
+
+from app import create_app
+from app.ingest import supervisor_from_config
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    app = create_app()
+    if not app.config["INGEST_CHANNELS"]:
+        print("INGEST_CHANNELS is empty; nothing to do.")
+        raise SystemExit(1)
+
+    supervisor = supervisor_from_config(app.config)
+
+    def _stop(signum, frame):
+        supervisor.stop()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    supervisor.run_forever()
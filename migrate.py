@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""
+Apply pending schema migrations to nvrwall.db (see app/migrations.py).
+
+Run this on deploy, before starting the workers; they only check the
+schema version. `--status` shows the version and what would be applied.
+"""
+import sys
+
+from app.tokens import DB_PATH
+from app.migrations import LATEST, SchemaError, current_version, migrate, pending
+
+if __name__ == "__main__":
+    version = current_version(DB_PATH)
+    if "--status" in sys.argv[1:]:
+        print(f"{DB_PATH}: schema version {version} (latest {LATEST})")
+        for n, description in pending(version):
+            print(f"  pending {n}: {description}")
+        raise SystemExit(0)
+
+    try:
+        applied = migrate(DB_PATH)
+    except SchemaError as exc:
+        print(exc)
+        raise SystemExit(1)
+    if applied:
+        print(f"{DB_PATH}: migrated from version {version} to {LATEST}")
+    else:
+        print(f"{DB_PATH}: up to date (version {LATEST})")
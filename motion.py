@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+"""
+Run the motion analyzer (RECORD_DIR, numpy) in the foreground: decode the
+recorded segments at low resolution, index motion into motion_events for
+/motion searches.
+
+Use this under systemd next to record.py; only one analyzer per archive
+runs at a time (others wait on the lock and take over).
+"""
+import signal
+import logging
+
+from app import create_app
+from app.motion import analyzer_from_config, np
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    app = create_app()
+    if not app.config["RECORD_DIR"]:
+        print("RECORD_DIR is not set; nothing to do.")
+        raise SystemExit(1)
+    if np is None:
+        print("numpy is not installed; motion analysis needs it.")
+        raise SystemExit(1)
+
+    analyzer = analyzer_from_config(app.config, app.extensions["db"].connection)
+
+    def _stop(signum, frame):
+        analyzer.stop()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    analyzer.run_forever()
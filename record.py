@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+"""
+Run the recorder (RECORD_DIR) in the foreground: archive live segments,
+catalog them for /vod/ and enforce the RECORD_MAX_* quotas.
+
+Use this under systemd next to ingest.py; only one recorder per archive
+runs at a time (others wait on the lock and take over).
+"""
+import signal
+import logging
+
+from app import create_app
+from app.recording import recorder_from_config
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    app = create_app()
+    if not app.config["RECORD_DIR"]:
+        print("RECORD_DIR is not set; nothing to do.")
+        raise SystemExit(1)
+
+    recorder = recorder_from_config(app.config, app.extensions["db"].connection)
+
+    def _stop(signum, frame):
+        recorder.stop()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    recorder.run_forever()
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 import getpass
 
-from app.tokens import init_db, set_admin_password
+from app.tokens import DB_PATH, set_admin_password
+from app.migrations import migrate
 
 if __name__ == "__main__":
     print("Set admin password for NVR wall web admin")
@@ -16,6 +17,6 @@ if __name__ == "__main__":
         print("Empty password not allowed. Aborting.")
         raise SystemExit(1)
 
-    init_db()
+    migrate(DB_PATH)
     set_admin_password(pwd1)
     print("Admin password updated successfully.")
@@ -0,0 +1,39 @@
+import pytest
+
+from app import create_app, tokens
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """
+    The app on a fresh database, with HLS_DIR and the shared dir under
+    tmp_path.
+    """
+    hls_dir = tmp_path / "hls"
+    hls_dir.mkdir()
+    settings = tmp_path / "settings.cfg"
+    settings.write_text(
+        f"HLS_DIR = {str(hls_dir)!r}\n"
+        f"MJPEG_SHARED_DIR = {str(tmp_path / 'shm')!r}\n"
+        "HLS_JS_CDN = True\n"
+        "HLS_PLAYLIST_INOTIFY = False\n"
+    )
+    monkeypatch.setenv("NVRWALL_SETTINGS", str(settings))
+    monkeypatch.setattr(tokens, "DB_PATH", str(tmp_path / "nvrwall.db"))
+    app = create_app()
+    app.config["TESTING"] = True
+    yield app
+    app.extensions["access_log"].stop()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def make_token(app):
+    def make(description="test", days_valid=None):
+        with app.app_context():
+            return tokens.create_token(description, days_valid)
+    return make
@@ -0,0 +1,61 @@
+import os
+import asyncio
+
+import pytest
+
+from app.asgi import AsyncApp, PREWAITED_KEY, wsgi_environ
+from app.signing import GRANT_COOKIE, issue_grant
+
+
+PLAYLIST = b"""#EXTM3U
+#EXT-X-VERSION:6
+#EXT-X-TARGETDURATION:2
+#EXT-X-MEDIA-SEQUENCE:10
+#EXTINF:2.0,
+seg10.ts
+"""
+
+
+@pytest.fixture
+def waits(app, monkeypatch):
+    with open(os.path.join(app.config["HLS_DIR"], "cam.m3u8"), "wb") as f:
+        f.write(PLAYLIST)
+    calls = []
+
+    async def wait_for_async(name, msn, part=None, timeout=None):
+        calls.append((name, msn))
+
+    monkeypatch.setattr(app.extensions["playlist_cache"], "wait_for_async", wait_for_async)
+    return calls
+
+
+def _prewait(app, query, cookie=None):
+    headers = [(b"cookie", f"{GRANT_COOKIE}={cookie}".encode())] if cookie else []
+    environ = wsgi_environ(
+        {"method": "GET", "path": "/hls/cam.m3u8", "query_string": query.encode(),
+         "headers": headers}, b""
+    )
+    asyncio.run(AsyncApp(app)._prewait_playlist(environ))
+    return environ
+
+
+def test_unauthorized_reload_is_not_held(app, waits):
+    environ = _prewait(app, "_HLS_msn=11&token=bogus")
+    assert waits == []
+    assert PREWAITED_KEY not in environ
+
+
+def test_token_reload_is_held(app, waits, make_token):
+    token = make_token()
+    environ = _prewait(app, f"_HLS_msn=11&token={token}")
+    assert waits == [("cam.m3u8", 11)]
+    assert environ[PREWAITED_KEY] is True
+
+
+def test_grant_reload_is_held(app, waits):
+    with app.app_context():
+        other = issue_grant(1, ["other"], 60)
+        grant = issue_grant(1, ["cam"], 60)
+    assert PREWAITED_KEY not in _prewait(app, "_HLS_msn=11", cookie=other)
+    assert _prewait(app, "_HLS_msn=11", cookie=grant)[PREWAITED_KEY] is True
+    assert waits == [("cam.m3u8", 11)]
@@ -0,0 +1,24 @@
+from app import assets, create_app, tokens
+
+
+def test_starts_without_vendored_hlsjs(tmp_path, monkeypatch):
+    monkeypatch.setattr(assets.AssetVersions, "exists", lambda self, filename: False)
+    settings = tmp_path / "stock.cfg"
+    settings.write_text(f"MJPEG_SHARED_DIR = {str(tmp_path / 'shm')!r}\n")
+    monkeypatch.setenv("NVRWALL_SETTINGS", str(settings))
+    monkeypatch.setattr(tokens, "DB_PATH", str(tmp_path / "nvrwall.db"))
+    app = create_app()
+    try:
+        assert not app.config["HLS_JS_CDN"]
+        assert app.test_client().get("/health").status_code == 200
+    finally:
+        app.extensions["access_log"].stop()
+
+
+def test_wall_needs_hlsjs(app, client, make_token, monkeypatch):
+    token = make_token()
+    assert assets.HLS_JS_CDN_URL in client.get(f"/wall?token={token}").get_data(as_text=True)
+
+    app.config["HLS_JS_CDN"] = False
+    monkeypatch.setattr(assets.AssetVersions, "exists", lambda self, filename: False)
+    assert client.get(f"/wall?token={token}").status_code == 503
@@ -0,0 +1,86 @@
+import pytest
+
+
+@pytest.fixture
+def admin(client):
+    with client.session_transaction() as session:
+        session["is_admin"] = True
+    return client
+
+
+def _create(admin, specs):
+    resp = admin.post("/tokens/bulk", json={"tokens": specs})
+    assert resp.status_code == 200
+    return resp.json["tokens"]
+
+
+def test_bulk_needs_admin(client):
+    assert client.post("/tokens/bulk", json={"tokens": [{"description": "x"}]}).status_code == 401
+    assert client.post("/tokens/bulk/revoke", json={"ids": [1]}).status_code == 401
+    assert client.get("/tokens").status_code == 401
+
+
+def test_bulk_create(admin):
+    created = _create(admin, [{"description": f"lobby-{i}", "days_valid": 1} for i in range(3)]
+                      + [{"description": "forever"}])
+    assert [t["description"] for t in created] == ["lobby-0", "lobby-1", "lobby-2", "forever"]
+    assert [t["id"] for t in created] == sorted(t["id"] for t in created)
+    assert created[0]["expires_at"] is not None and created[-1]["expires_at"] is None
+    assert admin.get(f"/wall?token={created[0]['token']}").status_code == 200
+
+
+def test_bulk_revoke_reports_not_found(admin):
+    created = _create(admin, [{"description": f"lobby-{i}"} for i in range(3)]
+                      + [{"description": "desk"}])
+    resp = admin.post("/tokens/bulk/revoke", json={
+        "description_like": "lobby-%",
+        "ids": [created[3]["id"], 99999],
+        "tokens": ["nope"],
+    })
+    assert resp.status_code == 200
+    assert [t["description"] for t in resp.json["revoked"]] == ["lobby-0", "lobby-1", "lobby-2", "desk"]
+    assert resp.json["not_found"] == {"ids": [99999], "tokens": ["nope"]}
+    for token in created:
+        assert admin.get(f"/wall?token={token['token']}").status_code == 401
+
+
+def test_bulk_extend(admin):
+    expiring, forever = _create(admin, [{"description": "a", "days_valid": 1}, {"description": "b"}])
+    revoked, = _create(admin, [{"description": "c", "days_valid": 1}])
+    admin.post("/tokens/bulk/revoke", json={"ids": [revoked["id"]]})
+
+    resp = admin.post("/tokens/bulk/extend", json={
+        "days": 10,
+        "ids": [expiring["id"], revoked["id"], 99999],
+        "tokens": [forever["token"]],
+    })
+    assert resp.status_code == 200
+    rows = {t["id"]: t for t in resp.json["tokens"]}
+    assert rows[expiring["id"]]["expires_at"][:10] > expiring["expires_at"][:10]
+    assert rows[forever["id"]]["expires_at"] is None
+    assert rows[revoked["id"]]["expires_at"] == revoked["expires_at"]
+    assert rows[revoked["id"]]["revoked"] is True
+    assert resp.json["not_found"] == {"ids": [99999], "tokens": []}
+
+
+@pytest.mark.parametrize("path, body", [
+    ("/tokens/bulk/revoke", {}),
+    ("/tokens/bulk/revoke", {"ids": ["a"]}),
+    ("/tokens/bulk/extend", {"days": "x", "ids": [1]}),
+    ("/tokens/bulk/extend", {"days": 0, "ids": [1]}),
+    ("/tokens/bulk", {"tokens": "x"}),
+])
+def test_bulk_rejects_bad_input(admin, path, body):
+    assert admin.post(path, json=body).status_code == 400
+
+
+def test_bulk_max(admin, app):
+    app.config["TOKENS_BULK_MAX"] = 2
+    assert admin.post("/tokens/bulk", json={"tokens": [{}] * 3}).status_code == 400
+    assert admin.post("/tokens/bulk/revoke", json={"ids": [1, 2, 3]}).status_code == 400
+
+
+def test_single_revoke_unknown_token(admin, make_token):
+    token = make_token()
+    assert admin.post("/tokens/revoke", json={"token": token}).status_code == 200
+    assert admin.post("/tokens/revoke", json={"token": "zz"}).status_code == 404
@@ -0,0 +1,33 @@
+import sqlite3
+
+from app import channels, create_app, migrations, tokens
+from app.tokens import get_db
+
+
+def test_seeded_once(app):
+    with app.app_context():
+        db = get_db()
+        assert [c.name for c in channels.get_catalog().channels] == list(app.config["HLS_CHANNELS"])
+        assert channels._read_channel_generation(db) is not None
+        for channel in channels.get_catalog().channels:
+            channels.delete_channel(channel.name)
+        assert channels.get_catalog().channels == []
+
+    # A restart must not bring deleted channels back
+    other = create_app()
+    try:
+        with other.app_context():
+            assert channels.get_catalog().channels == []
+    finally:
+        other.extensions["access_log"].stop()
+
+
+def test_existing_channels_are_not_seeded(tmp_path):
+    path = str(tmp_path / "nvrwall.db")
+    migrations.migrate(path)
+    with sqlite3.connect(path) as db:
+        db.execute("INSERT INTO channels (name, main_stream) VALUES ('gate', 'gate')")
+    channels.seed_channels(path, ["ch1", "ch2"])
+    with sqlite3.connect(path) as db:
+        assert db.execute("SELECT name FROM channels").fetchall() == [("gate",)]
+        assert db.execute("SELECT value FROM settings WHERE key = 'channels_seeded'").fetchone()
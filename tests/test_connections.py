@@ -0,0 +1,63 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from app.connections import ConnectionManager
+
+
+@pytest.fixture
+def manager(tmp_path):
+    manager = ConnectionManager(str(tmp_path / "t.db"), timeout=2)
+    db = manager.connection()
+    db.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, n INTEGER)")
+    db.execute("INSERT INTO t (n) VALUES (0)")
+    db.commit()
+    return manager
+
+
+def other_connection(manager):
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(db=manager.connection()))
+    thread.start()
+    thread.join()
+    return result["db"]
+
+
+def test_write_waits_for_the_lock(manager):
+    db = manager.connection()
+    other = other_connection(manager)
+    other.execute("UPDATE t SET n = n + 1")     # holds the write lock
+    threading.Timer(0.2, other.commit).start()
+
+    started = time.perf_counter()
+    db.execute("UPDATE t SET n = n + 1")
+    db.commit()
+    assert time.perf_counter() - started >= 0.15
+    assert db.execute("SELECT n FROM t").fetchone()[0] == 2
+    stats = manager.stats.snapshot()
+    assert stats["lock_waits"] == 1
+    assert stats["lock_timeouts"] == 0
+
+
+def test_stale_read_transaction_fails_fast(manager):
+    db = manager.connection()
+    other = other_connection(manager)
+    # Deferred transaction that reads first: its snapshot goes stale
+    db.execute("BEGIN")
+    db.execute("SELECT n FROM t").fetchone()
+    other.execute("UPDATE t SET n = 5")
+    other.commit()
+
+    started = time.perf_counter()
+    with pytest.raises(sqlite3.OperationalError):
+        db.execute("UPDATE t SET n = n + 1")
+    assert time.perf_counter() - started < 0.5   # no spinning until the timeout
+    db.rollback()
+    assert manager.stats.snapshot()["lock_conflicts"] == 1
+
+    # Started over, the write goes through
+    db.execute("UPDATE t SET n = n + 1")
+    db.commit()
+    assert db.execute("SELECT n FROM t").fetchone()[0] == 6
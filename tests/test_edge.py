@@ -0,0 +1,88 @@
+import time
+import asyncio
+import threading
+
+from app import edge
+from app.edge import EdgePlaylistCache
+
+
+def _playlist(last_msn):
+    lines = ["#EXTM3U", "#EXT-X-TARGETDURATION:2", "#EXT-X-MEDIA-SEQUENCE:10"]
+    for msn in range(10, last_msn + 1):
+        lines += ["#EXTINF:2.0,", f"seg{msn}.ts"]
+    return ("\n".join(lines) + "\n").encode()
+
+
+class FakeOrigin:
+    timeout = 1
+
+    def __init__(self):
+        self.responses = {}     # "plain" / "blocking" -> (status, body)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def get(self, path, params=None, with_token=False, timeout=None):
+        kind = "blocking" if params else "plain"
+        with self._lock:
+            self.calls.append(kind)
+        if kind == "blocking":
+            time.sleep(0.1)
+        status, body = self.responses[kind]
+        return status, {}, body
+
+
+def test_async_viewers_share_one_blocking_fetch(tmp_path):
+    origin = FakeOrigin()
+    origin.responses = {"plain": (200, _playlist(10)), "blocking": (200, _playlist(11))}
+    cache = EdgePlaylistCache(origin, str(tmp_path), ttl=60)
+    cache.get("cam.m3u8")
+    threads = []
+    wait_for = cache.wait_for
+
+    def counting_wait_for(*args):
+        threads.append(threading.current_thread())
+        return wait_for(*args)
+
+    cache.wait_for = counting_wait_for
+
+    async def main():
+        return await asyncio.gather(
+            *(cache.wait_for_async("cam.m3u8", 11) for _ in range(20))
+        )
+
+    results = asyncio.run(main())
+    assert all(p is not None and p.last_msn == 11 for p in results)
+    assert origin.calls.count("blocking") == 1
+    assert len(threads) == 1
+    assert cache._async_flights == {}
+
+
+def test_refused_edge_token_drops_playlist(tmp_path):
+    origin = FakeOrigin()
+    origin.forget_grant = lambda: origin.calls.append("forget")
+    origin.responses = {"plain": (200, _playlist(10))}
+    cache = EdgePlaylistCache(origin, str(tmp_path), ttl=0)
+    assert cache.get("cam.m3u8") is not None
+
+    origin.responses = {"plain": (401, b"")}
+    assert cache.get("cam.m3u8") is None
+    assert "forget" in origin.calls
+    assert cache._entries == {}
+
+
+def test_stale_playlist_served_for_bounded_time(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(edge.time, "monotonic", lambda: clock[0])
+    origin = FakeOrigin()
+    origin.responses = {"plain": (200, _playlist(10))}
+    cache = EdgePlaylistCache(origin, str(tmp_path), ttl=1, stale_max=30)
+    cache.get("cam.m3u8")
+
+    def down(*args, **kwargs):
+        raise edge.OriginError("down")
+
+    origin.get = down
+    clock[0] += 20
+    assert cache.get("cam.m3u8").last_msn == 10
+    clock[0] += 20
+    assert cache.get("cam.m3u8") is None
@@ -0,0 +1,66 @@
+import os
+import json
+import time
+
+from app import metrics
+
+
+def _dead_pid():
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    return pid
+
+
+def _requests(snaps):
+    total = {}
+    for snap in snaps:
+        for route, status, n in snap.get("requests", []):
+            total[(route, status)] = total.get((route, status), 0) + n
+    return total
+
+
+def test_dead_worker_totals_are_kept(tmp_path):
+    registry = metrics.Registry(str(tmp_path))
+    registry.observe_request("wall", 200, 0.01, 100)
+
+    dead = metrics.Registry(str(tmp_path))
+    dead.observe_request("wall", 200, 0.02, 50)
+    dead.observe_db("token_lookup", 0.001)
+    snap = dead.snapshot({"db_stats": {"lock_waits": 2}})
+    pid = _dead_pid()
+    (tmp_path / f"metrics-{pid}.json").write_text(json.dumps(snap))
+
+    snaps = registry.collect()
+    assert not (tmp_path / f"metrics-{pid}.json").exists()
+    assert _requests(snaps) == {("wall", 200): 2}
+    retired = [s for s in snaps if s.get("retired")]
+    assert retired[0]["db"]["token_lookup"]["count"] == 1
+    assert retired[0]["db_stats"] == {"lock_waits": 2}
+
+    # A second dead worker adds to the retired totals; nothing goes down
+    pid = _dead_pid()
+    (tmp_path / f"metrics-{pid}.json").write_text(json.dumps(snap))
+    snaps = registry.collect()
+    assert _requests(snaps) == {("wall", 200): 3}
+    retired = [s for s in snaps if s.get("retired")]
+    assert retired[0]["bytes"] == {"wall": 100}
+
+
+def test_publisher_writes_in_background(tmp_path):
+    registry = metrics.Registry(str(tmp_path), publish_interval=0.01,
+                                extra_fn=lambda: {"feeds": {"mjpeg:cam": 1}})
+    registry.observe_request("wall", 200, 0.01, 100)
+    registry.start_publisher()
+    registry.start_publisher()
+
+    path = tmp_path / f"metrics-{os.getpid()}.json"
+    for _ in range(500):
+        if path.exists():
+            break
+        time.sleep(0.01)
+    snap = json.loads(path.read_text())
+    assert snap["requests"] == [["wall", 200, 1]]
+    assert snap["feeds"] == {"mjpeg:cam": 1}
+    registry._publisher_pid = None  # stops the thread
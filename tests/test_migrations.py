@@ -0,0 +1,80 @@
+import sqlite3
+
+import pytest
+
+from app import migrations
+
+
+def _columns(path, table):
+    with sqlite3.connect(path) as db:
+        return {r[1] for r in db.execute(f"PRAGMA table_info({table})")}
+
+
+def _names(path, kind):
+    with sqlite3.connect(path) as db:
+        return {r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type = ?", (kind,))}
+
+
+@pytest.fixture
+def baseline(tmp_path):
+    """
+    A database from before versioning: the base tables only, with data,
+    at user_version 0.
+    """
+    path = str(tmp_path / "old.db")
+    db = sqlite3.connect(path)
+    migrations._base(db)
+    db.execute(
+        "INSERT INTO tokens (token, description, created_at) VALUES ('t1', 'old', '2024-01-01T00:00:00')"
+    )
+    db.execute(
+        "INSERT INTO access_logs (token_id, path, created_at) VALUES (1, '/wall', '2024-02-01T00:00:00')"
+    )
+    db.execute("INSERT INTO channels (name, main_stream) VALUES ('ch1', 'ch1')")
+    db.commit()
+    db.close()
+    return path
+
+
+def test_fresh_database(tmp_path):
+    path = str(tmp_path / "nvrwall.db")
+    assert migrations.current_version(path) == 0
+    assert migrations.migrate(path) == list(range(1, migrations.LATEST + 1))
+    assert migrations.current_version(path) == migrations.LATEST
+    assert {"tokens", "access_logs", "channels", "segments", "motion_events",
+            "motion_progress", "access_log_hourly"} <= _names(path, "table")
+    assert migrations.migrate(path) == []
+    migrations.check(path)
+
+
+def test_upgrade_from_baseline(baseline):
+    assert migrations.current_version(baseline) == 0
+    assert [n for n, _ in migrations.pending(0)] == list(range(1, migrations.LATEST + 1))
+
+    assert migrations.migrate(baseline) == list(range(1, migrations.LATEST + 1))
+    assert migrations.current_version(baseline) == migrations.LATEST
+    assert "low_stream" in _columns(baseline, "channels")
+    assert "tier" in _columns(baseline, "segments")
+    assert "idx_access_logs_token_created" in _names(baseline, "index")
+    with sqlite3.connect(baseline) as db:
+        assert db.execute("SELECT name, low_stream FROM channels").fetchall() == [("ch1", None)]
+        # last_used_at backfilled from the access log
+        assert db.execute("SELECT last_used_at FROM tokens").fetchone() == ("2024-02-01T00:00:00",)
+
+
+def test_check_when_behind(baseline):
+    with pytest.raises(migrations.SchemaError, match="migrate.py"):
+        migrations.check(baseline)
+    migrations.check(baseline, migrate_if_behind=True)
+    assert migrations.current_version(baseline) == migrations.LATEST
+
+
+def test_newer_database_is_refused(tmp_path):
+    path = str(tmp_path / "nvrwall.db")
+    migrations.migrate(path)
+    with sqlite3.connect(path) as db:
+        db.execute(f"PRAGMA user_version = {migrations.LATEST + 1}")
+    with pytest.raises(migrations.SchemaError, match="newer"):
+        migrations.check(path, migrate_if_behind=True)
+    with pytest.raises(migrations.SchemaError, match="newer"):
+        migrations.migrate(path)
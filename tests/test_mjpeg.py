@@ -0,0 +1,53 @@
+import time
+
+import pytest
+
+from app.mjpeg import SharedFeed, multipart
+
+
+class DeadFeed(SharedFeed):
+    def frames(self, should_stop):
+        while not should_stop():
+            time.sleep(0.05)
+        return
+        yield
+
+
+class OneFrameFeed(SharedFeed):
+    def frames(self, should_stop):
+        yield b"\xff\xd8jpeg\xff\xd9"
+        while not should_stop():
+            time.sleep(0.05)
+
+
+def test_frames_is_abstract(tmp_path):
+    with pytest.raises(TypeError):
+        SharedFeed("x", str(tmp_path))
+
+
+def test_dead_source_releases_viewer(tmp_path):
+    feed = DeadFeed("dead", str(tmp_path), idle_timeout=0.1, stall_timeout=0.3)
+    started = time.monotonic()
+    assert list(feed.stream()) == []
+    assert time.monotonic() - started < 2
+    assert feed.viewers == 0
+
+
+def test_keepalive_checked_while_stalled(tmp_path):
+    feed = DeadFeed("dead2", str(tmp_path), idle_timeout=0.1, stall_timeout=60)
+    feed.poll_interval = 0.1
+    calls = []
+
+    def keepalive():
+        calls.append(1)
+        return len(calls) < 3
+
+    list(feed.stream(keepalive))
+    assert len(calls) == 3
+    assert feed.viewers == 0
+
+
+def test_stream_yields_frames(tmp_path):
+    feed = OneFrameFeed("one", str(tmp_path), idle_timeout=0.1, stall_timeout=0.3)
+    parts = list(feed.stream())
+    assert parts == [multipart(b"\xff\xd8jpeg\xff\xd9")]
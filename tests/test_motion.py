@@ -0,0 +1,89 @@
+import os
+import time
+
+import pytest
+
+from app import channels, motion, recording
+from app.tokens import get_db
+
+
+class FakePool:
+    def __init__(self):
+        self.commands = []
+
+    def submit(self, fn, command, *args):
+        self.commands.append(command)
+        return object()
+
+
+def _write_live(hls_dir, stream, names, now):
+    lines = ["#EXTM3U", "#EXT-X-TARGETDURATION:2", "#EXT-X-MEDIA-SEQUENCE:0"]
+    for i, name in enumerate(names):
+        path = os.path.join(hls_dir, name)
+        with open(path, "wb") as f:
+            f.write(b"x" * 100)
+        os.utime(path, (now - 2 * (len(names) - i - 1),) * 2)
+        lines += ["#EXTINF:2.0,", name]
+    with open(os.path.join(hls_dir, f"{stream}.m3u8"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+@pytest.fixture
+def archive(app, tmp_path):
+    with app.app_context():
+        channels.save_channel("cam", sub="cam-sub")
+        channels.save_channel("door")
+    now = time.time()
+    hls_dir = app.config["HLS_DIR"]
+    _write_live(hls_dir, "cam", ["cam_1.ts", "cam_2.ts"], now)
+    _write_live(hls_dir, "cam-sub", ["cam-sub_1.ts", "cam-sub_2.ts"], now)
+    _write_live(hls_dir, "door", ["door_1.ts"], now)
+    connect = app.extensions["db"].connection
+    recorder = recording.Recorder(connect, hls_dir, str(tmp_path / "rec"))
+    recorder.tick(connect(), now)
+    return connect, str(tmp_path / "rec"), now
+
+
+def test_sub_stream_is_archived_but_not_played(archive):
+    connect, record_dir, now = archive
+    db = connect()
+    tiers = {(r["channel"], r["tier"]): r["n"] for r in db.execute(
+        "SELECT channel, tier, COUNT(*) AS n FROM segments GROUP BY channel, tier"
+    )}
+    assert tiers == {("cam", "main"): 2, ("cam", "sub"): 2, ("door", "main"): 1}
+    played = recording.find_segments(db, "cam", now - 60, now + 60, limit=10)
+    assert [os.path.basename(r["path"]).split("-", 1)[1] for r in played] == ["cam_1.ts", "cam_2.ts"]
+
+
+def test_motion_decodes_sub_stream_when_there_is_one(archive):
+    connect, record_dir, now = archive
+    analyzer = motion.MotionAnalyzer(connect, record_dir, backfill=3600)
+    analyzer._pool = FakePool()
+    analyzer._schedule(connect(), now)
+    inputs = sorted(os.path.basename(c[c.index("-i") + 1]) for c in analyzer._pool.commands)
+    assert [name.split("-", 1)[1] for name in inputs] == ["cam-sub_1.ts", "door_1.ts"]
+
+
+def test_motion_lag_in_metrics(app, client):
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            "INSERT INTO motion_progress (channel, analyzed_ts) VALUES (?, ?)",
+            ("cam", time.time() - 120),
+        )
+        db.commit()
+    body = client.get("/metrics").get_data(as_text=True)
+    line = next(l for l in body.splitlines() if l.startswith('nvrwall_motion_lag_seconds{channel="cam"}'))
+    assert 119 < float(line.split()[-1]) < 130
+
+
+def test_removed_channels_do_not_stall_scheduling(app, archive):
+    connect, record_dir, now = archive
+    analyzer = motion.MotionAnalyzer(connect, record_dir, workers=1)
+    analyzer._pool = FakePool()
+    # States of channels that are gone, more than workers * 2 of them
+    for n in range(4):
+        analyzer._state[f"gone{n}"] = motion._Channel(f"gone{n}", now - 60)
+    analyzer._schedule(connect(), now)
+    assert len(analyzer._pool.commands) == 2
+    assert not any(name.startswith("gone") for name in analyzer._state)
@@ -0,0 +1,28 @@
+import asyncio
+
+from app.playlists import PlaylistCache
+
+
+PLAYLIST = b"""#EXTM3U
+#EXT-X-VERSION:6
+#EXT-X-TARGETDURATION:2
+#EXT-X-MEDIA-SEQUENCE:10
+#EXTINF:2.0,
+seg10.ts
+"""
+
+
+def test_async_waiter_removed_on_timeout(tmp_path):
+    (tmp_path / "cam.m3u8").write_bytes(PLAYLIST)
+    cache = PlaylistCache(str(tmp_path), use_inotify=False, poll_interval=60)
+    try:
+        async def main():
+            return await asyncio.gather(
+                *(cache.wait_for_async("cam.m3u8", 12, timeout=0.05) for _ in range(20))
+            )
+
+        assert asyncio.run(main()) == [None] * 20
+        assert cache._async_waiters == {}
+    finally:
+        cache.stop()
+
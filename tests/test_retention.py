@@ -0,0 +1,88 @@
+import datetime
+
+import pytest
+
+from app.tokens import get_db
+from app.retention import (
+    access_summary,
+    get_rollup_watermark,
+    purge_access_logs,
+    rollup_access_logs,
+)
+
+
+NOW = datetime.datetime(2026, 10, 17, 12, 30)
+
+
+@pytest.fixture
+def db(app):
+    with app.app_context():
+        yield get_db()
+
+
+def log(db, when, token_id=1, path="/wall", ip="10.0.0.1"):
+    db.execute(
+        "INSERT INTO access_logs (token_id, path, ip, user_agent, created_at) VALUES (?, ?, ?, '', ?)",
+        (token_id, path, ip, when.isoformat()),
+    )
+    db.commit()
+
+
+def hourly(db):
+    return [
+        tuple(r) for r in db.execute(
+            "SELECT hour, token_id, path, hits, distinct_ips FROM access_log_hourly ORDER BY hour, path"
+        )
+    ]
+
+
+def test_rollup_nothing_logged(db):
+    assert rollup_access_logs(db, now=NOW) == 0
+    assert get_rollup_watermark(db) is None
+
+
+def test_rollup_complete_hours_and_watermark(db):
+    log(db, NOW.replace(hour=9, minute=5))
+    log(db, NOW.replace(hour=9, minute=50), ip="10.0.0.2")
+    log(db, NOW.replace(hour=9, minute=55), path="/hls/ch1.master.m3u8")
+    log(db, NOW.replace(hour=11, minute=10))     # 10:00 is empty
+    log(db, NOW.replace(hour=12, minute=20))     # current hour: not complete
+
+    assert rollup_access_logs(db, now=NOW) == 2
+    assert hourly(db) == [
+        ("2026-10-17T09", 1, "/hls/ch1.master.m3u8", 1, 1),
+        ("2026-10-17T09", 1, "/wall", 2, 2),
+        ("2026-10-17T11", 1, "/wall", 1, 1),
+    ]
+    assert get_rollup_watermark(db) == "2026-10-17T12"
+
+    # Idempotent until another hour completes
+    assert rollup_access_logs(db, now=NOW) == 0
+    assert rollup_access_logs(db, now=NOW.replace(hour=13, minute=10)) == 1
+    assert get_rollup_watermark(db) == "2026-10-17T13"
+
+
+def test_rollup_waits_for_the_grace_period(db):
+    log(db, NOW.replace(hour=11, minute=59))
+    # 12:02: the writer may still deliver rows for 11:00
+    assert rollup_access_logs(db, now=NOW.replace(hour=12, minute=2)) == 0
+    assert get_rollup_watermark(db) is None
+    assert rollup_access_logs(db, now=NOW.replace(hour=12, minute=6)) == 1
+
+
+def test_purge_keeps_rows_not_rolled_up(db):
+    old = NOW - datetime.timedelta(days=40)
+    log(db, old)
+    log(db, old + datetime.timedelta(minutes=1))
+    log(db, NOW - datetime.timedelta(days=1))
+
+    # Nothing rolled up yet: nothing may go
+    assert purge_access_logs(db, 30, now=NOW, pause=0) == 0
+
+    rollup_access_logs(db, now=NOW)
+    assert purge_access_logs(db, 30, batch_size=1, now=NOW, pause=0) == 2
+    assert db.execute("SELECT COUNT(*) FROM access_logs").fetchone()[0] == 1
+
+    # The purged hour is still reported, from the rollup
+    rows = access_summary(db, old - datetime.timedelta(hours=1), NOW)
+    assert sum(r["hits"] for r in rows) == 3
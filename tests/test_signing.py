@@ -0,0 +1,86 @@
+import time
+
+import pytest
+
+from app.signing import GRANT_COOKIE, issue_grant, verify_grant
+
+
+PLAYLIST = (
+    "#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:2\n#EXT-X-MEDIA-SEQUENCE:0\n"
+    "#EXTINF:2.0,\nch1_0.ts\n#EXTINF:2.0,\nch1_1.ts\n"
+)
+
+
+@pytest.fixture
+def live(app):
+    hls_dir = app.config["HLS_DIR"]
+    with open(f"{hls_dir}/ch1.m3u8", "w") as f:
+        f.write(PLAYLIST)
+    for i in range(2):
+        with open(f"{hls_dir}/ch1_{i}.ts", "wb") as f:
+            f.write(b"\x47" * 188)
+
+
+def test_grant_round_trip(app):
+    with app.app_context():
+        grant = verify_grant(issue_grant(7, ["ch1", "ch2"], 60))
+    assert grant.token_id == 7
+    assert 55 < grant.remaining() <= 60
+    assert grant.allows("ch1.m3u8")
+    assert grant.allows("ch2_15.ts")
+    assert not grant.allows("ch10.m3u8")
+    assert not grant.allows("ch3.m3u8")
+
+
+def test_grant_expired(app, monkeypatch):
+    with app.app_context():
+        value = issue_grant(7, ["ch1"], 60)
+        monkeypatch.setattr(time, "time", lambda: 10 ** 12)
+        assert verify_grant(value) is None
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda v: v.replace("7:", "8:", 1),        # other token
+    lambda v: v.replace("ch1", "ch1~ch2"),     # more channels
+    lambda v: v[:-2] + ("AA" if v[-2:] != "AA" else "BB"),  # signature
+    lambda v: "garbage",
+    lambda v: "",
+])
+def test_grant_tampered(app, tamper):
+    with app.app_context():
+        assert verify_grant(tamper(issue_grant(7, ["ch1"], 60))) is None
+
+
+def test_grant_other_secret(app):
+    with app.app_context():
+        value = issue_grant(7, ["ch1"], 60)
+        app.config["SECRET_KEY"] = "another"
+        assert verify_grant(value) is None
+
+
+def test_segment_needs_grant(client, live, make_token):
+    assert client.get("/hls/ch1_0.ts").status_code == 403
+    token = make_token()
+    assert client.get(f"/hls/ch1.m3u8?token={token}").status_code == 200
+    assert client.get("/hls/ch1_0.ts").status_code == 200
+
+
+def test_renewing_playlist_is_never_public(client, live, make_token):
+    token = make_token()
+    resp = client.get(f"/hls/ch1.m3u8?token={token}")
+    assert resp.status_code == 200
+    assert GRANT_COOKIE in resp.headers.get("Set-Cookie", "")
+    assert not resp.cache_control.public
+    assert resp.cache_control.private
+
+    # Blocking reloads renew the same way
+    client.delete_cookie(GRANT_COOKIE, path="/hls/")
+    resp = client.get(f"/hls/ch1.m3u8?token={token}&_HLS_msn=1")
+    assert GRANT_COOKIE in resp.headers.get("Set-Cookie", "")
+    assert not resp.cache_control.public
+
+    # Reloads inside the grant carry no cookie and may be shared
+    resp = client.get(f"/hls/ch1.m3u8?token={token}")
+    assert "Set-Cookie" not in resp.headers
+    assert resp.cache_control.public
+
@@ -0,0 +1,52 @@
+import threading
+
+from app.snapshots import SnapshotCache
+
+
+JPEG = b"\xff\xd8fake jpeg"
+
+
+class FakePlaylist:
+    def __init__(self, path, segment):
+        self.path = str(path)
+        self.data = f"#EXTM3U\n#EXTINF:2.0,\n{segment}\n".encode()
+
+
+def _workers(tmp_path, n, calls):
+    caches = [SnapshotCache(shared_dir=str(tmp_path / "shared")) for _ in range(n)]
+
+    def extract(segment):
+        calls.append(segment)
+        return JPEG
+
+    for cache in caches:
+        cache.extract = extract
+    return caches
+
+
+def test_workers_share_one_extraction(tmp_path):
+    calls = []
+    caches = _workers(tmp_path, 4, calls)
+    playlist = FakePlaylist(tmp_path / "cam.m3u8", "cam_1.ts")
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda c=cache: results.append(c.get("cam", playlist)))
+        for cache in caches
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert {r.data for r in results} == {JPEG}
+    assert sum(c.stats()["shared"] for c in caches) == 3
+
+
+def test_newer_segment_is_extracted_again(tmp_path):
+    calls = []
+    first, second = _workers(tmp_path, 2, calls)
+    first.get("cam", FakePlaylist(tmp_path / "cam.m3u8", "cam_1.ts"))
+    second.get("cam", FakePlaylist(tmp_path / "cam.m3u8", "cam_2.ts"))
+    assert [c.rsplit("/", 1)[-1] for c in calls] == ["cam_1.ts", "cam_2.ts"]
@@ -0,0 +1,90 @@
+import pytest
+
+from app import create_app, tokens
+from app.tokens import TokenCache, is_token_valid, revoke_token
+
+
+@pytest.fixture
+def other_worker(app):
+    """
+    A second app on the same database, standing in for another worker.
+    """
+    other = create_app()
+    yield other
+    other.extensions["access_log"].stop()
+
+
+def valid(app, token):
+    with app.app_context():
+        return is_token_valid(token)
+
+
+def test_cache_serves_without_db(app, make_token, monkeypatch):
+    token = make_token()
+    token_id = valid(app, token)
+    assert token_id is not None
+
+    # Pretend the row is gone: the cache still answers
+    calls = []
+    monkeypatch.setattr(tokens, "observe_db", lambda name, seconds: calls.append(name))
+    with app.app_context():
+        tokens.get_db().execute("UPDATE tokens SET token = 'moved'")
+        tokens.get_db().commit()
+        assert is_token_valid(token) == token_id
+    assert "token_lookup" not in calls
+
+
+def test_revoke_in_same_worker_is_immediate(app, make_token):
+    token = make_token()
+    token_id = valid(app, token)
+    with app.app_context():
+        revoke_token(token_id)
+    assert valid(app, token) is None
+
+
+def test_revoke_in_other_worker_seen_after_delay(app, other_worker, make_token, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(tokens.time, "monotonic", lambda: now[0])
+    app.extensions["token_cache"].generation_interval = 5
+
+    token = make_token()
+    token_id = valid(app, token)    # cached, generation recorded
+
+    with other_worker.app_context():
+        revoke_token(token_id)
+
+    # Within TOKEN_REVOCATION_DELAY this worker may still trust its cache...
+    now[0] += 1
+    assert valid(app, token) == token_id
+    # ...then the bumped generation drops the cache and the DB says revoked
+    now[0] += 5
+    assert valid(app, token) is None
+
+
+def test_create_in_other_worker_invalidates(app, other_worker, make_token):
+    token = make_token()
+    valid(app, token)
+    cache = app.extensions["token_cache"]
+    cache._generation_checked_at = float("-inf")
+    valid(app, token)  # records the current generation
+    generation = cache._generation
+
+    with other_worker.app_context():
+        tokens.create_token("other")
+    cache._generation_checked_at = float("-inf")
+    valid(app, token)
+    assert cache._generation != generation
+
+
+def test_cache_bounds_and_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(tokens.time, "monotonic", lambda: now[0])
+    cache = TokenCache(max_size=2, ttl=10)
+    cache.put("a", 1, None)
+    cache.put("b", 2, None)
+    cache.get("a")                # a is now most recent
+    cache.put("c", 3, None)       # evicts b
+    assert cache.get("b") is None
+    assert cache.get("a") == (1, None)
+    now[0] += 11
+    assert cache.get("a") is None
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+import os
+import urllib.request
+
+from app.assets import HLS_JS_CDN_URL, HLS_JS_VENDOR_PATH, HLS_JS_VERSION
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app", "static")
+
+if __name__ == "__main__":
+    dest = os.path.join(STATIC_DIR, HLS_JS_VENDOR_PATH)
+    print(f"Fetching hls.js {HLS_JS_VERSION} -> {dest}")
+    with urllib.request.urlopen(HLS_JS_CDN_URL, timeout=30) as resp:
+        data = resp.read()
+    if b"Hls" not in data:
+        print("Download does not look like hls.js. Aborting.")
+        raise SystemExit(1)
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    tmp = dest + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, dest)
+    print(f"Done ({len(data)} bytes). Commit it: /wall answers 503 without it (unless HLS_JS_CDN).")